@@ -0,0 +1,511 @@
+import heapq
+import itertools
+import json
+import logging
+import os
+import time
+import uuid
+
+import trollius as asyncio
+from trollius import From, Return
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from docker import BUILD_TIMEOUT, EVENTS_CMD, INVENTORY_SCRIPT
+from events import EventWatcher
+from reconciler import FORCE, IDLE, PRIORITIES
+from transport import Command, CommandError, CommandTimeout, LocalTransport, Result, TIMEOUT_GRACE, frame
+
+
+logger = logging.getLogger('hypervisor')
+
+
+class AsyncSession(object):
+    """ I am a _Session driven by an event loop. """
+    def __init__(self, process):
+        self.token = uuid.uuid4().hex
+        self.process = process
+
+    @classmethod
+    @asyncio.coroutine
+    def open(cls, argv):
+        devnull = open(os.devnull, 'w')
+        process = yield From(asyncio.create_subprocess_exec(*argv, stdin=asyncio.subprocess.PIPE,
+                                                            stdout=asyncio.subprocess.PIPE, stderr=devnull))
+        raise Return(cls(process))
+
+    def alive(self):
+        return self.process.returncode is None
+
+    def close(self):
+        if self.alive():
+            self.process.kill()
+
+    @asyncio.coroutine
+    def _read(self, size, deadline):
+        timeout = max(deadline - time.time(), 0) if deadline else None
+        try:
+            data = yield From(asyncio.wait_for(self.process.stdout.readexactly(size), timeout))
+        except asyncio.IncompleteReadError:
+            raise EOFError('ssh session closed')
+        except asyncio.TimeoutError:
+            raise CommandTimeout(None, 'session read')
+        raise Return(data)
+
+    @asyncio.coroutine
+    def _readline(self, deadline):
+        timeout = max(deadline - time.time(), 0) if deadline else None
+        try:
+            line = yield From(asyncio.wait_for(self.process.stdout.readline(), timeout))
+        except asyncio.TimeoutError:
+            raise CommandTimeout(None, 'session read')
+        if not line:
+            raise EOFError('ssh session closed')
+        raise Return(line.rstrip('\n'))
+
+    @asyncio.coroutine
+    def execute(self, commands):
+        """ I pipeline commands over the session and read their results. """
+        self.process.stdin.write(''.join(frame(self.token, command) for command in commands))
+        yield From(self.process.stdin.drain())
+        results = []
+        for command in commands:
+            deadline = None
+            if command.timeout:
+                deadline = time.time() + command.timeout + TIMEOUT_GRACE
+            header = yield From(self._readline(deadline))
+            while not header.startswith('@@{0} '.format(self.token)):
+                header = yield From(self._readline(deadline))
+            returncode, out_size, err_size = [int(chunk) for chunk in header.split()[1:]]
+            stdout = yield From(self._read(out_size, deadline))
+            stderr = yield From(self._read(err_size, deadline))
+            timed_out = bool(command.timeout) and returncode in (124, 137)
+            results.append(Result(command.cmd, returncode, stdout, stderr, timed_out=timed_out))
+        raise Return(results)
+
+
+class AsyncTransport(object):
+    """ I run the commands of a transport as coroutines.
+
+    Local hosts get a subprocess per command, ssh hosts a pool of
+    persistent sessions framed like the ones of SSHTransport.
+    """
+    def __init__(self, transport, sessions=1):
+        self.transport = transport
+        self.local = isinstance(transport, LocalTransport)
+        self.slots = asyncio.Semaphore(sessions)
+        self.idle = []
+
+    @asyncio.coroutine
+    def _run_local(self, command):
+        process = yield From(asyncio.create_subprocess_exec('bash', '-c', command.cmd, cwd=self.transport.cwd,
+                                                            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+                                                            stderr=asyncio.subprocess.PIPE))
+        try:
+            stdout, stderr = yield From(asyncio.wait_for(process.communicate(command.stdin), command.timeout))
+        except asyncio.TimeoutError:
+            process.kill()
+            yield From(process.wait())
+            raise Return(Result(command.cmd, process.returncode, timed_out=True))
+        raise Return(Result(command.cmd, process.returncode, stdout, stderr))
+
+    @asyncio.coroutine
+    def run_many(self, commands):
+        commands = [command if isinstance(command, Command) else Command(command) for command in commands]
+        if self.local:
+            results = []
+            for command in commands:
+                result = yield From(self._run_local(command))
+                results.append(result)
+            raise Return(results)
+
+        with (yield From(self.slots)):
+            session = self.idle.pop() if self.idle else None
+            if session is None or not session.alive():
+                logger.debug('opening async ssh session to {0}'.format(self.transport))
+                session = yield From(AsyncSession.open(self.transport.argv))
+            healthy = False
+            try:
+                results = yield From(session.execute(commands))
+                healthy = True
+            except CommandTimeout:
+                raise CommandTimeout(None, '; '.join(command.cmd for command in commands))
+            except EOFError:
+                raise CommandError(255, '; '.join(command.cmd for command in commands),
+                                   stderr='ssh session to {0} closed'.format(self.transport))
+            finally:
+                if healthy:
+                    self.idle.append(session)
+                else:
+                    session.close()
+        raise Return(results)
+
+    @asyncio.coroutine
+    def run_script(self, script, timeout=None):
+        """ I run a bash script and return its output. """
+        results = yield From(self.run_many([Command('bash -s', stdin=script, timeout=timeout)]))
+        raise Return(results[0].check().stdout)
+
+    @asyncio.coroutine
+    def follow(self, cmd, callback):
+        """ I run a long-lived command in its own process and call back with its output lines. """
+        process = yield From(asyncio.create_subprocess_exec(*self.transport._stream_argv(cmd),
+                                                            cwd=getattr(self.transport, 'cwd', None),
+                                                            stdout=asyncio.subprocess.PIPE))
+        try:
+            while True:
+                line = yield From(process.stdout.readline())
+                if not line:
+                    break
+                callback(line.rstrip('\n'))
+        finally:
+            if process.returncode is None:
+                process.kill()
+            yield From(process.wait())
+
+
+class AsyncHypervisor(object):
+    """ I drive a hypervisor from a single event loop.
+
+    Inventories, docker events, host stats, the poll timer and the control
+    endpoint are coroutines. Managing a level still goes through the
+    DockerPool and the API client, in a bounded executor. Like the
+    Reconciler, level instances are classified: idle ones are only
+    scheduled at their deadline, failing ones at the end of their backoff
+    unless forced, and the workers go to the best priority first.
+    """
+    def __init__(self, hypervisor, workers=1, refresh_rate=60, sweep_rate=3600, watch_events=False,
+                 control_port=0, retry=10):
+        self.hypervisor = hypervisor
+        self.pool = hypervisor.pool
+        self.workers = workers
+        self.refresh_rate = refresh_rate
+        self.sweep_rate = sweep_rate
+        self.watch_events = watch_events
+        self.control_port = control_port
+        self.retry = retry
+        self.loop = asyncio.get_event_loop()
+        self.executor = ThreadPoolExecutor(max_workers=workers + 1)
+        # level instances managed, and the heap of those waiting for a worker
+        self.running = 0
+        self.waiting = []
+        self.counter = itertools.count()
+        # level id -> timer handle of its next redump or retry
+        self.timers = {}
+        self.transports = dict((server.host, AsyncTransport(server.transport)) for server in self.pool.pool)
+        self.wakeup = asyncio.Event()
+        self.inflight = set()
+        self.tasks = []
+        self.swept_at = time.time()
+        self.stats = {'cycles': 0, 'duration': 0., 'submitted': 0, 'failed': 0, 'skipped': 0, 'idle': 0, 'backoff': 0}
+
+    def _native(self, server):
+        # drivers of the Docker Engine API inspect levels over HTTP
+        return not hasattr(server, 'engine')
+
+    def _in_executor(self, fn, *args):
+        return self.loop.run_in_executor(self.executor, fn, *args)
+
+    @asyncio.coroutine
+    def load_server(self, server):
+        try:
+            since = self.pool.generation()
+            with metrics.phase('inventory', server.host):
+                if self._native(server):
+                    logger.info('inventorying levels on {0}'.format(server.host))
+                    output = yield From(self.transports[server.host].run_script(INVENTORY_SCRIPT, timeout=BUILD_TIMEOUT))
+                    levels = server._parse_inventory(output)
+                else:
+                    levels = yield From(self._in_executor(server.inventory))
+            self.pool.apply_inventory(server, levels, since)
+        except Exception:
+            logger.warning('failed to load levels from {0}'.format(server.host), exc_info=True)
+
+    @asyncio.coroutine
+    def load(self):
+        """ I inventory every server concurrently. """
+        started_at = time.time()
+        self.hypervisor.rebalanced = False
+        yield From(asyncio.wait([self.load_server(server) for server in self.pool.pool]))
+        self.swept_at = time.time()
+        logger.info('loaded {0} levels from {1} servers in {2:.1f}s'.format(len(self.pool.levels), len(self.pool.pool), time.time() - started_at))
+
+    def _on_event(self, server, line):
+        event = server._parse_event(line)
+        if event and self.pool.apply_event(server, *event):
+            self.on_level_event(event[1])
+
+    @asyncio.coroutine
+    def watch(self, server):
+        """ I follow the docker events of a server. """
+        resync = False
+        while True:
+            try:
+                if resync:
+                    yield From(self.load_server(server))
+                logger.info('watching docker events on {0}'.format(server.host))
+                yield From(self.transports[server.host].follow(EVENTS_CMD, lambda line: self._on_event(server, line)))
+                logger.warning('docker events stream of {0} ended'.format(server.host))
+            except Exception:
+                logger.warning('failed to watch docker events on {0}'.format(server.host), exc_info=True)
+            resync = True
+            yield From(asyncio.sleep(self.retry))
+
+    @asyncio.coroutine
+    def watch_stats(self):
+        """ I refresh the scheduler stats of every server. """
+        scheduler = self.hypervisor.scheduler
+        while True:
+            for server in self.pool.pool:
+                try:
+                    output = yield From(self.transports[server.host].run_script(scheduler.stats_script(), timeout=60))
+                    scheduler.update(server, output)
+                except Exception:
+                    logger.warning('failed to collect stats of {0}'.format(server.host), exc_info=True)
+            yield From(asyncio.sleep(scheduler.stats_interval))
+
+    def on_level_event(self, level_id):
+        """ I reconcile a level right away when docker events changed it. """
+        if level_id in self.hypervisor.catalog and self.hypervisor.owns(level_id):
+            logger.info('waking up reconciler for level {0}'.format(level_id))
+            self.submit(self.hypervisor.catalog[level_id])
+
+    def submit(self, api_level_instance, priority=None, deadline=None):
+        """ I schedule the management of a level instance, unless it is idle, already managed or backing off. """
+        level_id = api_level_instance['_id']
+        if priority is None:
+            priority, deadline = self.hypervisor.classify(api_level_instance)
+        if priority == IDLE:
+            self.stats['idle'] += 1
+            if deadline:
+                self.schedule(api_level_instance, deadline)
+            return False
+        retry_at = self.hypervisor.backoff.retry_at(level_id) if priority != FORCE else None
+        if retry_at:
+            self.stats['backoff'] += 1
+            metrics.LEVELS_MANAGED.inc(result='backoff')
+            self.schedule(api_level_instance, retry_at)
+            return False
+        if level_id in self.inflight:
+            self.stats['skipped'] += 1
+            metrics.LEVELS_MANAGED.inc(result='skipped')
+            return False
+        self._cancel(level_id)
+        self.inflight.add(level_id)
+        self.stats['submitted'] += 1
+        self.tasks.append(self.loop.create_task(self._manage(api_level_instance, priority, deadline)))
+        return True
+
+    def request_redump(self, level_id):
+        """ I make a level instance of the catalog be redumped ahead of the others. """
+        if level_id not in self.hypervisor.catalog:
+            raise RuntimeError('level-instance {} not found'.format(level_id))
+        if not self.hypervisor.owns(level_id):
+            raise RuntimeError('level-instance {} belongs to another shard'.format(level_id))
+        self.hypervisor.forced.add(level_id)
+        # a level instance being managed is submitted again once done
+        self.submit(self.hypervisor.catalog[level_id], FORCE, time.time())
+
+    def schedule(self, api_level_instance, deadline):
+        """ I submit a level instance at its deadline, replacing its previous timer. """
+        level_id = api_level_instance['_id']
+        self._cancel(level_id)
+        self.timers[level_id] = self.loop.call_later(max(0, deadline - time.time()), self._due, level_id, deadline)
+        metrics.REDUMP_TIMERS.set(len(self.timers))
+
+    def _cancel(self, level_id):
+        timer = self.timers.pop(level_id, None)
+        if timer:
+            timer.cancel()
+            metrics.REDUMP_TIMERS.set(len(self.timers))
+
+    def _due(self, level_id, deadline):
+        self.timers.pop(level_id, None)
+        metrics.REDUMP_TIMERS.set(len(self.timers))
+        if level_id in self.hypervisor.catalog:
+            logger.info('level {0} is due'.format(level_id))
+            self.submit(self.hypervisor.catalog[level_id])
+
+    @asyncio.coroutine
+    def _acquire(self, priority, deadline):
+        """ I wait for a worker, the level instances of the best priority then deadline get one first. """
+        if self.running < self.workers and not self.waiting:
+            self.running += 1
+            return
+        future = asyncio.Future(loop=self.loop)
+        heapq.heappush(self.waiting, (priority, deadline or 0, next(self.counter), future))
+        yield From(future)
+
+    def _release(self):
+        # the worker goes to the next waiting level instance, if any
+        while self.waiting:
+            future = heapq.heappop(self.waiting)[-1]
+            if not future.done():
+                future.set_result(None)
+                return
+        self.running -= 1
+
+    @asyncio.coroutine
+    def _manage(self, api_level_instance, priority, deadline):
+        level_id = api_level_instance['_id']
+        try:
+            yield From(self._acquire(priority, deadline))
+            try:
+                if deadline:
+                    metrics.REDUMP_DELAY.observe(max(0., time.time() - deadline), priority=PRIORITIES[priority])
+                metrics.LEVELS_IN_PROGRESS.inc()
+                try:
+                    yield From(self._in_executor(self.hypervisor.manage_level, api_level_instance))
+                finally:
+                    metrics.LEVELS_IN_PROGRESS.dec()
+            finally:
+                self._release()
+            metrics.LEVELS_MANAGED.inc(result='ok')
+            self.hypervisor.backoff.succeeded(level_id)
+        except Exception as e:
+            self.stats['failed'] += 1
+            metrics.LEVELS_MANAGED.inc(result='failed')
+            logger.exception('failed to manage level {0}'.format(level_id))
+            self.hypervisor.backoff.failed(level_id, e)
+        finally:
+            self.inflight.discard(level_id)
+            self._reschedule(api_level_instance)
+
+    def _reschedule(self, api_level_instance):
+        """ I schedule the next redump of a level instance once managed, like Reconciler._reschedule. """
+        level_id = api_level_instance['_id']
+        try:
+            priority, deadline = self.hypervisor.classify(api_level_instance)
+        except Exception:
+            logger.warning('failed to schedule level {0}'.format(level_id), exc_info=True)
+            return
+        retry_at = self.hypervisor.backoff.retry_at(level_id)
+        if priority == FORCE:
+            # forced while being managed
+            self.submit(api_level_instance, priority, deadline)
+        elif retry_at and priority != IDLE:
+            self.schedule(api_level_instance, retry_at)
+        elif deadline:
+            # still due, the level instance failed to be redumped
+            if deadline <= time.time():
+                deadline = time.time() + self.hypervisor.reconciler.retry
+            self.schedule(api_level_instance, deadline)
+
+    def _fetch(self):
+        # runs in the executor, level instances are managed as the pages arrive
+        for api_level_instance in self.hypervisor.api_fetch_level_instances():
+            self.loop.call_soon_threadsafe(self.submit, api_level_instance)
+
+    @asyncio.coroutine
+    def cycle(self):
+        """ I manage every level instance of the API and wait until all of them are done. """
+        started_at = time.time()
+        for key in ('submitted', 'failed', 'skipped', 'idle', 'backoff'):
+            self.stats[key] = 0
+        try:
+            yield From(self._in_executor(self._fetch))
+        except Exception:
+            logger.warning('failed to sync level instances with the API', exc_info=True)
+        tasks, self.tasks = self.tasks, []
+        if tasks:
+            yield From(asyncio.wait(tasks))
+        self.stats['cycles'] += 1
+        self.stats['duration'] = time.time() - started_at
+        metrics.CYCLE_SECONDS.observe(self.stats['duration'])
+        logger.info('cycle done in {0:.1f}s: {1} levels, {2} failed, {3} idle, {4} backing off, {5} skipped ({6} workers)'.format(
+            self.stats['duration'], self.stats['submitted'], self.stats['failed'], self.stats['idle'], self.stats['backoff'],
+            self.stats['skipped'], self.workers))
+
+    @asyncio.coroutine
+    def handle_control(self, reader, writer):
+        """ I answer the control endpoint.
+
+        GET /status returns the state of the hypervisor, GET /metrics its
+        metrics, POST /sync starts a cycle right away and POST /redump/<uuid>
+        forces the redump of a level.
+        """
+        try:
+            request = yield From(reader.readline())
+            while True:
+                line = yield From(reader.readline())
+                if not line.strip():
+                    break
+            chunks = request.split()
+            method, path = (chunks[0], chunks[1]) if len(chunks) >= 2 else ('', '')
+            status, body = '404 Not Found', {'error': 'not found'}
+            if method == 'GET' and path == '/status':
+                status, body = '200 OK', {
+                    'levels': len(self.pool.levels),
+                    'catalog': len(self.hypervisor.catalog),
+                    'inflight': sorted(self.inflight),
+                    'cycle': self.stats,
+                    'api': self.hypervisor.api.summary(),
+                    'writer': self.hypervisor.writer.summary(),
+                    'metadata': self.pool.meta_summary(),
+                    'unhealthy': [server.host for server in self.pool.unhealthy()],
+                    'shard': self.hypervisor.shard.name if self.hypervisor.shard else None,
+                    'circuits': self.pool.circuits(),
+                    'backoff': self.hypervisor.backoff.status(),
+                }
+            elif method == 'GET' and path == '/metrics':
+                status, body = '200 OK', metrics.REGISTRY.render()
+            elif method == 'POST' and path == '/sync':
+                self.wakeup.set()
+                status, body = '202 Accepted', {}
+            elif method == 'POST' and path.startswith('/redump/'):
+                level_id = path[len('/redump/'):]
+                try:
+                    self.request_redump(level_id)
+                    status, body = '202 Accepted', {'redumping': level_id}
+                except RuntimeError as e:
+                    status, body = '404 Not Found', {'error': str(e)}
+            if isinstance(body, basestring):
+                data, content_type = body, 'text/plain; version=0.0.4'
+            else:
+                data, content_type = json.dumps(body), 'application/json'
+            writer.write('HTTP/1.0 {0}\r\nContent-Type: {1}\r\nContent-Length: {2}\r\n\r\n{3}'.format(status, content_type, len(data), data))
+            yield From(writer.drain())
+        finally:
+            writer.close()
+
+    @asyncio.coroutine
+    def run(self):
+        if self.hypervisor.state and self.pool.restore():
+            # restored levels are verified against the servers in the background
+            self.swept_at = time.time()
+            self.loop.create_task(self.load())
+        else:
+            yield From(self.load())
+        for server in self.pool.pool:
+            if not self.watch_events:
+                break
+            if self._native(server):
+                self.loop.create_task(self.watch(server))
+            else:
+                # the Engine API events come from a blocking HTTP stream
+                EventWatcher(self.pool, server, lambda level_id: self.loop.call_soon_threadsafe(self.on_level_event, level_id)).start()
+        self.loop.create_task(self.watch_stats())
+        if self.control_port:
+            yield From(asyncio.start_server(self.handle_control, '127.0.0.1', self.control_port))
+            logger.info('control endpoint listening on port {0}'.format(self.control_port))
+        while True:
+            logger.info('wake-up Neo')
+            if self.watch_events and time.time() - self.swept_at >= self.sweep_rate:
+                logger.info('sweeping docker hosts')
+                yield From(self.load())
+            elif self.hypervisor.rebalanced:
+                logger.info('shards rebalanced, inventorying docker hosts')
+                yield From(self.load())
+            yield From(self.cycle())
+            logger.info('API: {0}, {1}'.format(self.hypervisor.api.summary(), self.hypervisor.writer.summary()))
+            logger.info('level metadata cache: {0}'.format(self.pool.meta_summary()))
+            if self.hypervisor.artifacts:
+                logger.info('artifact cache: {0}'.format(self.hypervisor.artifacts.summary()))
+            try:
+                yield From(asyncio.wait_for(self.wakeup.wait(), self.refresh_rate))
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+
+    def run_forever(self):
+        self.loop.run_until_complete(self.run())
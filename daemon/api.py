@@ -0,0 +1,263 @@
+import email.utils
+import json
+import logging
+import Queue
+import threading
+import time
+
+import requests
+
+import metrics
+
+
+logger = logging.getLogger('hypervisor')
+
+
+LEVEL_INSTANCES = 'hypervisor-level-instances'
+
+# seconds subtracted from the date of a sync to tolerate slow writes on the API
+SYNC_MARGIN = 5
+
+
+class ApiError(Exception):
+    pass
+
+
+class ApiClient(object):
+    """ I talk to the Pathwar API over a persistent HTTP session.
+
+    Pages are fetched one after the other and their items yielded as they
+    arrive. Every page of a full sync is cached with its ETag and
+    Last-Modified headers and revalidated with a conditional request.
+    Between full syncs, only the level instances updated since the
+    previous sync are fetched, and not cached since that query changes
+    with every sync.
+    """
+    def __init__(self, endpoint, full_sync_interval=600, page_size=0, timeout=60, verify=False, pool_size=10):
+        self.endpoint = endpoint.rstrip('/')
+        self.full_sync_interval = full_sync_interval
+        self.page_size = page_size
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.verify = verify
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        # url -> (etag, last_modified, content), of the pages of full syncs
+        self.pages = {}
+        # server date of the last successful sync, and when the last full one ended
+        self.synced_at = None
+        self.full_synced_at = 0
+        self.fetched_at = None
+        self.stats = {'requests': 0, 'not_modified': 0, 'items': 0}
+        self.lock = threading.Lock()
+
+    def _count(self, key, value=1):
+        with self.lock:
+            self.stats[key] += value
+
+    def _get(self, resource, params, cache=True):
+        """ I GET a resource, revalidating the cached copy if there is one. """
+        url = '{0}/{1}'.format(self.endpoint, resource)
+        cache_key = '{0}?{1}'.format(url, json.dumps(sorted(params.items())))
+        headers = {}
+        cached = self.pages.get(cache_key) if cache else None
+        if cached:
+            etag, last_modified, _ = cached
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+        self._count('requests')
+        r = self.session.get(url, params=params, headers=headers, timeout=self.timeout)
+        if r.status_code == 304 and cached:
+            self._count('not_modified')
+            return cached[2], r.headers.get('Date')
+        if r.status_code != 200:
+            raise ApiError('GET {0} returned {1}'.format(resource, r.status_code))
+        content = r.json()
+        if cache and (r.headers.get('ETag') or r.headers.get('Last-Modified')):
+            self.pages[cache_key] = (r.headers.get('ETag'), r.headers.get('Last-Modified'), content)
+        return content, r.headers.get('Date')
+
+    def iter_items(self, resource, params=None, cache=True):
+        """ I yield the items of every page of a resource, caching the pages unless told not to. """
+        params = dict(params or {})
+        if self.page_size:
+            params['max_results'] = self.page_size
+        page = 1
+        while True:
+            params['page'] = page
+            content, date = self._get(resource, params, cache=cache)
+            if page == 1:
+                self.fetched_at = date
+            items = content.get('_items', [])
+            self._count('items', len(items))
+            for item in items:
+                yield item
+            if 'next' not in content.get('_links', {}) or not items:
+                return
+            page += 1
+
+    def full_sync_due(self):
+        return self.synced_at is None or time.time() - self.full_synced_at >= self.full_sync_interval
+
+    def level_instances(self, full=True):
+        """ I yield the level instances with their level, only the updated ones unless full. """
+        params = {'embedded': json.dumps({'level': 1})}
+        if not full and self.synced_at:
+            params['where'] = json.dumps({'_updated': {'$gte': self.synced_at}})
+        for item in self.iter_items(LEVEL_INSTANCES, params, cache='where' not in params):
+            yield item
+        # the server clock is authoritative, the margin covers updates racing the first page
+        parsed = email.utils.parsedate_tz(self.fetched_at) if self.fetched_at else None
+        fetched_at = email.utils.mktime_tz(parsed) if parsed else time.time()
+        self.synced_at = email.utils.formatdate(fetched_at - SYNC_MARGIN, usegmt=True)
+        if full:
+            self.full_synced_at = time.time()
+
+    def etag(self, resource):
+        """ I return the current ETag of an item. """
+        self._count('requests')
+        r = self.session.get('{0}/{1}'.format(self.endpoint, resource), timeout=self.timeout)
+        if r.status_code != 200:
+            raise ApiError('GET {0} returned {1}'.format(resource, r.status_code))
+        return r.json().get('_etag') or r.headers.get('ETag', '').strip('"')
+
+    def patch(self, resource, data, etag):
+        """ I PATCH a resource and return the response. """
+        headers = {
+            'If-Match': etag,
+            'Content-Type': 'application/json',
+        }
+        self._count('requests')
+        return self.session.patch('{0}/{1}'.format(self.endpoint, resource), data=json.dumps(data),
+                                  headers=headers, timeout=self.timeout)
+
+    def summary(self):
+        with self.lock:
+            stats = dict(self.stats)
+        return '{0} requests, {1} not modified, {2} items'.format(stats['requests'], stats['not_modified'], stats['items'])
+
+
+class UpdateWriter(object):
+    """ I PATCH level instances in the background.
+
+    Updates are queued by level instance and coalesced: while an update
+    waits, a newer one for the same level instance replaces it. A few
+    workers flush them over the pooled session of the client; an update
+    rejected because of a stale ETag (412) is retried with a fresh one.
+    Updates of a level instance are sent one at a time, a newer one waits
+    until the previous one is done, or an older one would overwrite it.
+    """
+    def __init__(self, api, workers=4, retries=3):
+        self.api = api
+        self.workers = workers
+        self.retries = retries
+        self.queue = Queue.Queue()
+        # resource -> [api_level_instance, data] waiting to be sent
+        self.pending = {}
+        # resources being sent, and notified when one is done
+        self.sending = set()
+        self.lock = threading.Lock()
+        self.done = threading.Condition(self.lock)
+        self.stats = {'queued': 0, 'coalesced': 0, 'sent': 0, 'conflicts': 0, 'failed': 0}
+        for i in range(workers):
+            thread = threading.Thread(target=self._work, name='api-writer-{0}'.format(i))
+            thread.daemon = True
+            thread.start()
+
+    def _count(self, key):
+        with self.lock:
+            self.stats[key] += 1
+
+    def submit(self, resource, api_level_instance, data):
+        """ I queue an update, replacing the one waiting for the same resource. """
+        with self.lock:
+            if resource in self.pending:
+                self.pending[resource][1] = data
+                self.stats['coalesced'] += 1
+                return
+            self.pending[resource] = [api_level_instance, data]
+            self.stats['queued'] += 1
+            if resource in self.sending:
+                # queued once the update being sent is done
+                return
+        self.queue.put(resource)
+
+    def send(self, resource, api_level_instance, data):
+        """ I send an update right away, superseding a queued one, I return True if it was applied. """
+        with self.lock:
+            self.pending.pop(resource, None)
+            while resource in self.sending:
+                self.done.wait()
+            self.sending.add(resource)
+        try:
+            return self._send(resource, api_level_instance, data)
+        finally:
+            self._sent(resource)
+
+    def _sent(self, resource):
+        """ I queue the update which arrived while a resource was being sent. """
+        with self.lock:
+            self.sending.discard(resource)
+            requeue = resource in self.pending
+            self.done.notify_all()
+        if requeue:
+            self.queue.put(resource)
+
+    def _work(self):
+        while True:
+            resource = self.queue.get()
+            try:
+                with self.lock:
+                    update = None
+                    if resource not in self.sending:
+                        update = self.pending.pop(resource, None)
+                    if update:
+                        self.sending.add(resource)
+                if update:
+                    try:
+                        self._send(resource, *update)
+                    finally:
+                        self._sent(resource)
+            except Exception:
+                logger.warning('failed to update {0}'.format(resource), exc_info=True)
+                self._count('failed')
+            finally:
+                self.queue.task_done()
+
+    def _send(self, resource, api_level_instance, data):
+        etag = api_level_instance['_etag']
+        for attempt in range(self.retries + 1):
+            with metrics.phase('api_patch', 'api'):
+                r = self.api.patch(resource, data, etag)
+            if r.status_code == 412:
+                # someone else updated the level instance since we fetched it
+                self._count('conflicts')
+                etag = self.api.etag(resource)
+                continue
+            if r.status_code >= 300:
+                break
+            self._count('sent')
+            # later updates of this level instance must match the new version
+            api_level_instance['_etag'] = r.json().get('_etag', api_level_instance['_etag'])
+            return True
+        logger.warning('API rejected the update of {0}: {1} {2}'.format(resource, r.status_code, r.text.strip()))
+        self._count('failed')
+        return False
+
+    def flush(self):
+        """ I wait until every queued update was sent. """
+        while True:
+            self.queue.join()
+            with self.lock:
+                if not self.pending and not self.sending:
+                    return
+                self.done.wait()
+
+    def summary(self):
+        with self.lock:
+            stats = dict(self.stats)
+        return '{0} updates queued, {1} coalesced, {2} sent, {3} conflicts, {4} failed, {5} waiting'.format(
+            stats['queued'], stats['coalesced'], stats['sent'], stats['conflicts'], stats['failed'], len(self.pending))
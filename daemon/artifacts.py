@@ -0,0 +1,196 @@
+import hashlib
+import json
+import logging
+import os
+import pipes
+import threading
+import time
+
+import requests
+
+
+logger = logging.getLogger('hypervisor')
+
+
+# evicts the least recently used artifacts of a host cache directory above a
+# size, abandoned partial transfers are removed after a day.
+EVICT_SCRIPT = r'''
+cd {root} || exit 0
+find . -maxdepth 1 -name '*.part' -mmin +1440 -delete
+total=0
+for file in $(ls -t | grep -v '\.part$'); do
+    total=$((total + $(stat -c %s "$file")))
+    if [ $total -gt {max_size} ]; then
+        rm -f "$file"
+    fi
+done
+'''
+
+
+class ArtifactCache(object):
+    """ I download level tarballs once and distribute them to the docker hosts.
+
+    Tarballs are stored by the sha256 of their content, on the hypervisor
+    and in a size bounded LRU directory on each host.
+    """
+    def __init__(self, root, max_size=10 * 1024 ** 3, remote_root='.hypervisor-cache', remote_max_size=10 * 1024 ** 3):
+        self.root = root
+        self.max_size = max_size
+        self.remote_root = remote_root
+        self.remote_max_size = remote_max_size
+        self.session = requests.Session()
+        self.lock = threading.Lock()
+        self.locks = {}
+        self.stats = dict.fromkeys(['local_hits', 'local_misses', 'remote_hits', 'remote_misses',
+                                    'resumed', 'bytes_downloaded', 'bytes_uploaded'], 0)
+        for directory in (self.root, os.path.join(self.root, 'partial')):
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+        self.index_path = os.path.join(self.root, 'index.json')
+        self.index = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+
+    def _lock(self, key):
+        with self.lock:
+            return self.locks.setdefault(key, threading.Lock())
+
+    def _count(self, stat, value=1):
+        with self.lock:
+            self.stats[stat] += value
+
+    def _save_index(self):
+        with self.lock:
+            data = json.dumps(self.index)
+        tmp = '{0}.tmp'.format(self.index_path)
+        with open(tmp, 'w') as f:
+            f.write(data)
+        os.rename(tmp, self.index_path)
+
+    def path(self, digest):
+        return os.path.join(self.root, digest)
+
+    def remote_path(self, digest):
+        return '{0}/{1}'.format(self.remote_root, digest)
+
+    def fetch(self, url):
+        """ I return the digest of a tarball, downloading it if needed. """
+        with self._lock(url):
+            entry = self.index.get(url)
+            headers = {}
+            if entry and os.path.exists(self.path(entry['digest'])):
+                if entry.get('etag'):
+                    headers['If-None-Match'] = entry['etag']
+                if entry.get('last_modified'):
+                    headers['If-Modified-Since'] = entry['last_modified']
+                if not headers:
+                    return self._hit(entry['digest'])
+                try:
+                    r = self.session.head(url, headers=headers, allow_redirects=True, timeout=60)
+                    if r.status_code == 304:
+                        return self._hit(entry['digest'])
+                except requests.RequestException:
+                    logger.warning('failed to revalidate {0}, using cached {1}'.format(url, entry['digest']), exc_info=True)
+                    return self._hit(entry['digest'])
+
+            self._count('local_misses')
+            digest, r = self._download(url)
+            with self.lock:
+                self.index[url] = {
+                    'digest': digest,
+                    'etag': r.headers.get('ETag'),
+                    'last_modified': r.headers.get('Last-Modified'),
+                }
+            self._save_index()
+            self._evict()
+            return digest
+
+    def _hit(self, digest):
+        self._count('local_hits')
+        os.utime(self.path(digest), None)
+        return digest
+
+    def _download(self, url):
+        partial = os.path.join(self.root, 'partial', hashlib.sha224(url).hexdigest())
+        offset = os.path.getsize(partial) if os.path.exists(partial) else 0
+        headers = {'Range': 'bytes={0}-'.format(offset)} if offset else {}
+        logger.info('downloading {0} to the artifact cache'.format(url))
+        r = self.session.get(url, headers=headers, stream=True, timeout=60)
+        if offset and (r.status_code == 416 or
+                       r.status_code == 206 and not r.headers.get('Content-Range', '').startswith('bytes {0}-'.format(offset))):
+            # the partial file is complete, longer than the artifact or out of step with it
+            logger.info('discarding the partial download of {0} at {1} bytes'.format(url, offset))
+            r.close()
+            os.remove(partial)
+            offset = 0
+            r = self.session.get(url, stream=True, timeout=60)
+        r.raise_for_status()
+        if offset and r.status_code == 206:
+            logger.info('resuming download of {0} at {1} bytes'.format(url, offset))
+            self._count('resumed')
+            mode = 'ab'
+        else:
+            mode = 'wb'
+        with open(partial, mode) as f:
+            for chunk in r.iter_content(1024 * 1024):
+                f.write(chunk)
+                self._count('bytes_downloaded', len(chunk))
+
+        sha = hashlib.sha256()
+        with open(partial, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), ''):
+                sha.update(chunk)
+        digest = sha.hexdigest()
+        os.rename(partial, self.path(digest))
+        return digest, r
+
+    def _evict(self):
+        """ I remove the least recently used local artifacts above max_size. """
+        files = []
+        for name in os.listdir(self.root):
+            path = self.path(name)
+            if os.path.isfile(path) and len(name) == 64:
+                files.append((os.path.getmtime(path), os.path.getsize(path), name))
+        total = 0
+        for _, size, name in sorted(files, reverse=True):
+            total += size
+            if total > self.max_size:
+                logger.info('evicting artifact {0}'.format(name))
+                os.remove(self.path(name))
+
+    def distribute(self, server, url):
+        """ I make sure a host has the tarball of an url and return its path there. """
+        digest = self.fetch(url)
+        remote = self.remote_path(digest)
+        with self._lock((server.host, digest)):
+            cmd = 'mkdir -p {0} ; if test -f {1}; then touch {1}; echo hit; else stat -c %s {1}.part 2>/dev/null || echo 0; fi'.format(
+                pipes.quote(self.remote_root), pipes.quote(remote))
+            state = server.transport.check_output(cmd, timeout=60).strip()
+            if state == 'hit':
+                self._count('remote_hits')
+                return remote
+
+            self._count('remote_misses')
+            offset = int(state)
+            size = os.path.getsize(self.path(digest))
+            if offset > size:
+                server.transport.call('rm -f {0}.part'.format(pipes.quote(remote)), timeout=60)
+                offset = 0
+            if offset:
+                logger.info('resuming upload of {0} to {1} at {2} bytes'.format(digest, server.host, offset))
+                self._count('resumed')
+            logger.info('uploading {0} to {1}'.format(digest, server.host))
+            server.transport.upload(self.path(digest), '{0}.part'.format(remote), offset=offset)
+            self._count('bytes_uploaded', size - offset)
+
+            cmd = 'test "$(sha256sum < {0}.part | cut -d" " -f1)" = {1} && mv {0}.part {0}'.format(pipes.quote(remote), digest)
+            if server.transport.call(cmd, timeout=600) != 0:
+                server.transport.call('rm -f {0}.part'.format(pipes.quote(remote)), timeout=60)
+                raise RuntimeError('corrupted upload of {0} to {1}'.format(digest, server.host))
+            server.transport.call(EVICT_SCRIPT.format(root=pipes.quote(self.remote_root), max_size=self.remote_max_size), timeout=600)
+            return remote
+
+    def summary(self):
+        with self.lock:
+            return ', '.join('{0}={1}'.format(key, value) for key, value in sorted(self.stats.items()))
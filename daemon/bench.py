@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import math
+import os
+import random
+import re
+import time
+import uuid
+
+# docker.py reads its configuration at import time
+os.environ.setdefault('HTTP_LEVEL_PORT', '8080')
+os.environ.setdefault('AUTH_PROXY', 'localhost')
+
+from docker import DockerDriver, DockerPool
+from placement import STRATEGIES, Scheduler
+from transport import Result, Transport
+
+
+class StubTransport(Transport):
+    """ I pretend to be a Docker server answering after a fixed latency.
+
+    Every round trip costs latency seconds plus exec_cost seconds per
+    docker command it runs. Only the commands inspecting levels are
+    understood.
+    """
+    def __init__(self, levels=10, containers=2, latency=0.02, exec_cost=0.005, manifests=False):
+        self.latency = latency
+        self.exec_cost = exec_cost
+        self.containers_per_level = containers
+        self.level_ids = [str(uuid.uuid4()) for i in range(levels)]
+        self.files = {}
+        for level_id in self.level_ids:
+            base = 'levels/{0}/'.format(level_id)
+            self.files[base + 'docker-compose.yml'] = 'www:\n  image: image-for-www\n'
+            self.files[base + 'source'] = 'http://levels.example.com/{0}.tar\n'.format(level_id)
+            if manifests:
+                self.files[base + 'MANIFEST'] = json.dumps({
+                    'level_type': 'web', 'built_at': '2015-06-01T11:59:00Z', 'dumped_at': '2015-06-01T12:00:00.000000000Z',
+                    'passphrases': [{'key': 'flag', 'value': level_id[:8]}], 'source': self.files[base + 'source'].strip(),
+                    'version': '1.0.0'})
+
+    def _containers(self, level_id):
+        return ['{0}{1:02d}'.format(level_id.replace('-', ''), i) for i in range(self.containers_per_level)]
+
+    def run_many(self, commands):
+        results = []
+        docker_commands = 0
+        for command in commands:
+            returncode, stdout, cost = self._execute(command.cmd, command.stdin)
+            docker_commands += cost
+            results.append(Result(command.cmd, returncode, stdout))
+        time.sleep(self.latency + docker_commands * self.exec_cost)
+        return results
+
+    def _execute(self, cmd, stdin):
+        """ I return the exit code and output of a command, and how many docker commands it ran. """
+        if cmd == 'docker ps --no-trunc':
+            lines = ['CONTAINER ID        IMAGE        NAMES']
+            for level_id in self.level_ids:
+                for i, container in enumerate(self._containers(level_id)):
+                    lines.append('{0} image {1}_www_{2}'.format(container, level_id.replace('-', ''), i + 1))
+            return 0, '\n'.join(lines) + '\n', 1
+        m = re.match(r'^cat > (\S+)$', cmd)
+        if m:
+            self.files[m.group(1)] = stdin
+            return 0, '', 0
+        m = re.match(r'^cat (\S+)$', cmd)
+        if m:
+            if m.group(1) not in self.files:
+                return 1, '', 0
+            return 0, self.files[m.group(1)], 0
+        if cmd == 'bash -s' and 'mark level' in stdin:
+            return self._inventory(self.level_ids)
+        if cmd == 'bash -s' and '@@built_at' in stdin:
+            return self._manifest(re.search(r'cd levels/(\S+) \|\| exit 1', stdin).group(1))
+        return 0, '', 0
+
+    def _inventory(self, level_ids):
+        lines = []
+        inspect = []
+        # docker ps and docker inspect
+        docker_commands = 2
+        for level_id in level_ids:
+            base = 'levels/{0}/'.format(level_id)
+            lines += ['@@level {0}'.format(level_id), '@@compose', self.files[base + 'docker-compose.yml']]
+            lines += ['@@source', self.files[base + 'source']]
+            docker_commands += 2
+            if base + 'MANIFEST' in self.files:
+                lines += ['@@manifest', self.files[base + 'MANIFEST']]
+                lines += ['@@container {0}'.format(container) for container in self._containers(level_id)]
+                continue
+            for container in self._containers(level_id):
+                lines += ['@@container {0}'.format(container)]
+                lines += ['@@version {0}'.format(container), '1.0.0']
+                lines += ['@@passphrases {0}'.format(container), 'flag {0}'.format(container[:8])]
+                inspect.append({'Id': container, 'State': {'StartedAt': '2015-06-01T12:00:00.000000000Z'}})
+                docker_commands += 2
+        lines += ['@@inspect', json.dumps(inspect)]
+        return 0, '\n'.join(lines), docker_commands
+
+    def _manifest(self, level_id):
+        lines = ['@@built_at 2015-06-01T11:59:00Z', '@@source', self.files['levels/{0}/source'.format(level_id)]]
+        # docker-compose ps, then inspect, version and passphrases of every container
+        docker_commands = 1
+        for container in self._containers(level_id):
+            lines += ['@@started_at 2015-06-01T12:00:00.000000000Z', '@@version', '1.0.0', '']
+            lines += ['@@passphrases', 'flag {0}'.format(container[:8]), '']
+            docker_commands += 3
+        return 0, '\n'.join(lines) + '\n', docker_commands
+
+
+class StubPool(DockerPool):
+    """ I am a pool of stubbed docker servers, which need no setup. """
+    def __init__(self, args):
+        self.args = args
+        DockerPool.__init__(self, ['bench@host{0}'.format(i) for i in range(args.hosts)])
+
+    def _make_driver(self, server_ip, host_concurrency):
+        transport = StubTransport(levels=self.args.levels, containers=self.args.containers, latency=self.args.latency,
+                                  exec_cost=self.args.exec_cost, manifests=self.args.manifests)
+        return DockerDriver(host=server_ip, max_operations=host_concurrency, transport=transport)
+
+    def init_server(self, server):
+        server.healthy = True
+
+
+def bench_load(args):
+    """ I compare the sequential per-level inspection with the batched inventory, both run by DockerDriver. """
+    pool = StubPool(args)
+    started_at = time.time()
+    for server in pool.pool:
+        for level_id in server.get_running_level_ids():
+            pool.levels[level_id] = (server.inspect_level(level_id), server)
+    sequential = time.time() - started_at
+    inspected = len(pool.levels)
+
+    pool = StubPool(args)
+    started_at = time.time()
+    pool.load()
+    batched = time.time() - started_at
+
+    print('hosts={0} levels/host={1} containers/level={2} latency={3}s manifests={4}'.format(
+        args.hosts, args.levels, args.containers, args.latency, args.manifests))
+    print('sequential inspect: {0:.2f}s ({1} levels)'.format(sequential, inspected))
+    print('batched inventory:  {0:.2f}s ({1} levels, x{2:.1f})'.format(batched, len(pool.levels), sequential / max(batched, 1e-6)))
+
+
+class SimulatedHost(object):
+    """ I am a docker host of the placement simulation. """
+    def __init__(self, host, cpus):
+        self.host = host
+        self.cpus = cpus
+
+
+def simulate_placement(strategy, args, seed):
+    """ I place levels then redump them, and measure the balance and the cold builds. """
+    rng = random.Random(seed)
+    hosts = [SimulatedHost('host{0}'.format(i), rng.choice([2, 4, 8])) for i in range(args.hosts)]
+    costs = dict(('level{0}'.format(i), rng.uniform(0.05, 0.5)) for i in range(args.hosts * args.levels))
+    # a few popular tarballs are shared by many level instances
+    digests = dict((level_id, 'digest{0}'.format(int(rng.paretovariate(1.2)) % 20)) for level_id in costs)
+    scheduler = Scheduler(strategy, max_levels=args.max_levels)
+    levels = {}
+    random.seed(seed)
+
+    def place(level_id):
+        server = scheduler.pick(hosts, levels, level_id=level_id)
+        if not server:
+            return None, False
+        stats = scheduler.stats[server.host]
+        cold = level_id not in stats.level_dirs
+        stats.artifacts.add(digests[level_id])
+        scheduler.release(server, level_id)
+        levels[level_id] = (level_id, server)
+        stats.load = sum(costs[l] for l, s in levels.values() if s is server)
+        stats.cpus = server.cpus
+        return server, cold
+
+    placements = cold_builds = rejected = 0
+    level_ids = sorted(costs)
+    for level_id in level_ids + [rng.choice(level_ids) for i in range(args.redumps)]:
+        previous = levels.pop(level_id, None)
+        if previous:
+            stats = scheduler.stats[previous[1].host]
+            stats.load = sum(costs[l] for l, s in levels.values() if s is previous[1])
+        server, cold = place(level_id)
+        if not server:
+            rejected += 1
+            continue
+        placements += 1
+        cold_builds += cold
+
+    utilizations = [scheduler.stats[host.host].utilization() for host in hosts]
+    mean = sum(utilizations) / len(utilizations)
+    stddev = math.sqrt(sum((u - mean) ** 2 for u in utilizations) / len(utilizations))
+    return {
+        'max': max(utilizations),
+        'stddev': stddev,
+        'cold': float(cold_builds) / max(placements, 1),
+        'rejected': rejected,
+    }
+
+
+def bench_placement(args):
+    """ I compare the placement strategies on a simulated pool. """
+    print('hosts={0} levels/host={1} redumps={2} max_levels={3}'.format(args.hosts, args.levels, args.redumps, args.max_levels))
+    print('{0:<16} {1:>10} {2:>10} {3:>10} {4:>10}'.format('strategy', 'max util', 'stddev', 'cold', 'rejected'))
+    started_at = time.time()
+    for strategy in sorted(STRATEGIES):
+        result = simulate_placement(strategy, args, seed=42)
+        print('{0:<16} {1:>10.2f} {2:>10.3f} {3:>9.1f}% {4:>10}'.format(
+            strategy, result['max'], result['stddev'], result['cold'] * 100, result['rejected']))
+    print('simulated in {0:.2f}s'.format(time.time() - started_at))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Pathwar\'s hypervisor benchmarks')
+    parser.add_argument('action', type=str, choices=['load', 'placement'], help='benchmark to run')
+    parser.add_argument('--hosts', type=int, default=10, help='number of stubbed docker hosts')
+    parser.add_argument('--levels', type=int, default=20, help='number of levels per host')
+    parser.add_argument('--containers', type=int, default=2, help='number of containers per level')
+    parser.add_argument('--latency', type=float, default=0.02, help='round trip time of a ssh command')
+    parser.add_argument('--exec-cost', type=float, default=0.005, help='remote cost of a docker command')
+    parser.add_argument('--manifests', action='store_true', help='stubbed levels have a MANIFEST')
+    parser.add_argument('--redumps', type=int, default=2000, help='number of simulated redumps')
+    parser.add_argument('--max-levels', type=int, default=0, help='max levels per host (0 for no limit)')
+    args = parser.parse_args()
+
+    if args.action == 'load':
+        bench_load(args)
+    elif args.action == 'placement':
+        bench_placement(args)
@@ -0,0 +1,203 @@
+import logging
+import pipes
+import re
+import threading
+import time
+
+from docker import COMMAND_TIMEOUT, BUILD_TIMEOUT, project_to_level_id
+
+
+logger = logging.getLogger('hypervisor')
+
+
+# lists what may be garbage on a host in a single round trip, ages are
+# computed against the 'now' of the host
+GC_SCAN_SCRIPT = r'''
+echo "now $(date +%s)"
+for dir in levels/*/; do
+    test -d "$dir" || continue
+    id=$(basename "$dir")
+    echo "level $id $(stat -c %Y "$dir")"
+    grep -ho 'image-for-[A-Za-z0-9_.-]*' "$dir/docker-compose.yml" 2>/dev/null | sort -u | sed "s/^/ref $id /"
+done
+docker ps --no-trunc | sed -n 's/^.*\([a-z0-9]\{32\}\)_.*_.*$/\1/p' | sort -u | sed 's/^/running /'
+docker ps -a --no-trunc --filter status=exited --format '{{.ID}} {{.Names}}' | grep '_run_' | while read -r container name; do
+    echo "container $container $(date -d "$(docker inspect -f '{{.State.FinishedAt}}' "$container")" +%s) $name"
+done
+docker images --format '{{.Repository}}' | grep '^image-for-' | sort -u | sed 's/^/image /'
+find /tmp -maxdepth 1 -type f -regex '/tmp/[0-9a-f]\{56\}' -printf 'tarball %p %T@ %s\n'
+exit 0
+'''
+
+# tears down an orphan level and everything built for it
+GC_LEVEL_SCRIPT = r'''
+docker ps -q --filter=label=ssh2docker --filter=image=unix-{level_id} | xargs -r docker kill >/dev/null
+if [ -d levels/{level_id} ]; then
+    (cd levels/{level_id} && docker-compose kill && docker-compose rm -fv) >/dev/null 2>&1
+fi
+docker ps -aq --filter name={project}_ | xargs -r docker rm -fv >/dev/null
+docker images --format '{{{{.Repository}}}}' | grep -E '^({project}_|unix-{level_id}$)' | sort -u | xargs -r docker rmi >/dev/null
+rm -rf levels/{level_id}
+'''
+
+LEVEL_ID_RE = re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$')
+
+
+class Orphan(object):
+    """ I am something to remove from a host, and why. """
+    def __init__(self, host, kind, name, reason, age=None, size=None, level_id=None):
+        self.host = host
+        self.kind = kind
+        self.name = name
+        self.reason = reason
+        self.age = age
+        self.size = size
+        self.level_id = level_id
+        # None until collected
+        self.removed = None
+
+    def __str__(self):
+        age = '{0:.1f}h'.format(self.age / 3600.) if self.age is not None else '-'
+        size = '{0:.1f}M'.format(self.size / 1024. ** 2) if self.size is not None else '-'
+        return '{0:<24} {1:<10} {2:<44} {3:>8} {4:>8}  {5}'.format(self.host, self.kind, self.name, age, size, self.reason)
+
+
+class GarbageCollector(object):
+    """ I remove from the hosts what no level instance of the API needs anymore.
+
+    Orphans are the levels which are not active in the API, copies of active
+    levels left on another host than theirs, the images no remaining level
+    refers to, the containers left by docker-compose run and the downloaded
+    tarballs. Levels not active in the API are orphans whatever their age,
+    anything else younger than retention seconds is kept, and so are the
+    stopped copies of protected levels (those deserving a warm spare). At
+    most rate orphans per minute are removed from each host.
+    """
+    def __init__(self, pool, retention=86400, rate=30):
+        self.pool = pool
+        self.retention = retention
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.stats = dict.fromkeys(['runs', 'orphans', 'removed', 'failed', 'freed_bytes'], 0)
+
+    def _count(self, stat, value=1):
+        with self.lock:
+            self.stats[stat] += value
+
+    def scan(self, server):
+        """ I return what may be garbage on a server. """
+        scan = {'now': time.time(), 'levels': {}, 'refs': {}, 'running': set(), 'containers': [], 'images': [], 'tarballs': []}
+        output = server.transport.run_script(GC_SCAN_SCRIPT, timeout=BUILD_TIMEOUT)
+        for line in output.splitlines():
+            chunks = line.split()
+            if len(chunks) < 2:
+                continue
+            kind, args = chunks[0], chunks[1:]
+            if kind == 'now':
+                scan['now'] = float(args[0])
+            elif kind == 'level' and len(args) == 2 and LEVEL_ID_RE.match(args[0]):
+                scan['levels'][args[0]] = float(args[1])
+            elif kind == 'ref' and len(args) == 2:
+                scan['refs'].setdefault(args[0], set()).add(args[1])
+            elif kind == 'running' and project_to_level_id(args[0]):
+                scan['running'].add(project_to_level_id(args[0]))
+            elif kind == 'container' and len(args) == 3:
+                scan['containers'].append((args[0], float(args[1]), args[2]))
+            elif kind == 'image':
+                scan['images'].append(args[0])
+            elif kind == 'tarball' and len(args) == 3:
+                scan['tarballs'].append((args[0], float(args[1]), int(args[2])))
+        return scan
+
+    def plan(self, server, scan, active, protected=()):
+        """ I return the orphans of a server from its scan.
+
+        active is the set of the level ids active in the API, protected
+        the level ids whose stopped copies must be kept.
+        """
+        now = scan['now']
+        orphans = []
+        kept = set()
+        for level_id in set(scan['levels']) | scan['running']:
+            age = now - scan['levels'][level_id] if level_id in scan['levels'] else None
+            owner = self.pool.levels.get(level_id, (None, None))[1]
+            if level_id not in active:
+                orphans.append(Orphan(server.host, 'level', level_id, 'not active in the API', age=age, level_id=level_id))
+            elif owner is None or owner is server or level_id in scan['running'] or level_id in protected:
+                kept.add(level_id)
+            elif age is not None and age < self.retention:
+                kept.add(level_id)
+            else:
+                orphans.append(Orphan(server.host, 'level', level_id, 'stopped copy, runs on {0}'.format(owner.host), age=age, level_id=level_id))
+        referenced = set()
+        for level_id in kept:
+            referenced.update(scan['refs'].get(level_id, ()))
+        for image in scan['images']:
+            if image not in referenced:
+                orphans.append(Orphan(server.host, 'image', image, 'no level refers to it'))
+        for container, finished_at, name in scan['containers']:
+            if now - finished_at >= self.retention:
+                orphans.append(Orphan(server.host, 'container', container[:12], 'left by {0}'.format(name), age=now - finished_at))
+        for path, modified_at, size in scan['tarballs']:
+            if now - modified_at >= self.retention:
+                orphans.append(Orphan(server.host, 'tarball', path, 'downloaded', age=now - modified_at, size=size))
+        # levels first, their images are not orphans until they are gone
+        orphans.sort(key=lambda orphan: ['level', 'container', 'image', 'tarball'].index(orphan.kind))
+        return orphans
+
+    def remove(self, server, orphan):
+        """ I remove an orphan from its server. """
+        if orphan.kind == 'level':
+            script = GC_LEVEL_SCRIPT.format(level_id=orphan.level_id, project=orphan.level_id.replace('-', ''))
+            with self.pool.guarded(server), server.slots:
+                server.transport.run_script(script, timeout=BUILD_TIMEOUT)
+            server.meta.invalidate(orphan.level_id)
+            self.pool.forget(orphan.level_id, server)
+            return
+        cmd = {
+            'container': 'docker rm -v {0}',
+            'image': 'docker rmi {0}',
+            'tarball': 'rm -f {0}',
+        }[orphan.kind].format(pipes.quote(orphan.name))
+        with self.pool.guarded(server):
+            server.transport.check_call(cmd, timeout=COMMAND_TIMEOUT)
+
+    def collect_server(self, server, active, protected=(), dry_run=False):
+        """ I remove the orphans of a server, I return them. """
+        orphans = self.plan(server, self.scan(server), active, protected)
+        self._count('orphans', len(orphans))
+        if dry_run:
+            return orphans
+        next_at = time.time()
+        for orphan in orphans:
+            delay = next_at - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            next_at = time.time() + 60. / max(1, self.rate)
+            try:
+                self.remove(server, orphan)
+            except Exception:
+                logger.warning('failed to remove {0} {1} from {2}'.format(orphan.kind, orphan.name, server.host), exc_info=True)
+                orphan.removed = False
+                self._count('failed')
+                continue
+            logger.info('removed {0} {1} from {2}: {3}'.format(orphan.kind, orphan.name, server.host, orphan.reason))
+            orphan.removed = True
+            self._count('removed')
+            self._count('freed_bytes', orphan.size or 0)
+        return orphans
+
+    def collect(self, active, protected=(), servers=None, dry_run=False):
+        """ I collect the garbage of the servers in parallel, I return their orphans. """
+        self._count('runs')
+        servers = [server for server in (self.pool.pool if servers is None else servers) if server.breaker.allows()]
+        outcome = self.pool.fanout(lambda server: self.collect_server(server, active, protected, dry_run=dry_run),
+                                   servers=servers, name='gc')
+        orphans = []
+        for server in servers:
+            orphans.extend(outcome.results.get(server.host, []))
+        return orphans
+
+    def summary(self):
+        with self.lock:
+            return ', '.join('{0}={1}'.format(key, value) for key, value in sorted(self.stats.items()))
@@ -1,65 +1,365 @@
+import contextlib
+import copy
 import dateutil.parser
 import hashlib
+import itertools
+import json
 import logging
 import os
+import pipes
 import random
 import re
-import subprocess
 import sys
 import socket
-import tempfile
+import threading
 import time
 import yaml
 
+import metrics
+from transport import CommandError, CommandTimeout, make_transport
+
 
 logger = logging.getLogger('hypervisor')
 
 
 HTTP_LEVEL_PORT = int(os.environ['HTTP_LEVEL_PORT'])
 AUTH_PROXY = os.environ['AUTH_PROXY']
+# timeouts in seconds of quick remote commands and of downloads/builds
+COMMAND_TIMEOUT = int(os.environ.get('COMMAND_TIMEOUT') or 120)
+BUILD_TIMEOUT = int(os.environ.get('BUILD_TIMEOUT') or 3600)
+# extract levels and import their images in one pass, requires GNU tar on the hosts
+STREAM_INGEST = bool(int(os.environ.get('STREAM_INGEST') or 0))
+
+
+# follows level containers events, the container name is appended to each
+# line since docker events only reports ids
+EVENTS_CMD = r'''docker events --filter event=start --filter event=die --filter event=destroy | while read -r line; do
+    id=$(echo "$line" | grep -o '\b[0-9a-f]\{12,64\}\b' | head -n 1)
+    echo "$line $(docker inspect -f '{{.Name}}' "$id" 2>/dev/null)"
+done'''
+
+PASSPHRASES_CMD = 'for file in /pathwar/passphrases/*; do echo -n "$(basename $file) "; cat $file; done'
+VERSION_CMD = "grep version /pathwar/level.yml | awk '// { print $2; }'"
+
+
+# Inventories every running level of a host in a single round trip, the
+# output is a stream of '@@<section> [arg]' markers parsed by
+# DockerDriver._parse_inventory.
+INVENTORY_SCRIPT = r'''
+mark() { echo; echo "@@$*"; }
+containers=""
+for merged in $(docker ps --no-trunc | sed -n 's/^.*\([a-z0-9]\{32\}\)_.*_.*$/\1/p' | sort -u); do
+    id=$(echo "$merged" | sed 's/^\(.\{8\}\)\(.\{4\}\)\(.\{4\}\)\(.\{4\}\)/\1-\2-\3-\4-/')
+    mark level "$id"
+    mark compose
+    cat "levels/$id/docker-compose.yml" 2>/dev/null
+    mark source
+    cat "levels/$id/source" 2>/dev/null
+    if [ -f "levels/$id/MANIFEST" ]; then
+        # captured when the level was created, no container to run
+        mark manifest
+        cat "levels/$id/MANIFEST"
+        for container in $(cd "levels/$id" 2>/dev/null && docker-compose ps -q); do
+            mark container "$container"
+        done
+        continue
+    fi
+    if docker inspect "unix-$id" >/dev/null 2>&1; then
+        mark passphrases "unix-$id"
+        docker run --entrypoint=bash --rm "unix-$id" -c 'for file in /pathwar/passphrases/*; do echo -n "$(basename $file) "; cat $file; done' 2>/dev/null
+    fi
+    for container in $(cd "levels/$id" 2>/dev/null && docker-compose ps -q); do
+        containers="$containers $container"
+        mark container "$container"
+        mark version "$container"
+        docker exec "$container" bash -c "grep version /pathwar/level.yml | awk '// { print \$2; }'" 2>/dev/null
+        mark passphrases "$container"
+        docker exec "$container" bash -c 'for file in /pathwar/passphrases/*; do echo -n "$(basename $file) "; cat $file; done' 2>/dev/null
+    done
+done
+mark inspect
+test -n "$containers" && docker inspect $containers
+exit 0
+'''
+
+
+# gathers what a level reports about itself once created, DockerDriver.capture_manifest
+# turns it into the MANIFEST of the level
+MANIFEST_SCRIPT = r'''
+cd levels/{level_id} || exit 1
+echo "@@built_at $(date -u -r BUILD +%Y-%m-%dT%H:%M:%SZ 2>/dev/null)"
+echo "@@source"
+cat source 2>/dev/null
+if [ {level_type} = unix ]; then
+    echo "@@dumped_at $(cat DUMPED 2>/dev/null)"
+    echo "@@passphrases"
+    docker run --entrypoint=bash --rm unix-{level_id} -c {unix_cmd} 2>/dev/null
+else
+    for container in $(docker-compose ps -q); do
+        echo "@@started_at $(docker inspect -f '{{{{.State.StartedAt}}}}' "$container")"
+        echo "@@version"
+        docker exec "$container" bash -c {version_cmd} 2>/dev/null
+        echo
+        echo "@@passphrases"
+        docker exec "$container" bash -c {passphrases_cmd} 2>/dev/null
+        echo
+    done
+fi
+exit 0
+'''
+
+
+# reads the build record of a level along with the current digests of its
+# tarball and compose file and the ids of the recorded images
+BUILD_CHECK_SCRIPT = r'''
+{tarball_check}
+cd levels/{level_id} 2>/dev/null || exit 0
+cat BUILD 2>/dev/null
+echo "current_compose $(sha256sum < docker-compose.yml 2>/dev/null | cut -d' ' -f1)"
+for image in $(awk '$1 == "image" {{print $2}}' BUILD 2>/dev/null); do
+    echo "current_image $image $(docker inspect -f '{{{{.Id}}}}' $image 2>/dev/null)"
+done
+'''
 
+# records what has been built for a level
+BUILD_RECORD_SCRIPT = r'''
+cd levels/{level_id} || exit 1
+echo {source} > source
+{{
+    echo "tarball {tarball}"
+    echo "compose $(sha256sum < docker-compose.yml | cut -d' ' -f1)"
+    echo "type {level_type}"
+    echo "main {main}"
+    for image in {images}; do
+        echo "image $image $(docker inspect -f '{{{{.Id}}}}' $image)"
+    done
+}} > BUILD
+'''
 
-def check_call(*args, **kwargs):
-    logger.debug("Executing: {}".format(*args))
-    return subprocess.check_call(*args, **kwargs)
 
+# run by tar for each file of a level tarball: '<name>.tar' files used by the
+# compose file as 'image-for-<name>' are piped to docker import, the others
+# written to disk
+INGEST_MEMBER_CMD = r'''
+umask 022  # tar clears the umask of its commands when it preserves permissions
+name="${TAR_FILENAME#./}"
+image="image-for-${name%.tar}"
+if [ "$name" != "${name%.tar}" ] && [ "$name" = "${name##*/}" ] && grep -qsw -- "$image" docker-compose.yml; then
+    docker import - "$image" >/dev/null && echo "$name" >> .imported && echo "imported $image"
+else
+    mkdir -p "$(dirname "$name")" && cat > "$name" && chmod "$TAR_MODE" "$name"
+fi
+'''
 
-def call(*args, **kwargs):
-    logger.debug("Executing: {}".format(*args))
-    return subprocess.call(*args, **kwargs)
+# imports an image of a level from its '<name>.tar', read from the level
+# tarball when it was streamed to docker import instead of written to disk
+IMPORT_SCRIPT = r'''
+set -o pipefail
+archive=$(readlink -f {archive}) || exit 1
+cd levels/{level_id} || exit 1
+if [ -f {member} ]; then
+    cat {member}
+else
+    tar -xOf "$archive" {member} 2>/dev/null || tar -xOf "$archive" ./{member}
+fi | docker import - {image} >/dev/null
+'''
 
+# extracts a level tarball in a single read, the checksum of the tarball is
+# computed as it streams through
+INGEST_SCRIPT = r'''
+set -o pipefail
+umask 022
+archive=$(readlink -f {archive}) || exit 1
+mkdir -p levels/{level_id} && cd levels/{level_id} || exit 1
+case "$(head -c 3 "$archive" | od -An -tx1 | tr -d ' \n')" in
+    1f8b*) decompress="gzip -dc" ;;
+    425a68) decompress="bzip2 -dc" ;;
+    fd377a) decompress="xz -dc" ;;
+    *) decompress=cat ;;
+esac
+rm -f .ingest .listing .special .imported && mkfifo .ingest .listing && touch .imported || exit 1
+sha256sum < .ingest | cut -d' ' -f1 > .digest &
+# --to-command only sees regular files, the others are listed to be extracted afterwards
+tar -tvf - < .listing | grep -v '^-' > .special &
+cat "$archive" | tee .ingest | $decompress | tee .listing | {{ tar -xf - --to-command={member}; status=$?; cat > /dev/null; exit $status; }}
+status=$?
+wait
+if [ $status = 0 ] && [ -s .special ]; then
+    $decompress < "$archive" | tar -xf - --skip-old-files --exclude-from=.imported
+    status=$?
+fi
+echo "digest $(cat .digest)"
+rm -f .ingest .listing .special .imported .digest
+exit $status
+'''
 
-def check_output(*args, **kwargs):
-    logger.debug("Executing: {}".format(*args))
-    return subprocess.check_output(*args, **kwargs)
+# writes the config of the nginx proxy and (re)starts it, unless the config
+# running has the same digest
+NGINX_PROXY_SCRIPT = r'''
+mkdir -p hypervisor-nginx-proxy && cd hypervisor-nginx-proxy || exit 1
+if [ "$(cat DIGEST 2>/dev/null)" = "{digest}" ] && docker-compose ps 2>/dev/null | grep -q ' Up'; then
+    echo unchanged
+    exit 0
+fi
+cat > docker-compose.yml <<'HYPERVISOR_EOF'
+{compose}HYPERVISOR_EOF
+cat > my_proxy.conf <<'HYPERVISOR_EOF'
+{conf}HYPERVISOR_EOF
+docker-compose up -d && echo {digest} > DIGEST
+'''
+
+
+def project_to_level_id(project):
+    """ I turn a docker-compose project name back into a level id. """
+    if len(project) != 32:
+        return None
+    return '{0}-{1}-{2}-{3}-{4}'.format(project[:8], project[8:12], project[12:16], project[16:20], project[20:32])
 
 
 class Level(object):
-    def __init__(self, id=None, passphrases=None, address=None, dumped_at=None, version=None, source=None):
+    def __init__(self, id=None, passphrases=None, address=None, dumped_at=None, version=None, source=None, running=True):
         self.id = id
         self.passphrases = passphrases
         self.address = address
         self.dumped_at = dumped_at
         self.version = version
         self.source = source
+        # turned off by docker events when a container of the level stops
+        self.running = running
+
+
+class BuildRecord(object):
+    """ I am what was built for a level on a host, and what is there now. """
+    def __init__(self):
+        self.tarball = None
+        self.compose = None
+        self.level_type = None
+        self.main = None
+        self.images = {}
+        self.current_tarball = None
+        self.current_compose = None
+        self.current_images = {}
+
+    def parse(self, output):
+        for line in output.splitlines():
+            chunks = line.split()
+            if len(chunks) < 2:
+                continue
+            key, value = chunks[0], chunks[1]
+            if key in ('tarball', 'compose', 'main', 'current_tarball', 'current_compose'):
+                setattr(self, key, value)
+            elif key == 'type':
+                self.level_type = value
+            elif key == 'image' and len(chunks) == 3:
+                self.images[value] = chunks[2]
+            elif key == 'current_image' and len(chunks) == 3:
+                self.current_images[value] = chunks[2]
+        return self
+
+    def tarball_changed(self):
+        return not self.tarball or self.tarball != self.current_tarball
+
+    def image_missing(self, image):
+        return image not in self.images or self.images[image] != self.current_images.get(image)
+
+    def up_to_date(self):
+        """ I return True if the level can be started from its existing images. """
+        if self.tarball_changed() or not self.compose or self.compose != self.current_compose:
+            return False
+        return bool(self.images) and not any(self.image_missing(image) for image in self.images)
+
+
+class LevelMetadata(object):
+    """ I am what a host knows about a level, beside its state. """
+    def __init__(self):
+        self.compose = None
+        self.level_type = None
+        self.main = None
+        # None until listed
+        self.containers = None
+        self.images = {}
+        # MANIFEST of the level, as captured once created
+        self.manifest = None
+
+
+class MetadataCache(object):
+    """ I cache the metadata of the levels of a host.
+
+    Entries are invalidated when a level is extracted or destroyed, and
+    its containers when they start or die.
+    """
+    def __init__(self):
+        self.levels = {}
+        self.stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+        self.lock = threading.Lock()
+
+    def get(self, level_id, attribute):
+        """ I return a cached attribute of a level, None on a miss. """
+        with self.lock:
+            value = getattr(self.levels.get(level_id), attribute, None)
+            self.stats['hits' if value is not None else 'misses'] += 1
+            return value
+
+    def peek(self, level_id, attribute):
+        """ I return a cached attribute of a level without counting a hit or a miss. """
+        with self.lock:
+            return getattr(self.levels.get(level_id), attribute, None)
+
+    def set(self, level_id, **attributes):
+        with self.lock:
+            entry = self.levels.setdefault(level_id, LevelMetadata())
+            for attribute, value in attributes.items():
+                setattr(entry, attribute, value)
+
+    def set_compose(self, level_id, compose, level_type):
+        self.set(level_id, compose=copy.deepcopy(compose), level_type=level_type,
+                 main=compose.keys()[0] if compose else None)
+
+    def knows(self, level_id):
+        with self.lock:
+            return level_id in self.levels
+
+    def invalidate(self, level_id, attribute=None):
+        """ I forget a level, or one of its attributes. """
+        with self.lock:
+            self.stats['invalidations'] += 1
+            if attribute is None:
+                self.levels.pop(level_id, None)
+            elif level_id in self.levels:
+                setattr(self.levels[level_id], attribute, LevelMetadata().__dict__[attribute])
 
 
 class DockerDriver(object):
     """ I manage a Docker server. """
-    def __init__(self, host=None):
+    def __init__(self, host=None, max_operations=1, transport=None):
         self.host = host
-        if '@' in host:
+        # bounds the number of concurrent level operations on this host
+        self.slots = threading.BoundedSemaphore(max_operations)
+        if host.startswith('local:'):
+            self.ip = '127.0.0.1'
+        elif '@' in host:
             self.ip = host.split('@')[1]
         else:
             self.ip = host
-        ssh_options = '-o ControlMaster=auto -o ControlPersist=10m -o ControlPath=~/%r@%h:%p -o UserKnownHostsFile=/dev/null -o StrictHostKeyChecking=no'
-        self.ssh = 'ssh {0} {1}'.format(host, ssh_options)
-        self.scp = 'scp {0}'.format(ssh_options)
+        # one extra session so inspections are not stuck behind builds
+        self.transport = transport or make_transport(host, sessions=max_operations + 1)
+        # container id -> level id, docker events do not name destroyed containers
+        self.containers = {}
+        # shared ArtifactCache, tarballs are downloaded by each host without it
+        self.artifacts = None
+        self.meta = MetadataCache()
+        # None until initialized, False while it fails to be, see DockerPool.init_servers
+        self.healthy = None
+        # takes the host out of placement while it fails, tuned by DockerPool
+        self.breaker = Breaker(host)
 
-        self._setup_nginx_proxy()
+    def _phase(self, name, level_id=None):
+        """ I time a lifecycle phase of a level on the host. """
+        level_type = self.meta.peek(level_id, 'level_type') if level_id else None
+        return metrics.phase(name, self.host, level_type)
 
     def _setup_nginx_proxy(self):
-        """ I ensure the nginx proxy is up. """
+        """ I ensure the nginx proxy is up with the current config, I return True if I had to (re)start it. """
 
         docker_compose = """# generated by the hypervisor
 proxy:
@@ -79,87 +379,99 @@ deny all;
 proxy_set_header Authorization "";
 """.format(socket.gethostbyname(AUTH_PROXY))
 
-        try:
-            # create dir if not exists
-            cmd = '{0} "mkdir -p hypervisor-nginx-proxy"'.format(self.ssh)
-            call(cmd, shell=True)
-
-            # overwrite compose file
-            fd, tmpfile = tempfile.mkstemp()
-            os.write(fd, docker_compose)
-            os.close(fd)
-            cmd = '{0} {1} {2}:hypervisor-nginx-proxy/docker-compose.yml'.format(self.scp, tmpfile, self.host)
-            check_call(cmd, shell=True)
-            os.remove(tmpfile)
-
-            # overwrite the config
-            fd, tmpfile = tempfile.mkstemp()
-            os.write(fd, my_proxy)
-            os.close(fd)
-            cmd = '{0} {1} {2}:hypervisor-nginx-proxy/my_proxy.conf'.format(self.scp, tmpfile, self.host)
-            check_call(cmd, shell=True)
-            os.remove(tmpfile)
-
-            # docker-compose up the proxy
-            logger.info('running nginx-proxy on {0}'.format(self.host))
-            cmd = '{0} "cd hypervisor-nginx-proxy ; docker-compose up -d"'.format(self.ssh)
-            call(cmd, shell=True)
-        except Exception as e:
-            logger.warning('failed to setup nginx proxy server on {0}'.format(self.host),  exc_info=True)
+        # a single round trip, skipped when the same config already runs
+        digest = hashlib.sha256(docker_compose + my_proxy).hexdigest()
+        script = NGINX_PROXY_SCRIPT.format(digest=digest, compose=docker_compose, conf=my_proxy)
+        if self.transport.run_script(script, timeout=BUILD_TIMEOUT).strip() == 'unchanged':
+            logger.info('nginx-proxy up to date on {0}'.format(self.host))
+            return False
+        logger.info('nginx-proxy (re)started on {0}'.format(self.host))
+        return True
 
     def _get_compose(self, level_id):
         """ I return the docker-compose.yml file of a level. """
-        cmd = '{0} cat levels/{1}/docker-compose.yml'.format(self.ssh, level_id)
-        return yaml.load(check_output(cmd, shell=True))
+        compose = self.meta.get(level_id, 'compose')
+        if compose is not None:
+            # callers patch the services they get
+            return copy.deepcopy(compose)
+        cmd = 'cat levels/{0}/docker-compose.yml'.format(level_id)
+        compose = yaml.load(self.transport.check_output(cmd, timeout=COMMAND_TIMEOUT))
+        if compose:
+            self.meta.set_compose(level_id, compose, self._level_type_from_compose(compose))
+        return compose
 
     def _write_compose(self, level_id, compose):
         """ I write back the docker-compose.yml file of a level. """
-        fd, tmpfile = tempfile.mkstemp()
-        os.write(fd, yaml.dump(compose, default_flow_style=False))
-        os.close(fd)
-        cmd = '{0} {1} {2}:levels/{3}/docker-compose.yml'.format(self.scp, tmpfile, self.host, level_id)
-        check_call(cmd, shell=True)
-        os.remove(tmpfile)
+        path = 'levels/{0}/docker-compose.yml'.format(level_id)
+        self.transport.put(path, yaml.dump(compose, default_flow_style=False), timeout=COMMAND_TIMEOUT)
+        self.meta.set_compose(level_id, compose, self._level_type_from_compose(compose))
 
     def get_running_level_ids(self):
         """ I return the list of IDs of running levels on the host. """
         uuids = set()
-        cmd = '{0} "docker ps --no-trunc"'.format(self.ssh)
-        for line in check_output(cmd, shell=True).splitlines():
+        for line in self.transport.check_output('docker ps --no-trunc', timeout=COMMAND_TIMEOUT).splitlines():
             m = re.match('^.*([a-z0-9]{32})_.*_.*$', line)
             if m:
-                uuid_merged = m.group(1)
-                uuid = '{0}-{1}-{2}-{3}-{4}'.format(uuid_merged[:8],
-                                                    uuid_merged[8:12],
-                                                    uuid_merged[12:16],
-                                                    uuid_merged[16:20],
-                                                    uuid_merged[20:32])
-                uuids.add(uuid)
+                uuids.add(project_to_level_id(m.group(1)))
         return uuids
 
+    def watch_events(self):
+        """ I yield (action, level_id) for the start, die and destroy events of level containers. """
+        for line in self.transport.stream(EVENTS_CMD):
+            event = self._parse_event(line)
+            if event:
+                yield event
+
+    def _parse_event(self, line):
+        """ I return (action, level_id) for a line of EVENTS_CMD, None if it is not about a level. """
+        action = None
+        for word in ('start', 'die', 'destroy'):
+            if re.search(r'(^|\s){0}(\s|$)'.format(word), line):
+                action = word
+        container = re.search(r'\b([0-9a-f]{12,64})\b', line)
+        if not action or not container:
+            return None
+        container = container.group(1)[:12]
+        m = re.search('([a-z0-9]{32})_[^_\s]*_\S*', line)
+        if m:
+            self.containers[container] = project_to_level_id(m.group(1))
+        level_id = self.containers.get(container)
+        if action == 'destroy':
+            self.containers.pop(container, None)
+        if level_id:
+            if action != 'die':
+                self.meta.invalidate(level_id, 'containers')
+            return action, level_id
+
     def destroy_level(self, level_id):
-        """ I destroy a level by ID. """
+        """ I destroy a level by ID, there is nothing to do if the host does not have it. """
 
-        level_type = self.get_level_type(level_id)
-        if level_type == "unix":
-            cmd = "{0} 'docker ps -q --filter=label=ssh2docker --filter=image=unix-{1} | xargs docker kill'".format(self.ssh, level_id)
-            call(cmd, shell=True)
+        with self._phase('destroy', level_id):
+            try:
+                level_type = self.get_level_type(level_id)
+            except CommandError as e:
+                if is_host_failure(e):
+                    raise
+                # no docker-compose.yml, the level was never extracted here
+                logger.debug('no level {0} on {1} to destroy'.format(level_id, self.host))
+                self.meta.invalidate(level_id)
+                return
+            if level_type == "unix":
+                cmd = 'docker ps -q --filter=label=ssh2docker --filter=image=unix-{0} | xargs docker kill'.format(level_id)
+                self.transport.call(cmd, timeout=COMMAND_TIMEOUT)
 
-        # stopping level
-        logger.info('stopping level {0} on {1}'.format(level_id, self.host))
-        cwd = 'levels/{0}'.format(level_id)
-        cmd = '{0} "test -d {1} && (cd {1} ; docker-compose kill; docker-compose rm -fv)"'.format(self.ssh, cwd)
-        call(cmd, shell=True)
+            # stopping level
+            logger.info('stopping level {0} on {1}'.format(level_id, self.host))
+            cwd = 'levels/{0}'.format(level_id)
+            cmd = 'test -d {0} && (cd {0} ; docker-compose kill; docker-compose rm -fv)'.format(cwd)
+            self.transport.call(cmd, timeout=BUILD_TIMEOUT)
+        self.meta.invalidate(level_id)
 
-    def rebuild_if_needed(self, level_id, tarball, conf):
+    def rebuild_if_needed(self, level_id, tarball, conf, changed=True, imported=False, archive=None):
             # never reached if level is not needed
             m = re.match('image\-for\-(.*)', conf['image'])
             if m:
-                try:
-                    cmd = '{0} "cat levels/{1}/REBUILD"'.format(self.ssh, level_id)
-                    check_call(cmd, shell=True)
-                    # raise here if level has no REBUILD file
-                except:
+                if not changed:
                     logger.info('do not rebuild level image for {0}, not changed'.format(level_id))
                     return
 
@@ -168,17 +480,28 @@ proxy_set_header Authorization "";
                 # FIXME: removing level
                 # logger.info('removing level {0} on {1}'.format(level_id, self.host))
                 # cwd = 'levels/{0}'.format(level_id)
-                # cmd = '{0} "cd {1} ; docker-compose rm -f"'.format(self.ssh, cwd)
-                # call(cmd, shell=True)
+                # cmd = 'cd {0} ; docker-compose rm -f'.format(cwd)
+                # self.transport.call(cmd)
 
 
                 # rebuild
                 logger.info('rebuilding level image for {0}'.format(level_id))
                 tarball = '{0}.tar'.format(m.group(1))
-                logger.info('importing {0}'.format(conf['image']))
                 cwd = 'levels/{0}'.format(level_id)
-                cmd = '{0} "cd {1} ; cat {2} | docker import - {3}"'.format(self.ssh, cwd, tarball, conf['image'])
-                check_call(cmd, shell=True)
+                if imported:
+                    logger.info('{0} imported while extracting'.format(conf['image']))
+                elif archive:
+                    # the member may have been streamed when the level was extracted
+                    logger.info('importing {0}'.format(conf['image']))
+                    with self._phase('import', level_id):
+                        script = IMPORT_SCRIPT.format(archive=archive, level_id=level_id, member=pipes.quote(tarball),
+                                                      image=pipes.quote(conf['image']))
+                        self.transport.run_script(script, timeout=BUILD_TIMEOUT)
+                else:
+                    logger.info('importing {0}'.format(conf['image']))
+                    with self._phase('import', level_id):
+                        cmd = 'cd {0} ; cat {1} | docker import - {2}'.format(cwd, tarball, conf['image'])
+                        self.transport.check_call(cmd, timeout=BUILD_TIMEOUT)
 
                 # patching docker-compose so it contains a VIRTUAL_HOST entry
                 # (required by nginx-proxy), we generate a random one only known
@@ -193,24 +516,86 @@ proxy_set_header Authorization "";
                 conf['environment']['VIRTUAL_HOST'] = conf['environment'].get('VIRTUAL_HOST', str(level_id))
                 print(conf.get('environment'))
 
-            # cleanup for next rebuild
-            cmd = '{0} "rm -f levels/{1}/REBUILD"'.format(self.ssh, level_id)
-            call(cmd, shell=True)
+    def _read_build(self, level_id, archive):
+        """ I return the build record of a level on the host. """
+        record = BuildRecord()
+        tarball_check = ''
+        if self.artifacts:
+            # artifacts are stored by digest
+            record.current_tarball = archive.split('/')[-1]
+        else:
+            tarball_check = 'echo "current_tarball $(sha256sum < {0} | cut -d\' \' -f1)"'.format(archive)
+        script = BUILD_CHECK_SCRIPT.format(tarball_check=tarball_check, level_id=level_id)
+        record.parse(self.transport.run_script(script, timeout=BUILD_TIMEOUT))
+        self.meta.set(level_id, images=record.current_images)
+        return record
 
-    def create_level(self, level_id, tarball):
-        """ I create a level from a tarball. """
+    def _write_build(self, level_id, tarball, record, compose, level_type):
+        """ I record the tarball, compose file and images a level was built from. """
+        project = level_id.replace('-', '')
+        images = [conf.get('image') or '{0}_{1}'.format(project, service) for service, conf in compose.iteritems()]
+        if level_type == 'unix':
+            images.append('unix-{0}'.format(level_id))
+        script = BUILD_RECORD_SCRIPT.format(level_id=level_id, source=pipes.quote(tarball), tarball=record.current_tarball,
+                                            level_type=level_type, main=compose.keys()[0], images=' '.join(images))
+        self.transport.run_script(script, timeout=COMMAND_TIMEOUT)
+
+    def _commit_unix_level(self, level_id, main):
+        """ I run a unix level once and commit it as its image. """
+        cwd = 'levels/{0}'.format(level_id)
+        # FIXME: docker ps -lq is not thread safe
+        # we should use the docker-compose feature: name
+        # DUMPED is the dump time of the level, BUILD is not rewritten by every commit
+        cmd = 'cd {0}; docker-compose run {1}; docker commit `docker ps -lq` unix-{2} && date -u +%Y-%m-%dT%H:%M:%SZ > DUMPED'.format(
+            cwd, main, str(level_id))
+        self.transport.check_call(cmd, timeout=BUILD_TIMEOUT)
+
+    def start_level(self, level_id):
+        """ I start the containers of a prepared level. """
+        logger.info('running level {0} on {1}'.format(level_id, self.host))
+        with self._phase('up', level_id):
+            cmd = 'cd levels/{0} ; docker-compose up -d'.format(level_id)
+            self.transport.check_call(cmd, timeout=BUILD_TIMEOUT)
+        self.meta.invalidate(level_id, 'containers')
+        self.meta.invalidate(level_id, 'manifest')
+
+    def prepare_level(self, level_id, tarball):
+        """ I extract and build a level without starting it, I return its build record. """
 
         # download the tarball remotely
         logger.info('downloading {0}'.format(tarball))
-        hashtar = hashlib.sha224(tarball).hexdigest()
-        cmd = '{0} "wget -nc -q {1} -O /tmp/{2}"'.format(self.ssh, tarball, hashtar)
-        call(cmd, shell=True)
+        with self._phase('download', level_id):
+            if self.artifacts:
+                archive = self.artifacts.distribute(self, tarball)
+            else:
+                archive = '/tmp/{0}'.format(hashlib.sha224(tarball).hexdigest())
+                cmd = 'wget -nc -q {0} -O {1}'.format(tarball, archive)
+                self.transport.call(cmd, timeout=BUILD_TIMEOUT)
 
-        # only extract level if source changed
-        logger.info('extracting level on {0}'.format(self.host))
-        source = 'levels/{0}/source'.format(level_id)
-        cmd = '{0} \'test -f {1} && [ $(cat {1}) = {2} ] || (mkdir -p levels/{4} ; tar -xf /tmp/{3} -C levels/{4} ; echo {2} > {1} ; touch levels/{4}/REBUILD)\''.format(self.ssh, source, tarball, hashtar, level_id)
-        check_call(cmd, shell=True)
+        # nothing changed since the last build, the images can be reused
+        record = self._read_build(level_id, archive)
+        if record.up_to_date():
+            logger.info('level {0} unchanged on {1}, reusing its images'.format(level_id, self.host))
+            if record.level_type != 'unix':
+                self.transport.check_call('echo {0} > levels/{1}/source'.format(pipes.quote(tarball), level_id), timeout=COMMAND_TIMEOUT)
+                return record
+            # a unix level is dumped by running it again, its committed image changes
+            with self._phase('build', level_id):
+                self._commit_unix_level(level_id, record.main)
+            self._write_build(level_id, tarball, record, self._get_compose(level_id), record.level_type)
+            return record
+
+        # only extract level if its tarball changed
+        imported = set()
+        if record.tarball_changed():
+            logger.info('extracting level on {0}'.format(self.host))
+            with self._phase('extract', level_id):
+                if STREAM_INGEST:
+                    imported = self._ingest(level_id, archive, record.current_tarball)
+                else:
+                    cmd = 'mkdir -p levels/{0} ; tar -xf {1} -C levels/{0}'.format(level_id, archive)
+                    self.transport.check_call(cmd, timeout=BUILD_TIMEOUT)
+                self.meta.invalidate(level_id)
 
         # preparing level image
         logger.info('preparing level image')
@@ -218,159 +603,702 @@ proxy_set_header Authorization "";
         modified = {}
         for service, conf in compose.iteritems():
             if 'image' in conf:
-                self.rebuild_if_needed(level_id, tarball, conf)
+                changed = record.tarball_changed() or record.image_missing(conf['image'])
+                self.rebuild_if_needed(level_id, tarball, conf, changed=changed, imported=conf['image'] in imported,
+                                       archive=archive)
             modified[service] = conf
         self._write_compose(level_id, modified)
 
         # building level
         logger.info('building level {0} on {1}'.format(level_id, self.host))
-        cwd = 'levels/{0}'.format(level_id)
-        cmd = '{0} "cd {1} ; docker-compose build"'.format(self.ssh, cwd)
-        check_call(cmd, shell=True)
-
-        main = compose.keys()[0]
-        section = compose.values()[0]
-        level_type = section.get('labels', {}).get('PATHWAR_LEVEL_TYPE', 'web')
-        level_type = section.get('labels', {}).get('PWR_LEVEL_TYPE', 'web')
-        if level_type == "unix":
-            # FIXME: docker ps -lq is not thread safe
-            # we should use the docker-compose feature: name
-            cmd = '{0} "cd {1}; docker-compose run {2}; docker commit \`docker ps -lq\` unix-{3}"'.format(self.ssh, cwd, main, str(level_id))
-            check_call(cmd, shell=True)
-            print("DOCKER_COMPOSE", level_type)
-        else:
-            # running level
-            logger.info('running level {0} on {1}'.format(level_id, self.host))
+        with self._phase('build', level_id):
             cwd = 'levels/{0}'.format(level_id)
-            cmd = '{0} "cd {1} ; docker-compose up -d"'.format(self.ssh, cwd)
-            check_call(cmd, shell=True)
+            cmd = 'cd {0} ; docker-compose build'.format(cwd)
+            self.transport.check_call(cmd, timeout=BUILD_TIMEOUT)
 
+            record.main = compose.keys()[0]
+            record.level_type = self._level_type_from_compose(compose)
+            if record.level_type == 'unix':
+                self._commit_unix_level(level_id, record.main)
+        self._write_build(level_id, tarball, record, compose, record.level_type)
+        return record
+
+    def _ingest(self, level_id, archive, digest):
+        """ I extract a level tarball and import its images in one pass, I return the imported images. """
+        script = INGEST_SCRIPT.format(level_id=level_id, archive=archive, member=pipes.quote(INGEST_MEMBER_CMD))
+        imported = set()
+        streamed = None
+        for line in self.transport.run_script(script, timeout=BUILD_TIMEOUT).splitlines():
+            chunks = line.split()
+            if len(chunks) == 2 and chunks[0] == 'imported':
+                imported.add(chunks[1])
+            elif len(chunks) == 2 and chunks[0] == 'digest':
+                streamed = chunks[1]
+        if digest and streamed != digest:
+            raise RuntimeError('tarball of level {0} on {1} has digest {2}, expected {3}'.format(level_id, self.host, streamed, digest))
+        return imported
+
+    def create_level(self, level_id, tarball):
+        """ I create a level from a tarball. """
+        record = self.prepare_level(level_id, tarball)
+        # unix levels only live as a committed image
+        if record.level_type != 'unix':
+            self.start_level(level_id)
+        with self._phase('manifest', level_id):
+            self.capture_manifest(level_id)
         return True
 
+    def capture_manifest(self, level_id):
+        """ I record the passphrases, version and build time of a created level in its MANIFEST, I return it.
+
+        Web levels are read from their running containers, unix levels
+        from their committed image and the time of their last commit;
+        later inspections only read the MANIFEST.
+        """
+        level_type = self.get_level_type(level_id)
+        unix_cmd = '{0}; echo; echo @@version; {1}'.format(PASSPHRASES_CMD, VERSION_CMD)
+        script = MANIFEST_SCRIPT.format(level_id=level_id, level_type=pipes.quote(level_type), unix_cmd=pipes.quote(unix_cmd),
+                                        version_cmd=pipes.quote(VERSION_CMD), passphrases_cmd=pipes.quote(PASSPHRASES_CMD))
+        sections = {'source': [], 'version': [], 'passphrases': []}
+        manifest = {'level_type': level_type, 'built_at': None, 'dumped_at': None}
+        section = None
+        for line in self.transport.run_script(script, timeout=BUILD_TIMEOUT).splitlines():
+            if line.startswith('@@'):
+                chunks = line[2:].split()
+                section = sections.get(chunks[0])
+                if chunks[0] == 'built_at' and len(chunks) > 1:
+                    manifest['built_at'] = chunks[1]
+                elif chunks[0] in ('dumped_at', 'started_at') and len(chunks) > 1 and not manifest['dumped_at']:
+                    manifest['dumped_at'] = chunks[1]
+                continue
+            if section is not None:
+                section.append(line)
+        if level_type == 'unix' and not manifest['dumped_at']:
+            # committed before its dump time was recorded
+            manifest['dumped_at'] = manifest['built_at']
+        level = Level(id=level_id, passphrases=[])
+        self._parse_passphrases(level, sections['passphrases'])
+        manifest['passphrases'] = level.passphrases
+        manifest['source'] = '\n'.join(sections['source']).strip() or None
+        manifest['version'] = next((line.strip() for line in sections['version'] if line.strip()), None)
+        self.transport.put('levels/{0}/MANIFEST'.format(level_id), json.dumps(manifest, indent=2, sort_keys=True) + '\n',
+                           timeout=COMMAND_TIMEOUT)
+        self.meta.set(level_id, manifest=manifest)
+        return manifest
+
+    def read_manifest(self, level_id):
+        """ I return the MANIFEST of a level, None if it has none. """
+        manifest = self.meta.get(level_id, 'manifest')
+        if manifest is not None:
+            return manifest
+        result = self.transport.run('cat levels/{0}/MANIFEST'.format(level_id), timeout=COMMAND_TIMEOUT)
+        if result.returncode != 0:
+            return None
+        try:
+            manifest = json.loads(result.stdout)
+        except ValueError:
+            logger.warning('invalid MANIFEST for level {0} on {1}'.format(level_id, self.host))
+            return None
+        self.meta.set(level_id, manifest=manifest)
+        return manifest
+
+    def _level_from_manifest(self, level_id, manifest):
+        level = Level(id=level_id, passphrases=list(manifest.get('passphrases') or []), address=self.ip,
+                      version=manifest.get('version'), source=manifest.get('source'))
+        level.tarball = None
+        if manifest.get('dumped_at'):
+            level.dumped_at = dateutil.parser.parse(manifest['dumped_at'])
+        return level
+
     def get_level_type(self, level_id):
+        level_type = self.meta.get(level_id, 'level_type')
+        if level_type is not None:
+            return level_type
         compose = self._get_compose(level_id)
+        return self._level_type_from_compose(compose)
+
+    def _level_type_from_compose(self, compose):
+        """ I return the level type declared in a parsed docker-compose.yml. """
+        if not compose:
+            return 'web'
         section = compose.values()[0]
         level_type = section.get('labels', {}).get('PATHWAR_LEVEL_TYPE', 'web')
         level_type = section.get('labels', {}).get('PWR_LEVEL_TYPE', 'web')
         return level_type
 
-    def inspect_level(self, level_id):
-        """ I inspect a level. """
-        level = Level()
-        level.id = level_id
+    def _parse_passphrases(self, level, lines):
+        """ I append the '<key> <value>' passphrase lines to a level. """
+        for line in lines:
+            chunks = line.split()
+            if len(chunks) == 2:
+                logger.info('found passphrase {0} for {1} on {2}'.format(chunks[0], level.id, self.host))
+                level.passphrases.append({'key': chunks[0], 'value': chunks[1]})
 
-        # fetch passphrases, uptime and version
-        level.dumped_at = None
-        level.version = None
-        level.tarball = None
-        level.passphrases = []
-        logger.info('fetching passphrases for {0} on {1}'.format(level_id, self.host))
-        level_type = self.get_level_type(level_id)
-        if level_type == "unix":
-            cmd = '{0} "docker run --entrypoint=bash --rm unix-{1} -c \'for file in /pathwar/passphrases/*; do echo -n \\"\\$(basename \\$file) \\"; cat \\$file; done\'"'.format(self.ssh, level_id)
-            for line in check_output(cmd, shell=True).splitlines():
-                chunks = line.split()
-                if len(chunks) == 2:
-                    logger.info('found passphrase {0} for {1} on {2}'.format(chunks[0], level_id, self.host))
-                    level.passphrases.append({'key': chunks[0], 'value': chunks[1]})
-                    # FIXME: set level.dumpet_at to the image build date
-                    # FIXME: set level.version
-        else:
-            cwd = 'levels/{0}'.format(level_id)
-            cmd = '{0} "cd {1} ; docker-compose ps -q"'.format(self.ssh, cwd)
-            for docker_uuid in check_output(cmd, shell=True).splitlines():
-                if not level.dumped_at:
-                    cmd = '{0} "docker inspect -f {{{{.State.StartedAt}}}} {1}"'.format(self.ssh, docker_uuid)
-                    uptime = check_output(cmd, shell=True).strip()
-                    level.dumped_at = dateutil.parser.parse(uptime)
-                    logger.info('found dumped_at {0} for {1} on {2}'.format(level.dumped_at, level_id, self.host))
-
-                if not level.version:
-                    try:
-                        # here, it is fine to fail
-                        cmd = '{0} "docker exec {1} bash -c \'grep version /pathwar/level.yml | awk \\"// {{ print \\$2; }}\\"\'"'.format(self.ssh, docker_uuid)
-                        version = check_output(cmd, shell=True).strip()
+    def probe(self):
+        """ I check that the host and its docker daemon answer. """
+        self.transport.check_call('docker info > /dev/null', timeout=COMMAND_TIMEOUT)
+
+    def run_script(self, script):
+        """ I run a shell script on the host and return its output. """
+        return self.transport.run_script(script, timeout=BUILD_TIMEOUT)
+
+    def inventory(self):
+        """ I inspect every running level of the host in one round trip. """
+        logger.info('inventorying levels on {0}'.format(self.host))
+        return self._parse_inventory(self.run_script(INVENTORY_SCRIPT))
+
+    def _parse_inventory(self, output):
+        """ I build the levels described by the output of INVENTORY_SCRIPT. """
+        entries = []
+        inspect = []
+        entry = None
+        section = None
+        for line in output.splitlines():
+            if line.startswith('@@'):
+                chunks = line[2:].split()
+                kind = chunks[0]
+                arg = chunks[1] if len(chunks) > 1 else None
+                section = None
+                if kind == 'level':
+                    entry = {'id': arg, 'compose': [], 'source': [], 'manifest': [], 'containers': [], 'versions': {}, 'passphrases': {}}
+                    entries.append(entry)
+                elif kind == 'inspect':
+                    section = inspect
+                elif entry is None:
+                    continue
+                elif kind in ('compose', 'source', 'manifest'):
+                    section = entry[kind]
+                elif kind == 'container':
+                    entry['containers'].append(arg)
+                    self.containers[arg[:12]] = entry['id']
+                elif kind == 'version':
+                    section = entry['versions'].setdefault(arg, [])
+                elif kind == 'passphrases':
+                    section = entry['passphrases'].setdefault(arg, [])
+                continue
+            if section is not None:
+                section.append(line)
+
+        started_at = {}
+        if ''.join(inspect).strip():
+            for container in json.loads('\n'.join(inspect)):
+                started_at[container['Id']] = container['State']['StartedAt']
+
+        levels = []
+        for entry in entries:
+            level = Level(id=entry['id'], passphrases=[], address=self.ip)
+            level.tarball = None
+            level.source = '\n'.join(entry['source']).strip() or None
+            compose = yaml.load('\n'.join(entry['compose']))
+            if compose:
+                self.meta.set_compose(level.id, compose, self._level_type_from_compose(compose))
+            self.meta.set(level.id, containers=entry['containers'])
+            manifest = None
+            if entry['manifest']:
+                try:
+                    manifest = json.loads('\n'.join(entry['manifest']))
+                except ValueError:
+                    logger.warning('invalid MANIFEST for level {0} on {1}'.format(level.id, self.host))
+            if manifest is not None:
+                self.meta.set(level.id, manifest=manifest)
+                level = self._level_from_manifest(level.id, manifest)
+                level.source = '\n'.join(entry['source']).strip() or level.source
+            elif self._level_type_from_compose(compose) == 'unix':
+                self._parse_passphrases(level, entry['passphrases'].get('unix-{0}'.format(level.id), []))
+            else:
+                for container in entry['containers']:
+                    if not level.dumped_at and container in started_at:
+                        level.dumped_at = dateutil.parser.parse(started_at[container])
+                    if not level.version:
+                        version = '\n'.join(entry['versions'].get(container, [])).strip()
                         if len(version):
-                            logger.info('found version {0} for {1} on {2}'.format(version, level_id, self.host))
                             level.version = version
-                    except:
-                        pass
+                    self._parse_passphrases(level, entry['passphrases'].get(container, []))
+            logger.info('found level {0} (dumped_at {1}, version {2}) on {3}'.format(level.id, level.dumped_at, level.version, self.host))
+            levels.append(level)
+        return levels
 
-                try:
-                    # here, it is fine to fail, not all containers have passphrases.
-                    # please, be careful with this line, this is really tricky (there
-                    # are several levels of inhibition mixing together).
-                    cmd = '{0} "docker exec {1} bash -c \'for file in /pathwar/passphrases/*; do echo -n \\"\\$(basename \\$file) \\"; cat \\$file; done\'"'.format(self.ssh, docker_uuid)
-                    for line in check_output(cmd, shell=True).splitlines():
-                        chunks = line.split()
-                        if len(chunks) == 2:
-                            logger.info('found passphrase {0} for {1} on {2}'.format(chunks[0], level_id, self.host))
-                            level.passphrases.append({'key': chunks[0], 'value': chunks[1]})
-                except:
-                    pass
+    def inspect_level(self, level_id):
+        """ I inspect a level. """
+        with self._phase('inspect', level_id):
+            return self._inspect_level(level_id)
 
-        try:
-            cmd = '{0} "cat levels/{1}/source"'.format(self.ssh, level_id)
-            level.source = check_output(cmd, shell=True).strip()
-        except Exception as e:
-            logger.warning("failed to find source on server {0} for level {1}".format(self.host, level_id), exc_info=True)
-            pass
+    def _inspect_level(self, level_id):
+        manifest = self.read_manifest(level_id)
+        if manifest is None:
+            # created before levels had a MANIFEST
+            logger.info('capturing the manifest of {0} on {1}'.format(level_id, self.host))
+            manifest = self.capture_manifest(level_id)
+        return self._level_from_manifest(level_id, manifest)
 
-        level.address = self.ip
 
-        return level
+class Fanout(object):
+    """ I am the outcome of an operation run on several servers. """
+    def __init__(self, name):
+        self.name = name
+        # host -> return value, host -> exception
+        self.results = {}
+        self.errors = {}
+        self.timed_out = []
+
+    def ok(self):
+        return not self.errors and not self.timed_out
+
+    def summary(self):
+        return '{0}: {1} done, {2} failed, {3} timed out'.format(self.name, len(self.results), len(self.errors), len(self.timed_out))
+
+
+def is_host_failure(error):
+    """ I tell whether an error comes from the host rather than from the level. """
+    if isinstance(error, CommandTimeout):
+        return True
+    if isinstance(error, CommandError):
+        # ssh exits with 255 when it fails to reach the host
+        return error.returncode == 255
+    return isinstance(error, (EnvironmentError, EOFError, socket.error))
+
+
+class Breaker(object):
+    """ I am the circuit breaker of a host.
+
+    After threshold host failures in a row the circuit opens and the
+    host is out of placement for cooldown seconds. Then the circuit is
+    half-open until a probe closes it, or opens it again for twice as
+    long, up to max_cooldown seconds.
+    """
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+    def __init__(self, host, threshold=3, cooldown=60, max_cooldown=3600):
+        self.host = host
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.lock = threading.Lock()
+        self.state = self.CLOSED
+        self.failures = 0
+        self.delay = cooldown
+        self.opened_at = 0
+        self.error = None
+
+    def allows(self):
+        with self.lock:
+            return self.state == self.CLOSED
+
+    def probe_due(self):
+        """ I turn an open circuit half-open once its cooldown is over, I return True if so. """
+        with self.lock:
+            if self.state != self.OPEN or time.time() < self.opened_at + self.delay:
+                return False
+            self.state = self.HALF_OPEN
+        logger.info('circuit of {0} half-open, probing'.format(self.host))
+        return True
+
+    def success(self):
+        with self.lock:
+            if self.state != self.CLOSED:
+                logger.info('circuit of {0} closed'.format(self.host))
+            self.state = self.CLOSED
+            self.failures = 0
+            self.delay = self.cooldown
+            self.error = None
+        metrics.HOST_CIRCUIT_OPEN.set(0, host=self.host)
+
+    def failure(self, error):
+        with self.lock:
+            self.failures += 1
+            self.error = str(error)
+            if self.state == self.HALF_OPEN:
+                self.delay = min(self.max_cooldown, self.delay * 2)
+            elif self.state == self.OPEN or self.failures < self.threshold:
+                return
+            self.state = self.OPEN
+            self.opened_at = time.time()
+            logger.warning('circuit of {0} open for {1}s after {2} failures: {3}'.format(self.host, self.delay, self.failures, self.error))
+        metrics.HOST_CIRCUIT_OPEN.set(1, host=self.host)
+
+    def status(self):
+        with self.lock:
+            status = {'state': self.state, 'failures': self.failures, 'error': self.error}
+            if self.state == self.OPEN:
+                status['retry_in'] = max(0, int(self.opened_at + self.delay - time.time()))
+            return status
 
 
 class DockerPool(object):
     """ I manage a pool of Docker servers. """
-    def __init__(self, server_ips):
+    def __init__(self, server_ips, host_concurrency=1, artifacts=None, scheduler=None, init_retry=60, state=None, shard=None,
+                 failure_threshold=3, cooldown=60):
+        self.artifacts = artifacts
+        self.scheduler = scheduler
+        self.state = state
+        self.shard = shard
+        self.init_retry = init_retry
         # init pool
         self.pool = []
         for server_ip in server_ips:
-            self.pool.append(DockerDriver(host=server_ip))
-        # init levels
+            server = self._make_driver(server_ip, host_concurrency)
+            server.artifacts = artifacts
+            server.breaker.threshold = failure_threshold
+            server.breaker.cooldown = server.breaker.delay = cooldown
+            self.pool.append(server)
+        # init levels, registrations are numbered so that a stale inventory leaves newer ones alone
         self.levels = {}
+        self.registered = {}
+        self.generations = itertools.count(1)
+        self.init_servers()
+
+    def _make_driver(self, server_ip, host_concurrency):
+        """ I return the driver matching a DOCKER_POOL entry.
+
+        'engine://<host>' inspects levels through the Docker Engine API,
+        anything else through the docker CLI.
+        """
+        if server_ip.startswith('engine://'):
+            from engine import EngineDockerDriver
+            return EngineDockerDriver(host=server_ip[len('engine://'):], max_operations=host_concurrency)
+        return DockerDriver(host=server_ip, max_operations=host_concurrency)
+
+    def init_server(self, server):
+        """ I initialize a server, it is healthy once done. """
+        with metrics.phase('init', server.host):
+            server._setup_nginx_proxy()
+        server.healthy = True
+
+    def init_servers(self):
+        """ I initialize every server in the background, retrying the unhealthy ones until they are up. """
+        def run():
+            pending = list(self.pool)
+            while pending:
+                outcome = self.fanout(self.init_server, timeout=BUILD_TIMEOUT, servers=pending, name='init')
+                pending = [server for server in pending if server.host not in outcome.results]
+                for server in pending:
+                    server.healthy = False
+                metrics.HOSTS_UNHEALTHY.set(len(pending))
+                if pending:
+                    logger.warning('{0} unhealthy, retrying in {1}s'.format(', '.join(server.host for server in pending), self.init_retry))
+                    time.sleep(self.init_retry)
+        thread = threading.Thread(target=run, name='init-servers')
+        thread.daemon = True
+        thread.start()
+
+    def unhealthy(self):
+        return [server for server in self.pool if server.healthy is False or not server.breaker.allows()]
+
+    def circuits(self):
+        return dict((server.host, server.breaker.status()) for server in self.pool)
+
+    @contextlib.contextmanager
+    def guarded(self, server):
+        """ I report the outcome of an operation on a server to its circuit breaker. """
+        try:
+            yield
+        except Exception as e:
+            if is_host_failure(e):
+                server.breaker.failure(e)
+            else:
+                # the host answered, the level failed
+                server.breaker.success()
+            raise
+        server.breaker.success()
+
+    def probe(self, server):
+        """ I probe a server with a half-open circuit in the background. """
+        def run():
+            try:
+                server.probe()
+            except Exception as e:
+                logger.warning('probing {0} failed'.format(server.host), exc_info=True)
+                server.breaker.failure(e)
+            else:
+                server.breaker.success()
+        thread = threading.Thread(target=run, name='probe-{0}'.format(server.host))
+        thread.daemon = True
+        thread.start()
+
+    def fanout(self, fn, timeout=None, servers=None, name='fanout'):
+        """ I run fn(server) on every server in parallel, I return a Fanout.
+
+        Servers which did not return within timeout seconds are reported as
+        timed out, their operation keeps running in the background.
+        """
+        outcome = Fanout(name)
+        lock = threading.Lock()
+
+        def run(server):
+            try:
+                result = fn(server)
+            except Exception as e:
+                logger.warning('{0} failed on {1}'.format(name, server.host), exc_info=True)
+                with lock:
+                    if server.host not in outcome.timed_out:
+                        outcome.errors[server.host] = e
+            else:
+                with lock:
+                    if server.host not in outcome.timed_out:
+                        outcome.results[server.host] = result
+
+        threads = []
+        for server in (self.pool if servers is None else servers):
+            thread = threading.Thread(target=run, args=(server,), name='{0}-{1}'.format(name, server.host))
+            thread.daemon = True
+            thread.start()
+            threads.append((server, thread))
+        deadline = time.time() + timeout if timeout else None
+        for server, thread in threads:
+            thread.join(max(0, deadline - time.time()) if deadline else None)
+            with lock:
+                if thread.is_alive():
+                    logger.warning('{0} timed out on {1}'.format(name, server.host))
+                    outcome.timed_out.append(server.host)
+        logger.info(outcome.summary())
+        return outcome
 
     def load(self):
-        for server in self.pool:
-            for level_id in server.get_running_level_ids():
-                level = server.inspect_level(level_id)
-                self.levels[level_id] = (level, server)
+        """ I inventory the levels running on every server in parallel. """
+        started_at = time.time()
+        self.fanout(self.load_server, timeout=BUILD_TIMEOUT, name='inventory')
+        logger.info('loaded {0} levels from {1} servers in {2:.1f}s'.format(len(self.levels), len(self.pool), time.time() - started_at))
+
+    def load_server(self, server):
+        """ I replace what I know about a server by its inventory. """
+        since = self.generation()
+        with self.guarded(server), metrics.phase('inventory', server.host):
+            levels = server.inventory()
+        self.apply_inventory(server, levels, since)
+
+    def generation(self):
+        """ I return a new generation, levels registered after it are newer than an inventory started now. """
+        return next(self.generations)
+
+    def apply_inventory(self, server, levels, since=None):
+        """ I replace what I know about a server by the levels it runs.
+
+        Levels registered or forgotten after generation since are left alone,
+        the inventory started before them and may not have seen the change.
+        """
+        def stale(level_id):
+            return since is not None and self.registered.get(level_id, 0) > since
+        found = set(level.id for level in levels)
+        for level_id, (_, owner) in self.levels.items():
+            if owner is server and level_id not in found and not stale(level_id):
+                logger.info('level {0} vanished from {1}'.format(level_id, server.host))
+                self.levels.pop(level_id, None)
+        for level in levels:
+            if not stale(level.id):
+                self.levels[level.id] = (level, server)
+        if self.state:
+            owned = [level for level, owner in self.levels.values() if owner is server]
+            try:
+                self.state.replace_host(server.host, [(level, server.meta.peek(level.id, 'level_type')) for level in owned])
+            except Exception:
+                logger.warning('failed to record the levels of {0}'.format(server.host), exc_info=True)
+
+    def _register(self, level_id, level, server):
+        """ I record which server runs a level, in the state store too. """
+        self.registered[level_id] = self.generation()
+        self.levels[level_id] = (level, server)
+        if self.state:
+            try:
+                self.state.save(level, server.host, server.meta.peek(level_id, 'level_type'))
+            except Exception:
+                logger.warning('failed to record level {0}'.format(level_id), exc_info=True)
+
+    def _unregister(self, level_id):
+        """ I forget a level, I return the (level, server) running it if known. """
+        self.registered[level_id] = self.generation()
+        entry = self.levels.pop(level_id, None)
+        if self.state:
+            try:
+                self.state.delete(level_id)
+            except Exception:
+                logger.warning('failed to forget level {0}'.format(level_id), exc_info=True)
+        return entry
+
+    def forget(self, level_id, server):
+        """ I forget a level removed from a server behind my back. """
+        if self.levels.get(level_id, (None, None))[1] is server:
+            self._unregister(level_id)
+
+    def restore(self):
+        """ I register the levels of the state store, I return how many.
+
+        Levels of servers which left the pool are ignored, load() verifies
+        the others against the servers.
+        """
+        servers = dict((server.host, server) for server in self.pool)
+        count = 0
+        for entry in self.state.levels():
+            server = servers.get(entry['host'])
+            if not server or entry['id'] in self.levels:
+                continue
+            dumped_at = dateutil.parser.parse(entry['dumped_at']) if entry['dumped_at'] else None
+            level = Level(id=entry['id'], passphrases=entry['passphrases'], address=server.ip, dumped_at=dumped_at,
+                          version=entry['version'], source=entry['source'], running=entry['running'])
+            if entry['level_type']:
+                server.meta.set(level.id, level_type=entry['level_type'])
+            self.levels[level.id] = (level, server)
+            count += 1
+        logger.info('restored {0} levels from {1}'.format(count, self.state.path))
+        return count
 
-    def _pick_server(self):
+    def apply_event(self, server, action, level_id):
+        """ I update a level from a docker event, I return True if it changed. """
+        if level_id not in self.levels:
+            return False
+        level, owner = self.levels[level_id]
+        if owner is not server:
+            return False
+        running = action == 'start'
+        if level.running == running:
+            return False
+        logger.info('level {0} on {1}: container {2}'.format(level_id, server.host, action))
+        level.running = running
+        self._register(level_id, level, server)
+        return True
+
+    def _pick_server(self, level_id=None, tarball=None, exclude=()):
         """ Allocation of levels on servers. """
-        return self.pool[int(random.random() * len(self.pool))]
+        for server in self.pool:
+            if server.breaker.probe_due():
+                self.probe(server)
+        exclude = tuple(exclude) + tuple(self.unhealthy())
+        if self.shard:
+            # a shard places its levels on its own servers when it has some
+            foreign = tuple(server for server in self.pool if not self.shard.owns(server.host))
+            if len(foreign) < len(self.pool):
+                exclude += foreign
+        if self.scheduler:
+            return self.scheduler.pick(self.pool, self.levels, level_id=level_id, tarball=tarball, exclude=exclude)
+        candidates = [server for server in self.pool if server not in exclude]
+        if candidates:
+            return candidates[int(random.random() * len(candidates))]
 
     def destroy_blindly(self, level_instance_id):
-        """ I blindly kill a level running on the pool of servers. """
-        for server in self.pool:
-            server.destroy_level(level_instance_id)
-            if level_instance_id in self.levels:
-                del self.levels[level_instance_id]
+        """ I blindly kill a level on every server of the pool at once.
+
+        Servers without the level have nothing to destroy, only a failure
+        of the server owning it is raised. Servers with an open circuit
+        are skipped unless they own the level.
+        """
+        def destroy(server):
+            with self.guarded(server), server.slots:
+                server.destroy_level(level_instance_id)
+
+        owner = (self._unregister(level_instance_id) or (None, None))[1]
+        servers = [server for server in self.pool if server is owner or server.breaker.allows()]
+        outcome = self.fanout(destroy, timeout=BUILD_TIMEOUT, servers=servers, name='destroy {0}'.format(level_instance_id))
+        if owner and owner.host in outcome.errors:
+            raise outcome.errors[owner.host]
+        if owner and owner.host in outcome.timed_out:
+            raise RuntimeError('destroying level {0} on {1} timed out'.format(level_instance_id, owner.host))
+        return outcome
 
     def destroy_level(self, level_id):
         """ I kill a level running on the pool of servers. """
         if level_id in self.levels:
             _, server = self.levels[level_id]
-            server.destroy_level(level_id)
-            del self.levels[level_id]
+            with self.guarded(server), server.slots:
+                server.destroy_level(level_id)
+            self._unregister(level_id)
+
+    def meta_stats(self):
+        """ I sum the metadata cache counters of the servers. """
+        totals = {}
+        for server in self.pool:
+            with server.meta.lock:
+                for key, value in server.meta.stats.items():
+                    totals[key] = totals.get(key, 0) + value
+        return totals
+
+    def meta_summary(self):
+        return ', '.join('{0}={1}'.format(key, value) for key, value in sorted(self.meta_stats().items()))
 
     def get_level(self, level_id):
         if level_id in self.levels:
             level, _ = self.levels[level_id]
             return level
 
+    def _create_on(self, server, level_id, tarball):
+        """ I create a level on a picked server and return it, without registering it. """
+        try:
+            with self.guarded(server), server.slots:
+                if not server.create_level(level_id, tarball):
+                    return
+                return server.inspect_level(level_id)
+        finally:
+            if self.scheduler:
+                self.scheduler.release(server, level_id)
+
     def create_level(self, level_id, tarball):
         """ I randomly create a level on a Docker server. """
-        server = self._pick_server()
+        if self.artifacts:
+            # known digests let the scheduler favor hosts having the tarball
+            self.artifacts.fetch(tarball)
+        server = self._pick_server(level_id=level_id, tarball=tarball)
+        if server:
+            level = self._create_on(server, level_id, tarball)
+            if level:
+                self._register(level_id, level, server)
+            return level
+
+    def replace_level(self, level_id, tarball, server=None):
+        """ I create a level on another server while its current instance keeps running.
+
+        I return the new level and the (level, server) it replaces, which
+        must be retired once the API points at the new instance.
+        """
+        previous = self.levels.get(level_id)
+        exclude = [previous[1]] if previous else []
+        if self.artifacts:
+            self.artifacts.fetch(tarball)
+        if server is None or server in exclude:
+            server = self._pick_server(level_id=level_id, tarball=tarball, exclude=exclude)
+        elif self.scheduler:
+            # spares are placed beforehand, they still count as pending
+            self.scheduler.pick([server], self.levels, level_id=level_id, tarball=tarball)
+        if not server:
+            return None, previous
+        level = self._create_on(server, level_id, tarball)
+        if level:
+            self._register(level_id, level, server)
+        return level, previous
+
+    def restore_level(self, level_id, previous):
+        """ I destroy the replacement of a level and register its previous instance again. """
+        if level_id in self.levels:
+            _, server = self.levels[level_id]
+            with self.guarded(server), server.slots:
+                server.destroy_level(level_id)
+        if previous:
+            self._register(level_id, *previous)
+        else:
+            self._unregister(level_id)
+
+    def retire_level(self, level_id, server):
+        """ I destroy the previous instance of a replaced level. """
+        with self.guarded(server), server.slots:
+            server.destroy_level(level_id)
+
+    def prepare_level(self, level_id, tarball, exclude=()):
+        """ I build a level on a server without starting it, I return the server. """
+        if self.artifacts:
+            self.artifacts.fetch(tarball)
+        server = self._pick_server(level_id=level_id, tarball=tarball, exclude=exclude)
         if server:
-            if server.create_level(level_id, tarball):
-                level = server.inspect_level(level_id)
-                self.levels[level_id] = (level, server)
-                return level
+            try:
+                with self.guarded(server), server.slots:
+                    server.prepare_level(level_id, tarball)
+            finally:
+                if self.scheduler:
+                    self.scheduler.release(server, level_id)
+        return server
 
     def get_level_type(self, level_id):
         """ I get the level type. """
-        server = self._pick_server()
+        if level_id in self.levels:
+            _, server = self.levels[level_id]
+        else:
+            known = [server for server in self.pool if server.meta.knows(level_id)]
+            server = known[0] if known else random.choice(self.pool)
         if server:
             return server.get_level_type(level_id)
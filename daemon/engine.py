@@ -0,0 +1,297 @@
+import dateutil.parser
+import io
+import json
+import logging
+import socket
+import subprocess
+import tarfile
+import threading
+import time
+
+import requests
+
+from docker import DockerDriver, Level, COMMAND_TIMEOUT, project_to_level_id
+
+
+logger = logging.getLogger('hypervisor')
+
+
+# docker-compose labels every container with its project, which is the level
+# id without dashes.
+PROJECT_LABEL = 'com.docker.compose.project'
+SERVICE_LABEL = 'com.docker.compose.service'
+NUMBER_LABEL = 'com.docker.compose.container-number'
+
+# seconds to wait for a ssh tunnel to accept connections
+TUNNEL_TIMEOUT = 15
+
+
+class EngineError(Exception):
+    pass
+
+
+class SSHTunnel(object):
+    """ I forward a local port to the docker socket of a host over ssh. """
+    def __init__(self, host, socket_path='/var/run/docker.sock'):
+        self.host = host
+        self.socket_path = socket_path
+        self.process = None
+        self.port = None
+        self.lock = threading.Lock()
+
+    def _free_port(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        return port
+
+    def url(self):
+        """ I return the URL of the tunnelled engine, (re)opening it if needed. """
+        with self.lock:
+            if self.process is None or self.process.poll() is not None:
+                self._open()
+            return 'http://127.0.0.1:{0}'.format(self.port)
+
+    def _open(self):
+        self.port = self._free_port()
+        # the tunnel owns its connection, it must not go through a ControlMaster
+        argv = ['ssh', '-N', '-o', 'ExitOnForwardFailure=yes', '-o', 'ControlPath=none',
+                '-o', 'UserKnownHostsFile=/dev/null', '-o', 'StrictHostKeyChecking=no',
+                '-L', '127.0.0.1:{0}:{1}'.format(self.port, self.socket_path), self.host]
+        logger.info('opening docker engine tunnel to {0} on port {1}'.format(self.host, self.port))
+        self.process = subprocess.Popen(argv)
+        deadline = time.time() + TUNNEL_TIMEOUT
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                break
+            try:
+                socket.create_connection(('127.0.0.1', self.port), 1).close()
+                return
+            except socket.error:
+                time.sleep(0.2)
+        self.close()
+        raise EngineError('failed to open docker engine tunnel to {0}'.format(self.host))
+
+    def close(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+        self.process = None
+
+
+class EngineClient(object):
+    """ I talk JSON to a Docker Engine API. """
+    def __init__(self, url):
+        # url is either a base URL or a callable returning one
+        self.url = url
+        self.session = requests.Session()
+
+    def _request(self, method, path, **kwargs):
+        url = self.url() if callable(self.url) else self.url
+        kwargs.setdefault('timeout', COMMAND_TIMEOUT)
+        r = self.session.request(method, '{0}{1}'.format(url, path), **kwargs)
+        if r.status_code >= 400:
+            raise EngineError('{0} {1} returned {2}: {3}'.format(method, path, r.status_code, r.text.strip()))
+        return r
+
+    def containers(self, all=False, filters=None):
+        params = {'all': int(all)}
+        if filters:
+            params['filters'] = json.dumps(filters)
+        return self._request('GET', '/containers/json', params=params).json()
+
+    def inspect(self, container):
+        return self._request('GET', '/containers/{0}/json'.format(container)).json()
+
+    def events(self, filters):
+        """ I yield the decoded events of the engine as they happen. """
+        r = self._request('GET', '/events', params={'filters': json.dumps(filters)}, stream=True, timeout=None)
+        # every event is written as one JSON document followed by a newline
+        for line in r.iter_lines(chunk_size=1):
+            if line.strip():
+                yield json.loads(line)
+
+    def inspect_many(self, containers):
+        return [self.inspect(container) for container in containers]
+
+    def create(self, image, **config):
+        config['Image'] = image
+        return self._request('POST', '/containers/create', data=json.dumps(config),
+                             headers={'Content-Type': 'application/json'}).json()['Id']
+
+    def remove(self, container):
+        self._request('DELETE', '/containers/{0}'.format(container), params={'v': 1, 'force': 1})
+
+    def get_archive(self, container, path):
+        """ I return {basename: content} for the files below a path in a container. """
+        try:
+            r = self._request('GET', '/containers/{0}/archive'.format(container), params={'path': path})
+        except EngineError:
+            # engines older than 1.8 only have the copy endpoint
+            r = self._request('POST', '/containers/{0}/copy'.format(container), data=json.dumps({'Resource': path}),
+                              headers={'Content-Type': 'application/json'})
+        files = {}
+        archive = tarfile.open(fileobj=io.BytesIO(r.content))
+        for member in archive.getmembers():
+            if member.isfile():
+                files[member.name.split('/')[-1]] = archive.extractfile(member).read()
+        return files
+
+
+class EngineDockerDriver(DockerDriver):
+    """ I manage a Docker server through its Engine API.
+
+    Inspection goes through a tunnelled docker socket, builds and
+    docker-compose operations still go through the transport.
+    """
+    def __init__(self, host=None, max_operations=1, transport=None, engine_url=None):
+        DockerDriver.__init__(self, host=host, max_operations=max_operations, transport=transport)
+        if engine_url:
+            self.tunnel = None
+            self.engine = EngineClient(engine_url)
+        else:
+            self.tunnel = SSHTunnel(host)
+            self.engine = EngineClient(self.tunnel.url)
+
+    def _level_containers(self, all=False):
+        """ I return the level containers of the host grouped by level id. """
+        levels = {}
+        for container in self.engine.containers(all=all, filters={'label': [PROJECT_LABEL]}):
+            level_id = project_to_level_id(container.get('Labels', {}).get(PROJECT_LABEL, ''))
+            if level_id:
+                levels.setdefault(level_id, []).append(container)
+                self.containers[container['Id'][:12]] = level_id
+        for containers in levels.values():
+            containers.sort(key=lambda c: (c['Labels'].get(SERVICE_LABEL), int(c['Labels'].get(NUMBER_LABEL) or 0)))
+        return levels
+
+    def get_running_level_ids(self):
+        """ I return the list of IDs of running levels on the host. """
+        return set(self._level_containers().keys())
+
+    def watch_events(self):
+        """ I yield (action, level_id) for the start, die and destroy events of level containers. """
+        for event in self.engine.events({'event': ['start', 'die', 'destroy']}):
+            action = event.get('status')
+            container = event.get('id', '')[:12]
+            if action not in ('start', 'die', 'destroy') or not container:
+                continue
+            labels = event.get('Actor', {}).get('Attributes', {})
+            level_id = project_to_level_id(labels.get(PROJECT_LABEL, ''))
+            if not level_id and action != 'destroy' and container not in self.containers:
+                # engines older than 1.10 do not send the container labels
+                try:
+                    details = self.engine.inspect(container)
+                    level_id = project_to_level_id((details['Config'].get('Labels') or {}).get(PROJECT_LABEL, ''))
+                except EngineError:
+                    pass
+            if level_id:
+                self.containers[container] = level_id
+            level_id = self.containers.get(container)
+            if action == 'destroy':
+                self.containers.pop(container, None)
+            if level_id:
+                yield action, level_id
+
+    def _read_sources(self, level_ids):
+        """ I return {level_id: source} in a single round trip. """
+        if not level_ids:
+            return {}
+        cmd = 'for id in {0}; do echo "$id $(cat levels/$id/source 2>/dev/null)"; done'.format(' '.join(level_ids))
+        sources = {}
+        for line in self.transport.check_output(cmd, timeout=COMMAND_TIMEOUT).splitlines():
+            chunks = line.split()
+            if len(chunks) == 2:
+                sources[chunks[0]] = chunks[1]
+        return sources
+
+    def _read_manifests(self, level_ids):
+        """ I return {level_id: manifest} of the levels having a MANIFEST, in a single round trip. """
+        if not level_ids:
+            return {}
+        cmd = 'for id in {0}; do test -f levels/$id/MANIFEST && echo "@@$id" && cat levels/$id/MANIFEST; done; exit 0'.format(' '.join(level_ids))
+        sections = {}
+        section = None
+        for line in self.transport.check_output(cmd, timeout=COMMAND_TIMEOUT).splitlines():
+            if line.startswith('@@'):
+                section = sections.setdefault(line[2:].strip(), [])
+            elif section is not None:
+                section.append(line)
+        manifests = {}
+        for level_id, lines in sections.items():
+            try:
+                manifests[level_id] = json.loads('\n'.join(lines))
+            except ValueError:
+                logger.warning('invalid MANIFEST for level {0} on {1}'.format(level_id, self.host))
+                continue
+            self.meta.set(level_id, manifest=manifests[level_id])
+        return manifests
+
+    def _read_passphrases(self, level, container):
+        try:
+            files = self.engine.get_archive(container, '/pathwar/passphrases')
+        except EngineError:
+            # not all containers have passphrases
+            return
+        self._parse_passphrases(level, ['{0} {1}'.format(name, content.strip()) for name, content in sorted(files.items())])
+
+    def _read_version(self, container):
+        try:
+            files = self.engine.get_archive(container, '/pathwar/level.yml')
+        except EngineError:
+            return None
+        for line in files.get('level.yml', '').splitlines():
+            chunks = line.split()
+            if 'version' in line and len(chunks) > 1:
+                return chunks[1]
+
+    def _inspect(self, level_id, containers, source):
+        level = Level(id=level_id, passphrases=[], address=self.ip, source=source)
+        level.tarball = None
+        # docker-compose copies the service labels on its containers
+        if containers:
+            level_type = containers[0].get('Labels', {}).get('PWR_LEVEL_TYPE', 'web')
+        else:
+            level_type = self.get_level_type(level_id)
+        if level_type == 'unix':
+            # read the committed image without starting it
+            container = self.engine.create('unix-{0}'.format(level_id), Entrypoint=['true'])
+            try:
+                self._read_passphrases(level, container)
+            finally:
+                self.engine.remove(container)
+            return level
+
+        for details in self.engine.inspect_many([container['Id'] for container in containers]):
+            if not level.dumped_at:
+                level.dumped_at = dateutil.parser.parse(details['State']['StartedAt'])
+            if not level.version:
+                level.version = self._read_version(details['Id'])
+            self._read_passphrases(level, details['Id'])
+        return level
+
+    def _inspect_level(self, level_id):
+        manifest = self.read_manifest(level_id)
+        if manifest is not None:
+            return self._level_from_manifest(level_id, manifest)
+        logger.info('fetching passphrases for {0} on {1}'.format(level_id, self.host))
+        containers = self._level_containers(all=True).get(level_id, [])
+        return self._inspect(level_id, containers, self._read_sources([level_id]).get(level_id))
+
+    def inventory(self):
+        """ I inspect every running level of the host through the engine. """
+        logger.info('inventorying levels on {0}'.format(self.host))
+        running = self._level_containers()
+        sources = self._read_sources(sorted(running.keys()))
+        manifests = self._read_manifests(sorted(running.keys()))
+        levels = []
+        for level_id, containers in running.items():
+            if level_id in manifests:
+                level = self._level_from_manifest(level_id, manifests[level_id])
+                level.source = sources.get(level_id) or level.source
+            else:
+                level = self._inspect(level_id, containers, sources.get(level_id))
+            logger.info('found level {0} (dumped_at {1}, version {2}) on {3}'.format(level.id, level.dumped_at, level.version, self.host))
+            levels.append(level)
+        return levels
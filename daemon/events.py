@@ -0,0 +1,44 @@
+import logging
+import threading
+import time
+
+
+logger = logging.getLogger('hypervisor')
+
+
+class EventWatcher(threading.Thread):
+    """ I follow the docker events of a server and keep the pool in sync. """
+    def __init__(self, pool, server, on_change, retry=10):
+        threading.Thread.__init__(self, name='events-{0}'.format(server.host))
+        self.daemon = True
+        self.pool = pool
+        self.server = server
+        self.on_change = on_change
+        self.retry = retry
+
+    def run(self):
+        resync = False
+        while True:
+            try:
+                if resync:
+                    # events may have been missed while disconnected
+                    self.pool.load_server(self.server)
+                logger.info('watching docker events on {0}'.format(self.server.host))
+                for action, level_id in self.server.watch_events():
+                    if self.pool.apply_event(self.server, action, level_id):
+                        self.on_change(level_id)
+                logger.warning('docker events stream of {0} ended'.format(self.server.host))
+            except Exception:
+                logger.warning('failed to watch docker events on {0}'.format(self.server.host), exc_info=True)
+            resync = True
+            time.sleep(self.retry)
+
+
+def watch_pool(pool, on_change):
+    """ I start an event watcher for every server of a pool. """
+    watchers = []
+    for server in pool.pool:
+        watcher = EventWatcher(pool, server, on_change)
+        watcher.start()
+        watchers.append(watcher)
+    return watchers
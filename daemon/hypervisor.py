@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 import argparse
+import calendar
 import requests
 import json
 import logging.config
@@ -12,12 +13,24 @@ import os.path
 import raven
 import re
 import shutil
+import socket
 import sys
+import threading
 import time
 import yaml
 
+import metrics
 from datetime import timedelta, datetime
+from api import ApiClient, ApiError, UpdateWriter
+from artifacts import ArtifactCache
+from collector import GarbageCollector
 from docker import DockerPool
+from events import watch_pool
+from placement import Scheduler
+from reconciler import CHECK, CREATE, FORCE, IDLE, REDUMP, Backoff, Reconciler
+from shard import HashRing, LeaseStore, Shard
+from state import StateStore
+from warm import WarmPool
 from raven.handlers.logging import SentryHandler
 from raven.conf import setup_logging
 
@@ -31,19 +44,137 @@ DOCKER_POOL = os.environ['DOCKER_POOL'].split(',')
 REFRESH_RATE = int(os.environ['REFRESH_RATE'])
 HTTP_LEVEL_PORT = int(os.environ['HTTP_LEVEL_PORT'])
 SENTRY_URL = os.environ['SENTRY_URL']
+RECONCILE_WORKERS = int(os.environ.get('RECONCILE_WORKERS') or 1)
+HOST_CONCURRENCY = int(os.environ.get('HOST_CONCURRENCY') or 1)
+WATCH_EVENTS = bool(int(os.environ.get('WATCH_EVENTS') or 0))
+SWEEP_RATE = int(os.environ.get('SWEEP_RATE') or 3600)
+ARTIFACT_CACHE = os.environ.get('ARTIFACT_CACHE') or ''
+ARTIFACT_CACHE_SIZE = int(os.environ.get('ARTIFACT_CACHE_SIZE') or 10240)
+HOST_CACHE_SIZE = int(os.environ.get('HOST_CACHE_SIZE') or 10240)
+PLACEMENT = os.environ.get('PLACEMENT') or 'least-loaded'
+MAX_LEVELS_PER_HOST = int(os.environ.get('MAX_LEVELS_PER_HOST') or 0)
+STATS_RATE = int(os.environ.get('STATS_RATE') or 300)
+BLUE_GREEN = bool(int(os.environ.get('BLUE_GREEN') or 0))
+WARM_REDUMP = int(os.environ.get('WARM_REDUMP') or 0)
+API_FULL_SYNC_RATE = int(os.environ.get('API_FULL_SYNC_RATE') or 600)
+API_PAGE_SIZE = int(os.environ.get('API_PAGE_SIZE') or 0)
+API_WRITERS = int(os.environ.get('API_WRITERS') or 4)
+CONTROL_PORT = int(os.environ.get('CONTROL_PORT') or 0)
+METRICS_PORT = int(os.environ.get('METRICS_PORT') or 0)
+HOST_INIT_RETRY = int(os.environ.get('HOST_INIT_RETRY') or 60)
+STATE_PATH = os.environ.get('STATE_PATH') or ''
+SHARD_STORE = os.environ.get('SHARD_STORE') or ''
+SHARD_NAME = os.environ.get('SHARD_NAME') or '{0}-{1}'.format(socket.gethostname(), os.getpid())
+SHARD_LEASE = int(os.environ.get('SHARD_LEASE') or 30)
+LEVEL_BACKOFF = int(os.environ.get('LEVEL_BACKOFF') or 60)
+LEVEL_BACKOFF_MAX = int(os.environ.get('LEVEL_BACKOFF_MAX') or 3600)
+HOST_FAILURES = int(os.environ.get('HOST_FAILURES') or 3)
+HOST_COOLDOWN = int(os.environ.get('HOST_COOLDOWN') or 60)
+GC_INTERVAL = int(os.environ.get('GC_INTERVAL') or 0)
+GC_RETENTION = int(os.environ.get('GC_RETENTION') or 86400)
+GC_RATE = int(os.environ.get('GC_RATE') or 30)
 
 class Hypervisor(object):
-    def __init__(self):
+    def __init__(self, join=True):
+        """ I join the shards of SHARD_STORE unless join is False, one-shot actions take no lease. """
         logger.info('starting the hypervisor')
-        self.pool = DockerPool(DOCKER_POOL)
+        self.api = ApiClient(API_ENDPOINT, full_sync_interval=API_FULL_SYNC_RATE, page_size=API_PAGE_SIZE,
+                             pool_size=API_WRITERS + 2)
+        self.writer = UpdateWriter(self.api, workers=API_WRITERS)
+        self.artifacts = None
+        if ARTIFACT_CACHE:
+            self.artifacts = ArtifactCache(ARTIFACT_CACHE, max_size=ARTIFACT_CACHE_SIZE * 1024 ** 2,
+                                           remote_max_size=HOST_CACHE_SIZE * 1024 ** 2)
+        self.scheduler = Scheduler(PLACEMENT, max_levels=MAX_LEVELS_PER_HOST, artifacts=self.artifacts,
+                                   stats_interval=STATS_RATE)
+        self.state = StateStore(STATE_PATH) if STATE_PATH else None
+        # the pool is inventoried again when the shards are rebalanced
+        self.rebalanced = False
+        self.shard = None
+        if SHARD_STORE and join:
+            self.shard = Shard(LeaseStore(SHARD_STORE), SHARD_NAME, ttl=SHARD_LEASE, on_rebalance=self.on_rebalance)
+        self.pool = DockerPool(DOCKER_POOL, host_concurrency=HOST_CONCURRENCY, artifacts=self.artifacts,
+                               scheduler=self.scheduler, init_retry=HOST_INIT_RETRY, state=self.state, shard=self.shard,
+                               failure_threshold=HOST_FAILURES, cooldown=HOST_COOLDOWN)
+        self.warm = None
+        if BLUE_GREEN and WARM_REDUMP:
+            self.warm = WarmPool(self.pool, max_redump=WARM_REDUMP)
+        self.collector = GarbageCollector(self.pool, retention=GC_RETENTION, rate=GC_RATE)
+        self.backoff = Backoff(LEVEL_BACKOFF, LEVEL_BACKOFF_MAX)
+        self.reconciler = Reconciler(self.manage_level, workers=RECONCILE_WORKERS, classify=self.classify, backoff=self.backoff,
+                                     lookup=lambda level_id: self.catalog.get(level_id))
+        metrics.REGISTRY.expose('hypervisor_api', 'API client counter.', lambda: dict(self.api.stats))
+        metrics.REGISTRY.expose('hypervisor_api_updates', 'API update writer counter.', lambda: dict(self.writer.stats))
+        metrics.REGISTRY.expose('hypervisor_level_metadata', 'Level metadata cache counter.', self.pool.meta_stats)
+        metrics.REGISTRY.expose('hypervisor_gc', 'Garbage collector counter.', lambda: dict(self.collector.stats))
+        if self.artifacts:
+            metrics.REGISTRY.expose('hypervisor_artifacts', 'Artifact cache counter.', lambda: dict(self.artifacts.stats))
+        # last known level instances of the API, by id
+        self.catalog = {}
+        # level ids to redump whether they are due or not
+        self.forced = set()
+        self.swept_at = time.time()
 
     def load(self):
+        self.rebalanced = False
         self.pool.load()
+        self.swept_at = time.time()
+
+    def on_rebalance(self):
+        # levels taken over were created by other processes since the last inventory
+        self.rebalanced = True
+
+    def owns(self, level_id):
+        """ I tell whether a level instance belongs to the shard of this process. """
+        return not self.shard or self.shard.owns(level_id)
+
+    def start(self):
+        """ I load the levels of the pool, from the state store when it knows some.
+
+        Restored levels are verified against the servers in the background.
+        """
+        if self.state and self.pool.restore():
+            thread = threading.Thread(target=self.load, name='verify-state')
+            thread.daemon = True
+            thread.start()
+        else:
+            self.load()
+
+    def on_level_event(self, level_id):
+        """ I reconcile a level right away when docker events changed it. """
+        if level_id in self.catalog and self.owns(level_id):
+            logger.info('waking up reconciler for level {0}'.format(level_id))
+            api_level_instance = self.catalog[level_id]
+            self.reconciler.submit(api_level_instance, *self.classify(api_level_instance))
+
+    def classify(self, api_level_instance):
+        """ I return the priority class of a level instance and the deadline of its next redump. """
+        level_id = api_level_instance['_id']
+        api_level = api_level_instance['level']
+        if 'url' not in api_level or not api_level_instance['active'] or not self.owns(level_id):
+            return IDLE, None
+        if level_id in self.forced:
+            return FORCE, time.time()
+        level = self.pool.get_level(level_id)
+        if not level:
+            return CREATE, None
+        if not level.dumped_at:
+            return CHECK, None
+        deadline = calendar.timegm(level.dumped_at.utctimetuple()) + api_level['defaults']['redump']
+        if level.source != api_level['url'] or not level.running or deadline <= time.time():
+            return REDUMP, deadline
+        return IDLE, deadline
 
     def manage_level(self, api_level_instance):
         """ I manage a level instance, create it, redump if needed, ... """
         level_id = api_level_instance['_id']
         api_level = api_level_instance['level']
+        forced = level_id in self.forced
+        self.forced.discard(level_id)
+
+        if not self.owns(level_id):
+            logger.debug('level {0} belongs to another shard'.format(level_id))
+            return
 
         # ignore level if incomplete
         if 'url' not in api_level or not api_level_instance['active']:
@@ -57,6 +188,7 @@ class Hypervisor(object):
             logger.info('creating level {0}'.format(level_id))
             level = self.pool.create_level(level_id, api_level['url'])
             self.api_update_level_instance(api_level_instance, level)
+            self.warm_level(api_level_instance)
             return
 
         # refresh/redump level if needed
@@ -64,17 +196,71 @@ class Hypervisor(object):
         level_redump = api_level['defaults']['redump']
         level_next_redump = level.dumped_at + timedelta(seconds=level_redump)
         level_need_redump = level_next_redump < datetime.now(level_next_redump.tzinfo)
-        if level_changed or level_need_redump:
+        if forced or level_changed or level_need_redump or not level.running:
             logger.info('redumping level {0}'.format(level_id))
+            if BLUE_GREEN and len(self.pool.pool) > 1:
+                self.replace_level(api_level_instance)
+            else:
+                self.pool.destroy_level(level_id)
+                self.pool.create_level(level_id, api_level['url'])
+                level = self.pool.get_level(level_id)
+                self.api_update_level_instance(api_level_instance, level)
+            self.warm_level(api_level_instance)
+            return
+
+    def replace_level(self, api_level_instance):
+        """ I redump a level on another server before tearing down its current instance. """
+        level_id = api_level_instance['_id']
+        tarball = api_level_instance['level']['url']
+        spare = self.warm.take(level_id, tarball) if self.warm else None
+        level, previous = self.pool.replace_level(level_id, tarball, server=spare)
+        if not level:
+            logger.warning('no server to replace level {0}, redumping it in place'.format(level_id))
             self.pool.destroy_level(level_id)
-            self.pool.create_level(level_id, api_level['url'])
-            level = self.pool.get_level(level_id)
+            level = self.pool.create_level(level_id, tarball)
             self.api_update_level_instance(api_level_instance, level)
             return
 
+        # players keep using the previous instance until the API points at the new one
+        try:
+            switched = self.api_update_level_instance(api_level_instance, level, wait=True)
+        except Exception:
+            logger.warning('failed to switch level {0} to its new instance, rolling back'.format(level_id))
+            self.pool.restore_level(level_id, previous)
+            raise
+        if not switched:
+            logger.warning('failed to switch level {0} to its new instance, rolling back'.format(level_id))
+            self.pool.restore_level(level_id, previous)
+            return
+        if previous:
+            previous_level, previous_server = previous
+            logger.info('retiring level {0} on {1}'.format(level_id, previous_server.host))
+            self.pool.retire_level(level_id, previous_server)
+            if self.warm and self.warm.wants(api_level_instance['level']):
+                # the retired server keeps the images of the level
+                self.warm.keep(level_id, previous_server, previous_level.source)
+
+    def warm_level(self, api_level_instance):
+        """ I make sure a frequently redumped level has a spare ready. """
+        if not self.warm or not self.warm.wants(api_level_instance['level']):
+            return
+        try:
+            self.warm.warm(api_level_instance['_id'], api_level_instance['level']['url'])
+        except Exception:
+            logger.warning('failed to prepare a spare of level {0}'.format(api_level_instance['_id']), exc_info=True)
+
+    def request_redump(self, level_id):
+        """ I make the reconciler redump a level instance of the catalog ahead of the others. """
+        if level_id not in self.catalog:
+            raise RuntimeError('level-instance {} not found'.format(level_id))
+        if not self.owns(level_id):
+            raise RuntimeError('level-instance {} belongs to another shard'.format(level_id))
+        self.forced.add(level_id)
+        self.reconciler.submit(self.catalog[level_id], FORCE, time.time())
+
     def force_redump(self, uuid):
         """ Used to force the redump of a level. """
-        for api_level_instance in self.api_fetch_level_instances():
+        for api_level_instance in self.api.level_instances():
             if api_level_instance['_id'] == uuid:
                 level_id = api_level_instance['_id']
                 api_level = api_level_instance['level']
@@ -85,35 +271,119 @@ class Hypervisor(object):
                     return
 
                 logger.info('redumping level {0}'.format(level_id))
-                self.pool.destroy_blindly(level_id)
+                if self.state and not self.pool.levels:
+                    # run from the command line
+                    self.pool.restore()
+                if self.pool.get_level(level_id):
+                    # the state store knows its server
+                    self.pool.destroy_level(level_id)
+                else:
+                    self.pool.destroy_blindly(level_id)
                 self.pool.create_level(level_id, api_level['url'])
                 level = self.pool.get_level(level_id)
-                self.api_update_level_instance(api_level_instance, level)
+                self.api_update_level_instance(api_level_instance, level, wait=True)
 
                 return
 
         raise RuntimeError('level-instance {} not found'.format(uuid))
 
+    def collect_garbage(self, dry_run=False, servers=None):
+        """ I remove what the level instances of the API do not need from the servers, I return the orphans.
+
+        Spares are kept for the levels which deserve one. Unless servers
+        are given, only the servers of this shard are collected in sharded
+        mode.
+        """
+        if not self.api.full_synced_at:
+            for _ in self.api_fetch_level_instances():
+                pass
+        if not self.api.full_synced_at:
+            raise RuntimeError('the catalog is incomplete, refusing to collect garbage')
+        active = set()
+        protected = set()
+        for level_id, api_level_instance in self.catalog.items():
+            if api_level_instance['active']:
+                active.add(level_id)
+                if self.warm and self.warm.wants(api_level_instance['level']):
+                    protected.add(level_id)
+        if servers is None:
+            servers = [server for server in self.pool.pool if not self.shard or self.shard.owns(server.host)]
+        orphans = self.collector.collect(active, protected, servers=servers, dry_run=dry_run)
+        logger.info('garbage collector: {0} orphans, {1}'.format(len(orphans), self.collector.summary()))
+        return orphans
+
+    def watch_garbage(self):
+        """ I collect the garbage every GC_INTERVAL seconds in the background. """
+        def run():
+            while True:
+                time.sleep(GC_INTERVAL)
+                try:
+                    self.collect_garbage()
+                except Exception:
+                    logger.warning('failed to collect garbage', exc_info=True)
+        thread = threading.Thread(target=run, name='gc')
+        thread.daemon = True
+        thread.start()
+
     def loop(self):
         """ I'm the main loop of the hypervisor. """
+        if METRICS_PORT:
+            metrics.serve(METRICS_PORT, status=self.status)
+        if GC_INTERVAL:
+            self.watch_garbage()
+        if WATCH_EVENTS:
+            watch_pool(self.pool, self.on_level_event)
+        self.scheduler.watch(self.pool)
         while True:
             logger.info('wake-up Neo')
-            for api_level_instance in self.api_fetch_level_instances():
-                try:
-                    self.manage_level(api_level_instance)
-                except Exception as e:
-                    logger.warning('had a problem while managing level {0}: {1}'.format(api_level_instance['_id'], str(e)), exc_info=True)
+            self.cycle()
             time.sleep(REFRESH_RATE)
 
-    def api_update_level_instance(self, api_level_instance, level):
-        """ I update the state of a level on the API. """
+    def status(self):
+        """ I return the state of the hypervisor, as shown by the status action. """
+        return {
+            'levels': len(self.pool.levels),
+            'catalog': len(self.catalog),
+            'shard': self.shard.name if self.shard else None,
+            'circuits': self.pool.circuits(),
+            'backoff': self.backoff.status(),
+        }
+
+    def cycle(self):
+        """ I reconcile every level instance of the API once, I return the reconciler stats. """
+        if WATCH_EVENTS and time.time() - self.swept_at >= SWEEP_RATE:
+            # events keep the pool up to date, this only catches drift
+            logger.info('sweeping docker hosts')
+            self.load()
+        elif self.rebalanced:
+            logger.info('shards rebalanced, inventorying docker hosts')
+            self.load()
+        stats = None
+        try:
+            stats = self.reconciler.run_cycle(self.api_fetch_level_instances())
+        except (ApiError, requests.RequestException):
+            logger.warning('failed to sync level instances with the API', exc_info=True)
+        logger.info('API: {0}, {1}'.format(self.api.summary(), self.writer.summary()))
+        logger.info('level metadata cache: {0}'.format(self.pool.meta_summary()))
+        if self.artifacts:
+            logger.info('artifact cache: {0}'.format(self.artifacts.summary()))
+        unhealthy = self.pool.unhealthy()
+        if unhealthy:
+            logger.info('out of placement: {0}'.format(', '.join(server.host for server in unhealthy)))
+        return stats
+
+    def api_update_level_instance(self, api_level_instance, level, wait=False):
+        """ I update the state of a level on the API.
+
+        The update is queued unless wait is set, then I return True once
+        the API applied it.
+        """
         level_id = api_level_instance['_id']
         logger.info('patching API for {0}'.format(level_id))
-        patch_url = '{0}/raw-level-instances/{1}'.format(API_ENDPOINT, level_id)
         response = dict()
 
         if level is None:
-            return
+            return False
 
         # patch level URL
 
@@ -139,34 +409,34 @@ class Hypervisor(object):
         # extract passphrases
         response['passphrases'] = level.passphrases
 
-        headers = {
-            'If-Match': api_level_instance['_etag'],
-            'Content-Type': 'application/json',
-        }
-
-        r = requests.patch(patch_url, data=json.dumps(response), headers=headers, verify=False)
-
-    def api_fetch_level_instances(self, resource=None):
-        """ I fetch level instances from the API. """
-        if not resource:
-            resource = 'hypervisor-level-instances?embedded={"level":1}'
-        url = '{0}/{1}'.format(API_ENDPOINT, resource)
-        r = requests.get(url, verify=False)
-        if r.status_code == 200:
-            level_instances = []
-            content = r.json()
-            if '_items' in content:
-                for item in content['_items']:
-                    level_instances.append(item)
-            if '_links' in content:
-                try:
-                    if 'next' in content['_links']:
-                        next_resource = '{0}&embedded={{"level":1}}'.format(content['_links']['next']['href'])
-                        level_instances.extend(self.api_fetch_level_instances(resource=next_resource))
-                except:
-                    pass
-            return level_instances
-        return []
+        resource = 'raw-level-instances/{0}'.format(level_id)
+        if wait:
+            return self.writer.send(resource, api_level_instance, response)
+        self.writer.submit(resource, api_level_instance, response)
+        return True
+
+    def api_fetch_level_instances(self):
+        """ I yield every level instance, refreshing the catalog with the API on the way.
+
+        Between full syncs only the updated level instances come from the
+        API, the others from the catalog. Level instances of other shards
+        are kept in the catalog but not yielded.
+        """
+        full = self.api.full_sync_due()
+        seen = set()
+        for api_level_instance in self.api.level_instances(full=full):
+            self.catalog[api_level_instance['_id']] = api_level_instance
+            seen.add(api_level_instance['_id'])
+            if self.owns(api_level_instance['_id']):
+                yield api_level_instance
+        for level_id, api_level_instance in self.catalog.items():
+            if level_id in seen:
+                continue
+            if full:
+                # gone from the API
+                del self.catalog[level_id]
+            elif self.owns(level_id):
+                yield api_level_instance
 
 
 if __name__ == '__main__':
@@ -212,17 +482,52 @@ if __name__ == '__main__':
         logging.config.dictConfig(LOGGING)
 
     parser = argparse.ArgumentParser('Pathwar\'s hypervisor')
-    parser.add_argument('action', type=str, choices=['loop', 'force-redump'], default='loop', help='action to perform')
+    parser.add_argument('action', type=str, choices=['loop', 'async-loop', 'force-redump', 'status', 'gc'], default='loop', help='action to perform')
     parser.add_argument('--uuid', type=str, help='uuid of the level instance to manipulate')
+    parser.add_argument('--dry-run', action='store_true', help='only report what gc would remove')
+    parser.add_argument('--shard', type=str, help='only collect the hosts this member of SHARD_STORE owns (gc)')
     args = parser.parse_args()
 
     if args.action == 'loop':
         h = Hypervisor()
-        h.load()
+        h.start()
         h.loop()
+    elif args.action == 'async-loop':
+        # trollius is only needed by this loop
+        from aio import AsyncHypervisor
+        h = Hypervisor()
+        if GC_INTERVAL:
+            h.watch_garbage()
+        AsyncHypervisor(h, workers=RECONCILE_WORKERS, refresh_rate=REFRESH_RATE, sweep_rate=SWEEP_RATE,
+                        watch_events=WATCH_EVENTS, control_port=CONTROL_PORT).run_forever()
     elif args.action == 'force-redump':
         instance_uuid = args.uuid
         if not instance_uuid:
             raise RuntimeError('bad usage: missing instance uuid')
-        h = Hypervisor()
+        h = Hypervisor(join=False)
         h.force_redump(instance_uuid)
+    elif args.action == 'status':
+        # asks the running hypervisor, through its control or metrics endpoint
+        port = CONTROL_PORT or METRICS_PORT
+        if not port:
+            raise RuntimeError('bad usage: neither CONTROL_PORT nor METRICS_PORT is set')
+        response = requests.get('http://127.0.0.1:{0}/status'.format(port), timeout=10)
+        response.raise_for_status()
+        print(json.dumps(response.json(), indent=2, sort_keys=True))
+    elif args.action == 'gc':
+        h = Hypervisor(join=False)
+        servers = None
+        if args.shard:
+            # the ring of the running processes, read without joining it
+            if not SHARD_STORE:
+                raise RuntimeError('bad usage: --shard needs SHARD_STORE')
+            members = LeaseStore(SHARD_STORE).members()
+            if args.shard not in members:
+                raise RuntimeError('shard {0} holds no lease, members: {1}'.format(args.shard, ', '.join(members) or 'none'))
+            ring = HashRing(members)
+            servers = [server for server in h.pool.pool if ring.owner(server.host) == args.shard]
+        h.load()
+        orphans = h.collect_garbage(dry_run=args.dry_run, servers=servers)
+        for orphan in orphans:
+            print('{0} {1}'.format(orphan, {None: '', True: 'removed', False: 'FAILED'}[orphan.removed]))
+        print('{0} orphans, {1:.1f}M of tarballs'.format(len(orphans), sum(orphan.size or 0 for orphan in orphans) / 1024. ** 2))
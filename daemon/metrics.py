@@ -0,0 +1,244 @@
+import BaseHTTPServer
+import contextlib
+import json
+import logging
+import SocketServer
+import threading
+import time
+
+
+logger = logging.getLogger('hypervisor')
+
+
+# seconds, from a quick ssh command to a long build
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for name, value in pairs) + '}'
+
+
+class Metric(object):
+    """ I am a family of samples sharing a name, keyed by label values. """
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(labels.get(name, '') for name in self.labels)
+
+    def render(self):
+        lines = ['# HELP {0} {1}'.format(self.name, self.help), '# TYPE {0} {1}'.format(self.name, self.kind)]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append('{0}{1} {2}'.format(self.name, _format_labels(self.labels, key), value))
+        return lines
+
+
+class Counter(Metric):
+    """ I only go up. """
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """ I go up and down. """
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    """ I count observations in cumulative buckets. """
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        Metric.__init__(self, name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            if key not in self.values:
+                # bucket counts, sum, count
+                self.values[key] = [[0] * len(self.buckets), 0., 0]
+            sample = self.values[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    sample[0][i] += 1
+            sample[1] += value
+            sample[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        started_at = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - started_at, **labels)
+
+    def render(self):
+        lines = ['# HELP {0} {1}'.format(self.name, self.help), '# TYPE {0} histogram'.format(self.name)]
+        with self.lock:
+            for key, (counts, total, count) in sorted(self.values.items()):
+                for bound, bucket in zip(self.buckets, counts):
+                    lines.append('{0}_bucket{1} {2}'.format(self.name, _format_labels(self.labels, key, [('le', bound)]), bucket))
+                lines.append('{0}_bucket{1} {2}'.format(self.name, _format_labels(self.labels, key, [('le', '+Inf')]), count))
+                lines.append('{0}_sum{1} {2}'.format(self.name, _format_labels(self.labels, key), total))
+                lines.append('{0}_count{1} {2}'.format(self.name, _format_labels(self.labels, key), count))
+        return lines
+
+
+class Registry(object):
+    """ I hold the metrics of the daemon and render them in the Prometheus text format. """
+    def __init__(self):
+        self.metrics = {}
+        # name -> (help, callable returning {stat: value})
+        self.collectors = {}
+        self.lock = threading.Lock()
+
+    def _get(self, cls, name, help, **kwargs):
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = cls(name, help, **kwargs)
+            return self.metrics[name]
+
+    def counter(self, name, help, labels=()):
+        return self._get(Counter, name, help, labels=labels)
+
+    def gauge(self, name, help, labels=()):
+        return self._get(Gauge, name, help, labels=labels)
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, help, labels=labels, buckets=buckets)
+
+    def expose(self, prefix, help, stats):
+        """ I render every value of a stats dict, as returned by a callable, as {prefix}_{key}. """
+        with self.lock:
+            self.collectors[prefix] = (help, stats)
+
+    def render(self):
+        lines = []
+        with self.lock:
+            metrics = sorted(self.metrics.items())
+            collectors = sorted(self.collectors.items())
+        for _, metric in metrics:
+            lines.extend(metric.render())
+        for prefix, (help, stats) in collectors:
+            try:
+                values = stats()
+            except Exception:
+                logger.warning('failed to collect {0} metrics'.format(prefix), exc_info=True)
+                continue
+            for key, value in sorted(values.items()):
+                if isinstance(value, (int, long, float)):
+                    lines.append('# HELP {0}_{1} {2}'.format(prefix, key, help))
+                    lines.append('{0}_{1} {2}'.format(prefix, key, value))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+PHASE_SECONDS = REGISTRY.histogram('hypervisor_phase_duration_seconds', 'Duration of level lifecycle phases.',
+                                   labels=('phase', 'host', 'level_type'))
+PHASES_IN_PROGRESS = REGISTRY.gauge('hypervisor_phases_in_progress', 'Level lifecycle phases running.',
+                                    labels=('phase', 'host'))
+PHASE_FAILURES = REGISTRY.counter('hypervisor_phase_failures_total', 'Level lifecycle phases which raised.',
+                                  labels=('phase', 'host'))
+COMMANDS = REGISTRY.counter('hypervisor_commands_total', 'Commands run on docker hosts.', labels=('host',))
+COMMAND_BYTES = REGISTRY.counter('hypervisor_command_bytes_total', 'Bytes sent to and received from docker hosts.',
+                                 labels=('host', 'direction'))
+CYCLE_SECONDS = REGISTRY.histogram('hypervisor_cycle_duration_seconds', 'Duration of reconciliation cycles.')
+LEVELS_MANAGED = REGISTRY.counter('hypervisor_levels_managed_total', 'Level instances managed, by result.',
+                                  labels=('result',))
+LEVELS_IN_PROGRESS = REGISTRY.gauge('hypervisor_levels_in_progress', 'Level instances being managed.')
+HOSTS_UNHEALTHY = REGISTRY.gauge('hypervisor_hosts_unhealthy', 'Docker hosts which failed to be initialized.')
+REDUMP_TIMERS = REGISTRY.gauge('hypervisor_redump_timers', 'Level instances waiting for their redump deadline.')
+SHARD_MEMBERS = REGISTRY.gauge('hypervisor_shard_members', 'Hypervisor processes sharing the level instances.')
+LEVELS_BACKING_OFF = REGISTRY.gauge('hypervisor_levels_backing_off', 'Level instances delayed after failing.')
+HOST_CIRCUIT_OPEN = REGISTRY.gauge('hypervisor_host_circuit_open', 'Docker hosts taken out of placement after failing, 1 when open.',
+                                   labels=('host',))
+REDUMP_DELAY = REGISTRY.histogram('hypervisor_redump_delay_seconds', 'Delay between the deadline of a level instance and its management.',
+                                  labels=('priority',))
+
+
+@contextlib.contextmanager
+def phase(name, host, level_type=None):
+    """ I time a lifecycle phase of a level on a host. """
+    PHASES_IN_PROGRESS.inc(phase=name, host=host)
+    started_at = time.time()
+    try:
+        yield
+    except Exception:
+        PHASE_FAILURES.inc(phase=name, host=host)
+        raise
+    finally:
+        PHASES_IN_PROGRESS.dec(phase=name, host=host)
+        PHASE_SECONDS.observe(time.time() - started_at, phase=name, host=host, level_type=level_type or 'unknown')
+
+
+def count_commands(host, commands, results):
+    """ I count the commands run on a host and the bytes they moved. """
+    COMMANDS.inc(len(commands), host=host)
+    sent = sum(len(command.stdin or '') + len(command.cmd) for command in commands)
+    received = sum(len(result.stdout or '') + len(result.stderr or '') for result in results)
+    COMMAND_BYTES.inc(sent, host=host, direction='sent')
+    COMMAND_BYTES.inc(received, host=host, direction='received')
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path == '/metrics':
+            body, content_type = REGISTRY.render(), 'text/plain; version=0.0.4'
+        elif path == '/status' and self.server.status:
+            body, content_type = json.dumps(self.server.status()), 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug('metrics: ' + format % args)
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def serve(port, address='0.0.0.0', status=None):
+    """ I serve /metrics on a port from a background thread, and /status if given a callable returning it. """
+    server = _Server((address, port), _Handler)
+    server.status = status
+    thread = threading.Thread(target=server.serve_forever, name='metrics')
+    thread.daemon = True
+    thread.start()
+    logger.info('serving metrics on port {0}'.format(port))
+    return server
@@ -0,0 +1,190 @@
+import logging
+import random
+import threading
+import time
+
+
+logger = logging.getLogger('hypervisor')
+
+
+# collects the capacity and load of a host, and what it already has cached
+STATS_SCRIPT = r'''
+echo cpus $(nproc)
+echo load $(cut -d' ' -f1 /proc/loadavg)
+awk '/^MemTotal:/ {{print "mem_total", $2}} /^MemFree:/ {{print "mem_free", $2}} /^MemAvailable:/ {{print "mem_available", $2}}' /proc/meminfo
+echo level_dirs $(ls levels 2>/dev/null)
+echo artifacts $(ls {artifacts} 2>/dev/null | grep -v '\.part$')
+'''
+
+
+class HostStats(object):
+    """ I am what the scheduler knows about a docker host. """
+    def __init__(self, server):
+        self.server = server
+        self.cpus = 1
+        self.load = 0.
+        self.mem_total = 0
+        self.mem_available = 0
+        # levels running on the host, and placements not yet running
+        self.levels = 0
+        self.pending = 0
+        # levels extracted on the host, and tarball digests it has cached
+        self.level_dirs = set()
+        self.artifacts = set()
+        self.updated_at = None
+
+    def parse(self, output):
+        values = {}
+        for line in output.splitlines():
+            chunks = line.split()
+            if chunks:
+                values[chunks[0]] = chunks[1:]
+        self.cpus = int(values.get('cpus', [1])[0])
+        self.load = float(values.get('load', [0])[0])
+        self.mem_total = int(values.get('mem_total', [0])[0])
+        self.mem_available = int(values.get('mem_available', values.get('mem_free', [0]))[0])
+        self.level_dirs = set(values.get('level_dirs', []))
+        self.artifacts = set(values.get('artifacts', []))
+        self.updated_at = time.time()
+
+    def assigned(self):
+        return self.levels + self.pending
+
+    def density(self):
+        """ I return the number of levels per cpu. """
+        return float(self.assigned()) / max(self.cpus, 1)
+
+    def utilization(self):
+        """ I return the highest of the cpu and memory usage ratios. """
+        cpu = self.load / max(self.cpus, 1)
+        mem = 1 - float(self.mem_available) / self.mem_total if self.mem_total else 0.
+        return max(cpu, mem)
+
+
+class Placement(object):
+    """ I am a level to place. """
+    def __init__(self, level_id=None, digest=None):
+        self.level_id = level_id
+        self.digest = digest
+
+
+class RandomStrategy(object):
+    """ I place levels on random hosts. """
+    def choose(self, candidates, placement):
+        return random.choice(candidates)
+
+
+class LeastLoadedStrategy(object):
+    """ I place levels on the host running the fewest levels per cpu. """
+    def choose(self, candidates, placement):
+        return min(candidates, key=lambda stats: (stats.density(), stats.utilization()))
+
+
+class BinPackingStrategy(object):
+    """ I fill the busiest hosts first, keeping the others free for big levels. """
+    def __init__(self, max_utilization=0.8):
+        self.max_utilization = max_utilization
+
+    def choose(self, candidates, placement):
+        room = [stats for stats in candidates if stats.utilization() < self.max_utilization]
+        if not room:
+            return LeastLoadedStrategy().choose(candidates, placement)
+        return max(room, key=lambda stats: (stats.density(), -stats.utilization()))
+
+
+class CacheAffinityStrategy(object):
+    """ I prefer hosts which already extracted the level or cached its tarball. """
+    def choose(self, candidates, placement):
+        def affinity(stats):
+            if placement.level_id in stats.level_dirs:
+                return 2
+            if placement.digest and placement.digest in stats.artifacts:
+                return 1
+            return 0
+        return min(candidates, key=lambda stats: (-affinity(stats), stats.density(), stats.utilization()))
+
+
+STRATEGIES = {
+    'random': RandomStrategy,
+    'least-loaded': LeastLoadedStrategy,
+    'bin-packing': BinPackingStrategy,
+    'cache-affinity': CacheAffinityStrategy,
+}
+
+
+class Scheduler(object):
+    """ I choose the docker host of new levels. """
+    def __init__(self, strategy='least-loaded', max_levels=0, artifacts=None, stats_interval=300):
+        self.strategy = STRATEGIES[strategy]() if isinstance(strategy, basestring) else strategy
+        self.max_levels = max_levels
+        self.artifacts = artifacts
+        self.stats_interval = stats_interval
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def _stats(self, server):
+        if server.host not in self.stats:
+            self.stats[server.host] = HostStats(server)
+        return self.stats[server.host]
+
+    def stats_script(self):
+        remote_root = self.artifacts.remote_root if self.artifacts else '.hypervisor-cache'
+        return STATS_SCRIPT.format(artifacts=remote_root)
+
+    def refresh(self, server):
+        """ I collect the stats of a host. """
+        self.update(server, server.transport.run_script(self.stats_script(), timeout=60))
+
+    def update(self, server, output):
+        """ I update the stats of a host from the output of STATS_SCRIPT. """
+        with self.lock:
+            self._stats(server).parse(output)
+
+    def watch(self, pool):
+        """ I refresh the stats of every host of a pool in the background. """
+        def run():
+            while True:
+                for server in pool.pool:
+                    try:
+                        self.refresh(server)
+                    except Exception:
+                        logger.warning('failed to collect stats of {0}'.format(server.host), exc_info=True)
+                time.sleep(self.stats_interval)
+        thread = threading.Thread(target=run, name='placement-stats')
+        thread.daemon = True
+        thread.start()
+
+    def pick(self, servers, levels, level_id=None, tarball=None, exclude=()):
+        """ I return the server a level should be created on, None if all are full. """
+        digest = None
+        if self.artifacts and tarball in self.artifacts.index:
+            digest = self.artifacts.index[tarball]['digest']
+        placement = Placement(level_id=level_id, digest=digest)
+        with self.lock:
+            counts = {}
+            for _, server in levels.values():
+                counts[server.host] = counts.get(server.host, 0) + 1
+            candidates = []
+            for server in servers:
+                if server in exclude:
+                    continue
+                stats = self._stats(server)
+                stats.levels = counts.get(server.host, 0)
+                if self.max_levels and stats.assigned() >= self.max_levels:
+                    continue
+                candidates.append(stats)
+            if not candidates:
+                logger.warning('no docker host has room for level {0}'.format(level_id))
+                return None
+            chosen = self.strategy.choose(candidates, placement)
+            chosen.pending += 1
+            logger.info('placing level {0} on {1} ({2} levels, utilization {3:.2f})'.format(
+                level_id, chosen.server.host, chosen.assigned(), chosen.utilization()))
+            return chosen.server
+
+    def release(self, server, level_id):
+        """ I forget a placement once the level runs, or failed to. """
+        with self.lock:
+            stats = self._stats(server)
+            stats.pending = max(0, stats.pending - 1)
+            stats.level_dirs.add(level_id)
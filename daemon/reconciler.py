@@ -0,0 +1,307 @@
+import heapq
+import itertools
+import logging
+import Queue
+import threading
+import time
+
+import metrics
+
+
+logger = logging.getLogger('hypervisor')
+
+
+# priority classes, the lowest is managed first
+FORCE, CREATE, REDUMP, CHECK, IDLE = range(5)
+PRIORITIES = {FORCE: 'force', CREATE: 'create', REDUMP: 'redump', CHECK: 'check', IDLE: 'idle'}
+
+
+class Backoff(object):
+    """ I delay the next attempt of failing level instances exponentially.
+
+    The first failure delays a level instance by base seconds, every
+    other one doubles the delay up to cap seconds; a success resets it.
+    """
+    def __init__(self, base=60, cap=3600):
+        self.base = base
+        self.cap = cap
+        self.lock = threading.Lock()
+        # level id -> (failures, retry_at, error)
+        self.levels = {}
+
+    def failed(self, level_id, error):
+        """ I record a failure of a level instance, I return when to retry it. """
+        with self.lock:
+            failures = self.levels.get(level_id, (0,))[0] + 1
+            retry_at = time.time() + min(self.cap, self.base * 2 ** (failures - 1))
+            self.levels[level_id] = (failures, retry_at, str(error))
+            metrics.LEVELS_BACKING_OFF.set(len(self.levels))
+        return retry_at
+
+    def succeeded(self, level_id):
+        with self.lock:
+            if self.levels.pop(level_id, None):
+                metrics.LEVELS_BACKING_OFF.set(len(self.levels))
+
+    def retry_at(self, level_id):
+        """ I return when a level instance may be retried, None if it may be right away. """
+        with self.lock:
+            entry = self.levels.get(level_id)
+        if entry and entry[1] > time.time():
+            return entry[1]
+
+    def status(self):
+        now = time.time()
+        with self.lock:
+            return dict((level_id, {'failures': failures, 'retry_in': max(0, int(retry_at - now)), 'error': error})
+                        for level_id, (failures, retry_at, error) in self.levels.items())
+
+
+class Reconciler(object):
+    """ I dispatch level instances to a bounded pool of workers.
+
+    Level instances are queued by priority class, then by deadline. When
+    given, classify(api_level_instance) returns both: IDLE level instances
+    are not queued, their redump is only scheduled at their deadline.
+    A level instance still due once managed is retried after retry seconds,
+    a failing one once its backoff is over unless it is forced. When given,
+    lookup(level_id) returns the current level instance when its timer
+    fires, the timer is dropped if there is none anymore.
+    """
+    def __init__(self, manage, workers=1, classify=None, retry=60, backoff=None, lookup=None):
+        self.manage = manage
+        self.workers = max(1, workers)
+        self.classify = classify
+        self.lookup = lookup
+        self.retry = retry
+        self.backoff = backoff
+        self.queue = Queue.PriorityQueue()
+        self.lock = threading.Lock()
+        # level ids queued or being managed, never twice at once
+        self.inflight = set()
+        # level id -> entry waiting in the queue, a better one replaces it
+        self.queued = {}
+        self.counter = itertools.count()
+        # level id -> (deadline, api_level_instance), and the heap of the deadlines
+        self.timers = {}
+        self.deadlines = []
+        self.timers_changed = threading.Condition(self.lock)
+        # level ids someone waits for
+        self.waiting = set()
+        self.done = threading.Condition(self.lock)
+        self.stats = {}
+        self._reset_stats()
+        for i in range(self.workers):
+            worker = threading.Thread(target=self._work, name='reconciler-{0}'.format(i))
+            worker.daemon = True
+            worker.start()
+        thread = threading.Thread(target=self._wake, name='reconciler-timers')
+        thread.daemon = True
+        thread.start()
+
+    def _reset_stats(self):
+        with self.lock:
+            self.stats = {
+                'started_at': time.time(),
+                'duration': 0.,
+                'submitted': 0,
+                'skipped': 0,
+                'failed': 0,
+                'idle': 0,
+                'backoff': 0,
+                'queue_peak': 0,
+            }
+
+    def submit(self, api_level_instance, priority=CHECK, deadline=None):
+        """ I enqueue a level instance unless it is already in flight.
+
+        A level instance waiting in the queue is moved up if submitted
+        again with a better priority. A level instance backing off is
+        scheduled at the end of its backoff instead, unless forced.
+        """
+        level_id = api_level_instance['_id']
+        retry_at = self.backoff.retry_at(level_id) if self.backoff and priority != FORCE else None
+        if retry_at:
+            logger.debug('level {0} backing off, retried in {1:.0f}s'.format(level_id, retry_at - time.time()))
+            with self.lock:
+                self.stats['backoff'] += 1
+            metrics.LEVELS_MANAGED.inc(result='backoff')
+            self.schedule(api_level_instance, retry_at)
+            return False
+        entry = (priority, deadline or 0, next(self.counter), api_level_instance)
+        with self.lock:
+            if level_id in self.inflight:
+                queued = self.queued.get(level_id)
+                if not queued or queued[:2] <= entry[:2]:
+                    logger.debug('level {0} already in flight, skipped'.format(level_id))
+                    self.stats['skipped'] += 1
+                    metrics.LEVELS_MANAGED.inc(result='skipped')
+                    return False
+                logger.debug('level {0} moved up to {1}'.format(level_id, PRIORITIES[priority]))
+            else:
+                self.inflight.add(level_id)
+                self.stats['submitted'] += 1
+            self.queued[level_id] = entry
+        self.queue.put(entry)
+        with self.lock:
+            self.stats['queue_peak'] = max(self.stats['queue_peak'], self.queue.qsize())
+        return True
+
+    def schedule(self, api_level_instance, deadline):
+        """ I submit a level instance for a redump at its deadline, replacing its previous one. """
+        level_id = api_level_instance['_id']
+        with self.lock:
+            previous = self.timers.get(level_id)
+            self.timers[level_id] = (deadline, api_level_instance)
+            if previous and previous[0] == deadline:
+                return
+            heapq.heappush(self.deadlines, (deadline, level_id))
+            metrics.REDUMP_TIMERS.set(len(self.timers))
+            self.timers_changed.notify()
+
+    def cancel(self, level_id):
+        """ I drop the timer of a level instance, if any. """
+        with self.lock:
+            if self.timers.pop(level_id, None):
+                metrics.REDUMP_TIMERS.set(len(self.timers))
+
+    def _wake(self):
+        while True:
+            with self.lock:
+                while True:
+                    if not self.deadlines:
+                        self.timers_changed.wait()
+                        continue
+                    deadline, level_id = self.deadlines[0]
+                    if self.timers.get(level_id, (None,))[0] != deadline:
+                        # replaced or already fired
+                        heapq.heappop(self.deadlines)
+                        continue
+                    if deadline > time.time():
+                        self.timers_changed.wait(deadline - time.time())
+                        continue
+                    heapq.heappop(self.deadlines)
+                    _, api_level_instance = self.timers.pop(level_id)
+                    metrics.REDUMP_TIMERS.set(len(self.timers))
+                    break
+            if self.lookup:
+                # the level instance may have changed since it was scheduled
+                api_level_instance = self.lookup(level_id)
+                if api_level_instance is None:
+                    logger.debug('level {0} is gone, its timer is dropped'.format(level_id))
+                    continue
+            priority = REDUMP
+            if self.classify:
+                try:
+                    priority, _ = self.classify(api_level_instance)
+                except Exception:
+                    logger.warning('failed to classify level {0}'.format(level_id), exc_info=True)
+                if priority == IDLE:
+                    # deactivated, or redumped by someone else in the meantime
+                    self._reschedule(api_level_instance)
+                    continue
+            logger.info('level {0} is due for a redump'.format(level_id))
+            self.submit(api_level_instance, priority, deadline)
+
+    def _work(self):
+        while True:
+            entry = self.queue.get()
+            priority, deadline, _, api_level_instance = entry
+            level_id = api_level_instance['_id']
+            with self.lock:
+                stale = self.queued.get(level_id) is not entry
+                if not stale:
+                    del self.queued[level_id]
+            if stale:
+                # moved up, the better entry is managed instead
+                self.queue.task_done()
+                continue
+            if deadline:
+                metrics.REDUMP_DELAY.observe(max(0., time.time() - deadline), priority=PRIORITIES[priority])
+            metrics.LEVELS_IN_PROGRESS.inc()
+            try:
+                self.manage(api_level_instance)
+                metrics.LEVELS_MANAGED.inc(result='ok')
+                if self.backoff:
+                    self.backoff.succeeded(level_id)
+            except Exception as e:
+                logger.warning('had a problem while managing level {0}: {1}'.format(level_id, str(e)), exc_info=True)
+                metrics.LEVELS_MANAGED.inc(result='failed')
+                with self.lock:
+                    self.stats['failed'] += 1
+                if self.backoff:
+                    self.backoff.failed(level_id, e)
+            finally:
+                metrics.LEVELS_IN_PROGRESS.dec()
+                with self.lock:
+                    self.inflight.discard(level_id)
+                self._reschedule(api_level_instance)
+                with self.lock:
+                    if level_id not in self.inflight:
+                        self.waiting.discard(level_id)
+                        self.done.notify_all()
+                self.queue.task_done()
+
+    def _reschedule(self, api_level_instance):
+        """ I schedule the next redump of a level instance once managed. """
+        if not self.classify:
+            return
+        try:
+            priority, deadline = self.classify(api_level_instance)
+        except Exception:
+            logger.warning('failed to schedule level {0}'.format(api_level_instance['_id']), exc_info=True)
+            return
+        retry_at = self.backoff.retry_at(api_level_instance['_id']) if self.backoff else None
+        if priority == FORCE:
+            # forced while being managed
+            self.submit(api_level_instance, priority, deadline)
+        elif retry_at and priority != IDLE:
+            self.schedule(api_level_instance, retry_at)
+        elif deadline:
+            # still due, the level instance failed to be redumped
+            if deadline <= time.time():
+                deadline = time.time() + self.retry
+            self.schedule(api_level_instance, deadline)
+
+    def wait(self, level_ids):
+        """ I wait until none of the level ids is queued or being managed. """
+        level_ids = set(level_ids)
+        with self.lock:
+            self.waiting.update(level_ids & self.inflight)
+            while self.waiting & level_ids:
+                self.done.wait()
+
+    def run_cycle(self, api_level_instances):
+        """ I manage every level instance which needs it and wait until all of them are done. """
+        self._reset_stats()
+        level_ids = []
+        seen = set()
+        for api_level_instance in api_level_instances:
+            seen.add(api_level_instance['_id'])
+            priority, deadline = self.classify(api_level_instance) if self.classify else (CHECK, None)
+            if priority == IDLE:
+                with self.lock:
+                    self.stats['idle'] += 1
+                if deadline:
+                    self.schedule(api_level_instance, deadline)
+                else:
+                    # deactivated, incomplete or of another shard
+                    self.cancel(api_level_instance['_id'])
+                continue
+            self.submit(api_level_instance, priority, deadline)
+            level_ids.append(api_level_instance['_id'])
+        with self.lock:
+            # level instances gone from the API
+            for level_id in [level_id for level_id in self.timers if level_id not in seen]:
+                del self.timers[level_id]
+            metrics.REDUMP_TIMERS.set(len(self.timers))
+        # timers keep feeding the queue, only wait for this cycle
+        self.wait(level_ids)
+        with self.lock:
+            self.stats['duration'] = time.time() - self.stats['started_at']
+            stats = dict(self.stats)
+        metrics.CYCLE_SECONDS.observe(stats['duration'])
+        logger.info('cycle done in {0:.1f}s: {1} levels, {2} idle, {3} failed, {4} backing off, {5} skipped, queue depth peak {6} ({7} workers)'.format(
+            stats['duration'], stats['submitted'], stats['idle'], stats['failed'], stats['backoff'], stats['skipped'],
+            stats['queue_peak'], self.workers))
+        return stats
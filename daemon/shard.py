@@ -0,0 +1,130 @@
+import bisect
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+
+import metrics
+
+
+logger = logging.getLogger('hypervisor')
+
+
+def _hash(key):
+    return int(hashlib.md5(key).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+    """ I map keys to members with consistent hashing.
+
+    Every member is placed replicas times on the ring, a key belongs to
+    the first member after it; a member joining or leaving only moves the
+    keys next to its points.
+    """
+    def __init__(self, members, replicas=64):
+        self.members = sorted(members)
+        self.points = sorted((_hash('{0}#{1}'.format(member, i)), member) for member in self.members for i in range(replicas))
+        self.hashes = [point for point, _ in self.points]
+
+    def owner(self, key):
+        if not self.points:
+            return None
+        index = bisect.bisect(self.hashes, _hash(key)) % len(self.points)
+        return self.points[index][1]
+
+
+class LeaseStore(object):
+    """ I keep the leases of the hypervisor processes in a SQLite database.
+
+    The database is shared by the processes, their clocks must agree.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self.lock:
+            self.db.execute('CREATE TABLE IF NOT EXISTS leases (member TEXT PRIMARY KEY, expires_at REAL)')
+            self.db.commit()
+
+    def renew(self, member, ttl):
+        """ I extend the lease of a member, I return the members holding a lease. """
+        now = time.time()
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO leases VALUES (?, ?)', (member, now + ttl))
+            self.db.execute('DELETE FROM leases WHERE expires_at < ?', (now,))
+            self.db.commit()
+            return [row[0] for row in self.db.execute('SELECT member FROM leases ORDER BY member')]
+
+    def members(self):
+        """ I return the members holding a lease, without renewing any. """
+        with self.lock:
+            return [row[0] for row in self.db.execute('SELECT member FROM leases WHERE expires_at >= ? ORDER BY member', (time.time(),))]
+
+    def release(self, member):
+        with self.lock:
+            self.db.execute('DELETE FROM leases WHERE member = ?', (member,))
+            self.db.commit()
+
+
+class Shard(object):
+    """ I am the share of the level instances and docker hosts of a hypervisor process.
+
+    The lease of the process is renewed every third of ttl seconds, the
+    keys are split between the processes holding a lease. on_rebalance()
+    is called when a process joins or leaves. A process owns nothing for
+    a renewal period after joining, until the others have seen it, nor
+    while it fails to renew its lease.
+    """
+    def __init__(self, leases, name, ttl=30, replicas=64, on_rebalance=None):
+        self.leases = leases
+        self.name = name
+        self.ttl = ttl
+        self.replicas = replicas
+        self.on_rebalance = on_rebalance
+        self.lock = threading.Lock()
+        self.ring = HashRing([], replicas)
+        self.renewed_at = 0
+        self.released = False
+        self.joined_at = time.time()
+        self.renew()
+        thread = threading.Thread(target=self._run, name='shard-lease')
+        thread.daemon = True
+        thread.start()
+
+    def renew(self):
+        members = self.leases.renew(self.name, self.ttl)
+        with self.lock:
+            self.renewed_at = time.time()
+            changed = members != self.ring.members
+            if changed:
+                logger.info('shard {0}: {1} members ({2}), rebalancing'.format(self.name, len(members), ', '.join(members)))
+                self.ring = HashRing(members, self.replicas)
+        metrics.SHARD_MEMBERS.set(len(members))
+        if changed and self.on_rebalance:
+            self.on_rebalance()
+
+    def _run(self):
+        while not self.released:
+            time.sleep(self.ttl / 3.)
+            if self.released:
+                break
+            try:
+                self.renew()
+            except Exception:
+                logger.warning('shard {0}: failed to renew the lease'.format(self.name), exc_info=True)
+
+    def owns(self, key):
+        with self.lock:
+            now = time.time()
+            if now - self.joined_at < self.ttl / 3. or now - self.renewed_at > self.ttl:
+                # not seen by the others yet, or the lease expired and they took over
+                return False
+            return self.ring.owner(key) == self.name
+
+    def release(self):
+        """ I hand my keys over to the other processes. """
+        self.released = True
+        with self.lock:
+            self.renewed_at = 0
+        self.leases.release(self.name)
@@ -0,0 +1,736 @@
+#!/usr/bin/env python
+
+import argparse
+import datetime
+import email.utils
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import shlex
+import threading
+import time
+import uuid
+
+import yaml
+
+# docker.py reads its configuration at import time
+os.environ.setdefault('HTTP_LEVEL_PORT', '8080')
+os.environ.setdefault('AUTH_PROXY', 'localhost')
+
+from transport import Result, Transport, register_transport
+
+
+logger = logging.getLogger('hypervisor')
+
+
+def _sha(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _started_at(timestamp):
+    return datetime.datetime.utcfromtimestamp(timestamp).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+class FakeHost(object):
+    """ I am the state of a simulated docker host: its files, images and containers. """
+    def __init__(self, name, tarballs, cpus=4):
+        self.name = name
+        # tarball url -> docker-compose.yml it contains
+        self.tarballs = tarballs
+        self.cpus = cpus
+        self.files = {}
+        # image -> id
+        self.images = {}
+        # level id -> container ids, container id -> start time
+        self.containers = {}
+        self.started_at = {}
+        # path -> modification time, of level directories and tarballs
+        self.modified = {}
+        # unreachable, every command fails like ssh does
+        self.dead = False
+        self.lock = threading.Lock()
+
+    def images_of(self, level_id):
+        compose = yaml.load(self.files['levels/{0}/docker-compose.yml'.format(level_id)])
+        project = level_id.replace('-', '')
+        return [conf.get('image') or '{0}_{1}'.format(project, service) for service, conf in compose.iteritems()]
+
+    def members(self, tarball):
+        """ I return the '<name>.tar' files of a tarball, imported as 'image-for-<name>'. """
+        return sorted(set('{0}.tar'.format(name) for name in re.findall(r'image-for-([A-Za-z0-9_.-]+)', self.tarballs[tarball])))
+
+    def import_image(self, image):
+        self.images[image] = _sha('{0} {1}'.format(image, uuid.uuid4()))
+
+    def build(self, level_id):
+        for image in self.images_of(level_id):
+            self.images[image] = _sha('{0} {1}'.format(image, uuid.uuid4()))
+
+    def start(self, level_id, started_at=None):
+        self.stop(level_id)
+        compose = yaml.load(self.files['levels/{0}/docker-compose.yml'.format(level_id)])
+        containers = []
+        for service in sorted(compose):
+            container = _sha('{0} {1} {2}'.format(level_id, service, uuid.uuid4()))
+            self.started_at[container] = started_at or time.time()
+            containers.append(container)
+        self.containers[level_id] = containers
+
+    def stop(self, level_id):
+        for container in self.containers.pop(level_id, []):
+            self.started_at.pop(container, None)
+
+    def deploy(self, level_id, tarball, started_at):
+        """ I make a level look extracted, built and running since started_at. """
+        base = 'levels/{0}/'.format(level_id)
+        compose = self.tarballs[tarball]
+        self.modified[base] = started_at
+        self.files[base + 'docker-compose.yml'] = compose
+        self.files[base + 'source'] = tarball + '\n'
+        self.build(level_id)
+        lines = ['tarball {0}'.format(_sha(tarball)), 'compose {0}'.format(_sha(compose)), 'type web',
+                 'main {0}'.format(yaml.load(compose).keys()[0])]
+        lines += ['image {0} {1}'.format(image, self.images[image]) for image in self.images_of(level_id)]
+        self.files[base + 'BUILD'] = '\n'.join(lines) + '\n'
+        self.start(level_id, started_at)
+
+
+class Latencies(object):
+    """ I am what the operations of a simulated host cost, in seconds. """
+    def __init__(self, round_trip=0.002, command=0.0005, download=0.01, extract=0.005, build=0.05, up=0.01):
+        self.round_trip = round_trip
+        self.command = command
+        self.download = download
+        self.extract = extract
+        self.build = build
+        self.up = up
+
+
+class FakeTransport(Transport):
+    """ I answer the commands of DockerDriver the way a docker host would.
+
+    Only the commands the driver sends are understood, the others succeed
+    without output and are counted as unknown. A command fails with the
+    probability failure_rate.
+    """
+    def __init__(self, host, latencies, failure_rate=0., rng=None):
+        self.host = host
+        self.latencies = latencies
+        self.failure_rate = failure_rate
+        self.rng = rng or random.Random()
+        self.stats = {'round_trips': 0, 'commands': 0, 'failures': 0, 'unknown': 0}
+        self.lock = threading.Lock()
+
+    def __str__(self):
+        return self.host.name
+
+    def _count(self, key, value=1):
+        with self.lock:
+            self.stats[key] += value
+
+    def run_many(self, commands):
+        self._count('round_trips')
+        self._count('commands', len(commands))
+        time.sleep(self.latencies.round_trip)
+        return [self._run(command) for command in commands]
+
+    def _run(self, command):
+        time.sleep(self.latencies.command)
+        if self.host.dead:
+            self._count('failures')
+            return Result(command.cmd, 255, '', 'ssh: connect to host {0}: Connection refused'.format(self.host.name))
+        with self.lock:
+            failed = self.failure_rate and self.rng.random() < self.failure_rate
+        if failed:
+            self._count('failures')
+            return Result(command.cmd, 1, '', 'simulated failure')
+        try:
+            with self.host.lock:
+                returncode, stdout, duration = self._execute(command.cmd, command.stdin)
+        except KeyError as e:
+            return Result(command.cmd, 1, '', 'no such file or directory: {0}'.format(e))
+        time.sleep(duration)
+        return Result(command.cmd, returncode, stdout, '')
+
+    def _execute(self, cmd, stdin):
+        """ I apply a command to the host, I return its exit code, its output and how long it took. """
+        host = self.host
+        latencies = self.latencies
+        if cmd == 'bash -s':
+            return self._script(stdin)
+        m = re.match(r'^cat > (\S+)$', cmd)
+        if m:
+            host.files[m.group(1)] = stdin
+            return 0, '', 0
+        m = re.match(r'^cat (levels/\S+/(docker-compose\.yml|source|MANIFEST))$', cmd)
+        if m:
+            return 0, host.files[m.group(1)], 0
+        m = re.match(r'^wget -nc -q (\S+) -O (\S+)$', cmd)
+        if m:
+            if m.group(2) in host.files:
+                return 0, '', 0
+            # archives only hold the url they were downloaded from
+            host.files[m.group(2)] = m.group(1)
+            host.modified[m.group(2)] = time.time()
+            return 0, '', latencies.download
+        m = re.match(r'^mkdir -p levels/(\S+) ; tar -xf (\S+) -C levels/\S+$', cmd)
+        if m:
+            url = host.files[m.group(2)]
+            host.files['levels/{0}/docker-compose.yml'.format(m.group(1))] = host.tarballs[url]
+            for member in host.members(url):
+                host.files['levels/{0}/{1}'.format(m.group(1), member)] = url
+            host.modified['levels/{0}/'.format(m.group(1))] = time.time()
+            return 0, '', latencies.extract
+        m = re.match(r'^echo (.*) > levels/(\S+)/source$', cmd)
+        if m:
+            host.files['levels/{0}/source'.format(m.group(2))] = shlex.split(m.group(1))[0] + '\n'
+            return 0, '', 0
+        m = re.match(r'^cd (levels/\S+) ; cat (\S+) \| docker import - (\S+)$', cmd)
+        if m:
+            if '{0}/{1}'.format(m.group(1), m.group(2)) not in host.files:
+                return 1, '', 0
+            host.import_image(m.group(3))
+            return 0, '', latencies.build
+        m = re.match(r'^cd levels/(\S+) ; docker-compose build$', cmd)
+        if m:
+            host.build(m.group(1))
+            return 0, '', latencies.build
+        m = re.match(r'^cd levels/\S+; docker-compose run .*; docker commit .* (unix-\S+) && date .* > DUMPED$', cmd)
+        if m:
+            host.images[m.group(1)] = _sha('{0} {1}'.format(m.group(1), uuid.uuid4()))
+            return 0, '', latencies.up
+        m = re.match(r'^cd levels/(\S+) ; docker-compose up -d$', cmd)
+        if m:
+            host.start(m.group(1))
+            return 0, '', latencies.up
+        m = re.match(r'^cd levels/(\S+) ; docker-compose ps -q$', cmd)
+        if m:
+            return 0, ''.join(container + '\n' for container in host.containers.get(m.group(1), [])), 0
+        m = re.match(r'^test -d levels/(\S+) && ', cmd)
+        if m:
+            host.stop(m.group(1))
+            return 0, '', latencies.up
+        m = re.match(r'^docker inspect -f \S+ (\S+)$', cmd)
+        if m:
+            return 0, _started_at(host.started_at[m.group(1)]) + '\n', 0
+        m = re.match(r'^docker exec (\S+) bash -c', cmd)
+        if m:
+            if 'version' in cmd:
+                return 0, '1.0\n', 0
+            return 0, 'passphrase {0}\n'.format(m.group(1)[:16]), 0
+        m = re.match(r'^docker run --entrypoint=bash --rm unix-(\S+) -c', cmd)
+        if m:
+            return 0, 'passphrase {0}\n'.format(_sha(m.group(1))[:16]), 0
+        if cmd == 'docker ps --no-trunc':
+            lines = ['CONTAINER ID        IMAGE        NAMES']
+            for level_id, containers in sorted(host.containers.items()):
+                for i, container in enumerate(containers):
+                    lines.append('{0} image {1}_www_{2}'.format(container, level_id.replace('-', ''), i + 1))
+            return 0, '\n'.join(lines) + '\n', 0
+        m = re.match(r'^(docker rmi|docker rm -v|rm -f) (\S+)$', cmd)
+        if m:
+            if m.group(1) == 'docker rmi':
+                del host.images[m.group(2)]
+            elif m.group(1) == 'rm -f':
+                host.files.pop(m.group(2), None)
+                host.modified.pop(m.group(2), None)
+            return 0, '', 0
+        if re.match(r'^(mkdir -p |docker ps -q |docker info )', cmd):
+            return 0, '', 0
+        self._count('unknown')
+        logger.debug('simulated host {0} ignored: {1}'.format(host.name, cmd))
+        return 0, '', 0
+
+    def _script(self, script):
+        """ I run the scripts of DockerDriver and Scheduler, told apart by what they contain. """
+        host = self.host
+        if 'mark level' in script:
+            return 0, self._inventory(), 0
+        if '--to-command' in script:
+            level_id = re.search(r'cd levels/(\S+) \|\| exit 1', script).group(1)
+            url = host.files[re.search(r'archive=\$\(readlink -f (\S+)\)', script).group(1)]
+            host.files['levels/{0}/docker-compose.yml'.format(level_id)] = host.tarballs[url]
+            host.modified['levels/{0}/'.format(level_id)] = time.time()
+            # images are streamed to docker import, their members never reach the disk
+            lines = []
+            for member in host.members(url):
+                image = 'image-for-{0}'.format(member[:-len('.tar')])
+                host.import_image(image)
+                lines.append('imported {0}'.format(image))
+            lines.append('digest {0}'.format(_sha(url)))
+            return 0, '\n'.join(lines) + '\n', self.latencies.extract
+        if 'docker import - ' in script:
+            level_id = re.search(r'cd levels/(\S+) \|\| exit 1', script).group(1)
+            member = re.search(r'if \[ -f (\S+) \]', script).group(1)
+            archive = re.search(r'archive=\$\(readlink -f (\S+)\)', script).group(1)
+            if 'levels/{0}/{1}'.format(level_id, member) not in host.files and (archive not in host.files or member not in host.members(host.files[archive])):
+                return 1, '', 0
+            host.import_image(re.search(r'docker import - (\S+)', script).group(1))
+            return 0, '', self.latencies.build
+        if 'hypervisor-nginx-proxy' in script:
+            digest = re.search(r'echo (\S+) > DIGEST', script).group(1)
+            if host.files.get('hypervisor-nginx-proxy/DIGEST') == digest:
+                return 0, 'unchanged\n', 0
+            host.files['hypervisor-nginx-proxy/DIGEST'] = digest
+            return 0, '', self.latencies.up
+        if 'nproc' in script:
+            level_dirs = sorted(set(path.split('/')[1] for path in host.files if path.startswith('levels/')))
+            output = 'cpus {0}\nload 0.5\nmem_total 8388608\nmem_available 4194304\nlevel_dirs {1}\nartifacts\n'
+            return 0, output.format(host.cpus, ' '.join(level_dirs)), 0
+        if 'current_compose' in script:
+            return 0, self._build_check(script), 0
+        if '@@built_at' in script:
+            return 0, self._manifest(script), 0
+        if "'tarball %p" in script:
+            return 0, self._gc_scan(), 0
+        if 'rm -rf levels/' in script:
+            level_id = re.search(r'rm -rf levels/(\S+)', script).group(1)
+            host.stop(level_id)
+            for path in [path for path in host.files if path.startswith('levels/{0}/'.format(level_id))]:
+                del host.files[path]
+            host.modified.pop('levels/{0}/'.format(level_id), None)
+            for image in [image for image in host.images if image.startswith(level_id.replace('-', '') + '_')]:
+                del host.images[image]
+            host.images.pop('unix-{0}'.format(level_id), None)
+            return 0, '', self.latencies.up
+        if '> BUILD' in script:
+            return 0, self._build_record(script), 0
+        self._count('unknown')
+        return 0, '', 0
+
+    def _inventory(self):
+        host = self.host
+        lines = []
+        inspect = []
+        for level_id, containers in sorted(host.containers.items()):
+            base = 'levels/{0}/'.format(level_id)
+            lines += ['', '@@level {0}'.format(level_id), '', '@@compose', host.files.get(base + 'docker-compose.yml', '')]
+            lines += ['', '@@source', host.files.get(base + 'source', '')]
+            if base + 'MANIFEST' in host.files:
+                lines += ['', '@@manifest', host.files[base + 'MANIFEST']]
+                lines += ['@@container {0}'.format(container) for container in containers]
+                continue
+            for container in containers:
+                lines += ['', '@@container {0}'.format(container), '', '@@version {0}'.format(container), '1.0']
+                lines += ['', '@@passphrases {0}'.format(container), 'passphrase {0}'.format(container[:16])]
+                inspect.append({'Id': container, 'State': {'StartedAt': _started_at(host.started_at[container])}})
+        lines += ['', '@@inspect']
+        if inspect:
+            lines.append(json.dumps(inspect))
+        return '\n'.join(lines) + '\n'
+
+    def _manifest(self, script):
+        host = self.host
+        level_id = re.search(r'cd levels/(\S+) \|\| exit 1', script).group(1)
+        base = 'levels/{0}/'.format(level_id)
+        lines = ['@@built_at {0}'.format(_started_at(host.modified.get(base, time.time()))), '@@source', host.files.get(base + 'source', '')]
+        for container in host.containers.get(level_id, []):
+            lines += ['@@started_at {0}'.format(_started_at(host.started_at[container])), '@@version', '1.0', '']
+            lines += ['@@passphrases', 'passphrase {0}'.format(container[:16]), '']
+        return '\n'.join(lines) + '\n'
+
+    def _gc_scan(self):
+        host = self.host
+        lines = ['now {0}'.format(time.time())]
+        for level_id in sorted(set(path.split('/')[1] for path in host.files if path.startswith('levels/'))):
+            base = 'levels/{0}/'.format(level_id)
+            lines.append('level {0} {1}'.format(level_id, host.modified.get(base, time.time())))
+            for image in sorted(set(re.findall(r'image-for-[A-Za-z0-9_.-]*', host.files.get(base + 'docker-compose.yml', '')))):
+                lines.append('ref {0} {1}'.format(level_id, image))
+        for level_id in sorted(host.containers):
+            lines.append('running {0}'.format(level_id.replace('-', '')))
+        lines += ['image {0}'.format(image) for image in sorted(host.images) if image.startswith('image-for-')]
+        for path in sorted(host.files):
+            if path.startswith('/tmp/'):
+                lines.append('tarball {0} {1} {2}'.format(path, host.modified.get(path, time.time()), len(host.files[path])))
+        return '\n'.join(lines) + '\n'
+
+    def _build_check(self, script):
+        host = self.host
+        output = []
+        m = re.search(r'sha256sum < (\S+) \|', script)
+        if m:
+            output.append('current_tarball {0}'.format(_sha(host.files.get(m.group(1), ''))))
+        base = 'levels/{0}/'.format(re.search(r'cd levels/(\S+) 2>/dev/null', script).group(1))
+        if base + 'docker-compose.yml' in host.files:
+            build = host.files.get(base + 'BUILD', '')
+            output.append(build.rstrip('\n'))
+            output.append('current_compose {0}'.format(_sha(host.files[base + 'docker-compose.yml'])))
+            for line in build.splitlines():
+                chunks = line.split()
+                if chunks[0] == 'image':
+                    output.append('current_image {0} {1}'.format(chunks[1], host.images.get(chunks[1], '')))
+        return '\n'.join(output) + '\n'
+
+    def _build_record(self, script):
+        host = self.host
+        base = 'levels/{0}/'.format(re.search(r'cd levels/(\S+) \|\| exit 1', script).group(1))
+        host.files[base + 'source'] = shlex.split(re.search(r'echo (.*) > source', script).group(1))[0] + '\n'
+        lines = ['compose {0}'.format(_sha(host.files[base + 'docker-compose.yml']))]
+        for key in ('tarball', 'type', 'main'):
+            lines.append('{0} {1}'.format(key, re.search(r'echo "{0} (\S+)"'.format(key), script).group(1)))
+        for image in re.search(r'for image in (.*); do', script).group(1).split():
+            lines.append('image {0} {1}'.format(image, host.images.get(image, '')))
+        host.files[base + 'BUILD'] = '\n'.join(lines) + '\n'
+        return ''
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, content=None, headers=None):
+        self.status_code = status_code
+        self.text = json.dumps(content) if content is not None else ''
+        self.headers = {'Date': email.utils.formatdate(usegmt=True)}
+        self.headers.update(headers or {})
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class FakeApi(object):
+    """ I stand in for the requests session of ApiClient, serving level instances like Eve does.
+
+    A request fails with a 503 with the probability failure_rate.
+    """
+    def __init__(self, instances, latency=0.005, failure_rate=0., rng=None):
+        self.instances = dict((instance['_id'], instance) for instance in instances)
+        self.order = [instance['_id'] for instance in instances]
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.rng = rng or random.Random()
+        self.verify = False
+        self.stats = {'get': 0, 'patch': 0, 'not_modified': 0, 'conflicts': 0, 'failures': 0}
+        self.lock = threading.Lock()
+
+    def mount(self, prefix, adapter):
+        pass
+
+    def _request(self, method):
+        """ I return a failure, or None if the request goes through. """
+        time.sleep(self.latency)
+        with self.lock:
+            self.stats[method] += 1
+            if self.failure_rate and self.rng.random() < self.failure_rate:
+                self.stats['failures'] += 1
+                return FakeResponse(503, {'_status': 'ERR'})
+
+    def get(self, url, params=None, headers=None, timeout=None):
+        failure = self._request('get')
+        if failure:
+            return failure
+        resource, level_id = url.split('/')[-2:]
+        with self.lock:
+            if resource == 'raw-level-instances':
+                return FakeResponse(200, {'_etag': self.instances[level_id]['_etag']})
+            return self._page(dict(params or {}), headers or {})
+
+    def _page(self, params, headers):
+        level_ids = self.order
+        if 'where' in params:
+            since = email.utils.mktime_tz(email.utils.parsedate_tz(json.loads(params['where'])['_updated']['$gte']))
+            level_ids = [level_id for level_id in level_ids if self.instances[level_id]['_updated_at'] >= since]
+        size = int(params.get('max_results', 25))
+        page = int(params.get('page', 1))
+        items = []
+        for level_id in level_ids[(page - 1) * size:page * size]:
+            items.append(dict((k, v) for k, v in self.instances[level_id].items() if k != '_updated_at'))
+        content = {'_items': items, '_links': {}}
+        if page * size < len(level_ids):
+            content['_links']['next'] = {'href': 'hypervisor-level-instances?page={0}'.format(page + 1)}
+        etag = _sha(json.dumps(content, sort_keys=True))
+        if headers.get('If-None-Match') == etag:
+            self.stats['not_modified'] += 1
+            return FakeResponse(304)
+        return FakeResponse(200, content, {'ETag': etag})
+
+    def patch(self, url, data=None, headers=None, timeout=None):
+        failure = self._request('patch')
+        if failure:
+            return failure
+        with self.lock:
+            instance = self.instances[url.split('/')[-1]]
+            if headers.get('If-Match') != instance['_etag']:
+                self.stats['conflicts'] += 1
+                return FakeResponse(412, {'_status': 'ERR'})
+            instance.update(json.loads(data))
+            instance['_etag'] = uuid.uuid4().hex
+            instance['_updated_at'] = time.time()
+            instance['_updated'] = email.utils.formatdate(instance['_updated_at'], usegmt=True)
+            return FakeResponse(200, {'_etag': instance['_etag']})
+
+
+def make_catalog(args, rng):
+    """ I return the level instances served by the fake API and the tarballs they point at. """
+    tarballs = {}
+    for i in range(args.tarballs):
+        compose = {'www': {'build': '.', 'labels': {'PWR_LEVEL_TYPE': 'web'}}}
+        if i % 3 == 0:
+            compose['db'] = {'image': 'mysql'}
+        if i % 5 == 1:
+            compose['app'] = {'image': 'image-for-app{0}'.format(i)}
+        tarballs['http://levels.example.com/level{0}.tar'.format(i)] = yaml.dump(compose, default_flow_style=False)
+    urls = sorted(tarballs)
+    updated_at = time.time() - 3600
+    instances = []
+    for i in range(args.levels):
+        instances.append({
+            '_id': str(uuid.UUID(int=rng.getrandbits(128))),
+            '_etag': uuid.uuid4().hex,
+            '_updated': email.utils.formatdate(updated_at, usegmt=True),
+            '_updated_at': updated_at,
+            'active': True,
+            'level': {'url': rng.choice(urls), 'defaults': {'redump': args.redump}},
+        })
+    return instances, tarballs
+
+
+class Simulation(object):
+    """ I replay a catalog of level instances through a hypervisor managing fake hosts. """
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.latencies = Latencies(round_trip=args.latency, command=args.exec_cost, download=args.download_cost,
+                                   build=args.build_cost, up=args.up_cost)
+        self.instances, self.tarballs = make_catalog(args, self.rng)
+        self.hosts = {}
+        for i in range(args.hosts):
+            name = 'sim:host{0}'.format(i)
+            self.hosts[name] = FakeHost(name, self.tarballs)
+        # every hypervisor process has its own transports
+        self.transports = []
+        self.api = FakeApi(self.instances, latency=args.api_latency, failure_rate=args.api_failure_rate, rng=self.rng)
+        self._seed()
+
+    def _seed(self):
+        """ I deploy part of the catalog on the hosts, some of it already due for a redump. """
+        hosts = [self.hosts[name] for name in sorted(self.hosts)]
+        now = time.time()
+        for i, instance in enumerate(self.instances):
+            if self.rng.random() >= self.args.deployed:
+                continue
+            age = self.args.redump * (2 if self.rng.random() < self.args.due else 0.5)
+            hosts[i % len(hosts)].deploy(instance['_id'], instance['level']['url'], now - age)
+
+    def make_transport(self, host, sessions):
+        transport = FakeTransport(self.hosts[host], self.latencies, failure_rate=self.args.failure_rate,
+                                  rng=random.Random(self.rng.random()))
+        self.transports.append(transport)
+        return transport
+
+    def counters(self):
+        counters = dict.fromkeys(['round_trips', 'commands', 'failures', 'unknown'], 0)
+        for transport in self.transports:
+            with transport.lock:
+                for key in counters:
+                    counters[key] += transport.stats[key]
+        with self.api.lock:
+            for key, value in self.api.stats.items():
+                counters['api_' + key] = value
+        return counters
+
+    def _parallel(self, shards, fn):
+        threads = [threading.Thread(target=fn, args=(shard,)) for shard in shards]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def measure(self, name, fn):
+        """ I run a phase of the simulation and print what it cost. """
+        before = self.counters()
+        started_at = time.time()
+        fn()
+        duration = time.time() - started_at
+        after = self.counters()
+        delta = dict((key, after[key] - before[key]) for key in after)
+        print('{0:<14} {1:>8.2f}s {2:>8} {3:>9} {4:>8} {5:>9} {6:>8} {7:>9}'.format(
+            name, duration, delta['round_trips'], delta['commands'], delta['api_get'], delta['api_patch'],
+            delta['api_not_modified'], delta['failures'] + delta['api_failures']))
+
+    def run(self):
+        args = self.args
+        os.environ.update({
+            'API_ENDPOINT': 'http://api.simulation',
+            'DOCKER_POOL': ','.join(sorted(self.hosts)),
+            'REFRESH_RATE': '0',
+            'SENTRY_URL': '',
+            'RECONCILE_WORKERS': str(args.workers),
+            'HOST_CONCURRENCY': str(args.host_concurrency),
+            'API_PAGE_SIZE': str(args.page_size),
+            'STATE_PATH': args.state or '',
+            'SHARD_STORE': args.shard_store if args.shards > 1 else '',
+            'SHARD_LEASE': str(args.shard_lease),
+            'GC_RETENTION': str(args.gc_retention),
+            'GC_RATE': str(args.gc_rate),
+            'STREAM_INGEST': str(int(args.stream_ingest)),
+        })
+        register_transport('sim', self.make_transport)
+        if args.shards > 1 and os.path.exists(args.shard_store):
+            # leases of a previous run
+            os.remove(args.shard_store)
+        # the hypervisor reads its configuration at import time
+        import hypervisor
+        shards = []
+        for i in range(args.shards):
+            hypervisor.SHARD_NAME = 'sim-{0}'.format(i)
+            shard = hypervisor.Hypervisor()
+            shard.api.session = self.api
+            shards.append(shard)
+        h = shards[0]
+        if len(shards) > 1:
+            # every process sees the others, then waits until they saw it
+            for shard in shards:
+                shard.shard.renew()
+            time.sleep(args.shard_lease / 3.)
+
+        print('hosts={0} levels={1} deployed={2:.0%} due={3:.0%} workers={4} latency={5}s'.format(
+            args.hosts, args.levels, args.deployed, args.due, args.workers, args.latency))
+        print('{0:<14} {1:>9} {2:>8} {3:>9} {4:>8} {5:>9} {6:>8} {7:>9}'.format(
+            'phase', 'time', 'trips', 'commands', 'api get', 'api patch', 'api 304', 'failures'))
+        self.measure('load', lambda: self._parallel(shards, lambda shard: shard.load()))
+
+        def cycle():
+            self._parallel(shards, lambda shard: shard.cycle())
+            for shard in shards:
+                shard.writer.flush()
+        for host in sorted(self.hosts)[:args.dead_hosts]:
+            self.hosts[host].dead = True
+        for i in range(args.cycles):
+            self.measure('cycle {0}'.format(i + 1), cycle)
+
+        failed_redumps = []
+
+        def force_redump():
+            for instance in self.rng.sample(self.instances, min(args.force_redumps, len(self.instances))):
+                try:
+                    h.force_redump(instance['_id'])
+                except Exception:
+                    logger.warning('failed to redump {0}'.format(instance['_id']), exc_info=True)
+                    failed_redumps.append(instance['_id'])
+        if args.force_redumps:
+            self.measure('force-redump', force_redump)
+
+        def request_redump():
+            level_ids = [instance['_id'] for instance in self.rng.sample(self.instances, min(args.force_redumps, len(self.instances)))]
+            for level_id in level_ids:
+                owner = [shard for shard in shards if shard.owns(level_id)][0]
+                owner.request_redump(level_id)
+            for shard in shards:
+                shard.reconciler.wait(level_ids)
+                shard.writer.flush()
+        if args.force_redumps:
+            self.measure('request-redump', request_redump)
+
+        if args.prune:
+            # images pruned behind the back of the hypervisor are imported again
+            pruned = []
+            for host in self.hosts.values():
+                with host.lock:
+                    for image in [image for image in host.images if image.startswith('image-for-')]:
+                        del host.images[image]
+                        pruned.append(image)
+            redumped = [instance for instance in self.instances if 'image-for-' in self.tarballs[instance['level']['url']]]
+            redumped = self.rng.sample(redumped, min(args.prune, len(redumped)))
+
+            def prune():
+                for instance in redumped:
+                    try:
+                        h.force_redump(instance['_id'])
+                    except Exception:
+                        logger.warning('failed to redump {0}'.format(instance['_id']), exc_info=True)
+                        failed_redumps.append(instance['_id'])
+            self.measure('prune', prune)
+            restored = sum(1 for instance in redumped if h.pool.levels.get(instance['_id'], (None, None))[1] and
+                           all(image in self.hosts[h.pool.levels[instance['_id']][1].host].images
+                               for image in re.findall(r'image-for-[A-Za-z0-9_.-]+', self.tarballs[instance['level']['url']])))
+            print('{0} images pruned, {1}/{2} redumped levels have their images back'.format(len(pruned), restored, len(redumped)))
+
+        if args.state:
+            # a restarted hypervisor starts from the state store
+            restarted = hypervisor.Hypervisor()
+            restarted.api.session = self.api
+            self.measure('restart', restarted.start)
+            print('{0} levels restored'.format(len(restarted.pool.levels)))
+
+        if args.gc:
+            # level instances deactivated in the API leave orphans behind
+            for instance in self.rng.sample(self.instances, min(args.gc, len(self.instances))):
+                with self.api.lock:
+                    instance['active'] = False
+                    instance['_etag'] = uuid.uuid4().hex
+                    instance['_updated_at'] = time.time()
+                    instance['_updated'] = email.utils.formatdate(instance['_updated_at'], usegmt=True)
+            self.measure('sync', cycle)
+            orphans = []
+            self.measure('gc dry-run', lambda: orphans.extend(h.collect_garbage(dry_run=True)))
+            kinds = {}
+            for orphan in orphans:
+                kinds[orphan.kind] = kinds.get(orphan.kind, 0) + 1
+            print('orphans: {0}'.format(', '.join('{0} {1}'.format(count, kind) for kind, count in sorted(kinds.items()))))
+            self.measure('gc', h.collect_garbage)
+            self.measure('gc again', lambda: orphans.extend(h.collect_garbage(dry_run=True)))
+            print('{0}, {1} orphans left'.format(h.collector.summary(), len(orphans) - sum(kinds.values())))
+
+        if len(shards) > 1:
+            managed = [sum(1 for instance in self.instances if shard.owns(instance['_id'])) for shard in shards]
+            print('level instances by shard: {0}'.format(' '.join(str(count) for count in managed)))
+            # a shard leaving hands its level instances over to the others
+            shards[-1].shard.release()
+            for shard in shards[:-1]:
+                shard.shard.renew()
+
+            def rebalance():
+                self._parallel(shards[:-1], lambda shard: shard.cycle())
+                for shard in shards[:-1]:
+                    shard.writer.flush()
+            self.measure('rebalance', rebalance)
+
+        if args.dead_hosts:
+            status = h.status()
+            print('circuits: {0}'.format(', '.join('{0} {1}'.format(host, circuit['state']) for host, circuit in sorted(status['circuits'].items()))))
+            print('{0} levels backing off'.format(len(status['backoff'])))
+
+        running = sum(len(host.containers) for host in self.hosts.values())
+        print('{0} levels running, {1} forced redumps failed, {2} unknown commands'.format(
+            running, len(failed_redumps), self.counters()['unknown']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Pathwar\'s hypervisor simulation')
+    parser.add_argument('--hosts', type=int, default=10, help='number of fake docker hosts')
+    parser.add_argument('--levels', type=int, default=2000, help='number of level instances served by the fake API')
+    parser.add_argument('--tarballs', type=int, default=50, help='number of distinct level tarballs')
+    parser.add_argument('--deployed', type=float, default=0.9, help='fraction of the levels already running')
+    parser.add_argument('--due', type=float, default=0.05, help='fraction of the running levels due for a redump')
+    parser.add_argument('--redump', type=int, default=3600, help='redump period of the levels in seconds')
+    parser.add_argument('--cycles', type=int, default=2, help='number of reconciliation cycles')
+    parser.add_argument('--force-redumps', type=int, default=5, help='number of forced redumps')
+    parser.add_argument('--workers', type=int, default=8, help='number of reconciler workers')
+    parser.add_argument('--host-concurrency', type=int, default=2, help='concurrent level operations per host')
+    parser.add_argument('--page-size', type=int, default=25, help='level instances per API page')
+    parser.add_argument('--latency', type=float, default=0.002, help='round trip time of a ssh command')
+    parser.add_argument('--exec-cost', type=float, default=0.0005, help='remote cost of a command')
+    parser.add_argument('--download-cost', type=float, default=0.01, help='duration of a tarball download')
+    parser.add_argument('--build-cost', type=float, default=0.05, help='duration of a build or an import')
+    parser.add_argument('--up-cost', type=float, default=0.01, help='duration of starting or stopping a level')
+    parser.add_argument('--api-latency', type=float, default=0.005, help='duration of an API request')
+    parser.add_argument('--failure-rate', type=float, default=0., help='probability of a host command to fail')
+    parser.add_argument('--dead-hosts', type=int, default=0, help='number of hosts unreachable after the load phase')
+    parser.add_argument('--api-failure-rate', type=float, default=0., help='probability of an API request to fail')
+    parser.add_argument('--state', type=str, help='path of the state store, enables a restart phase')
+    parser.add_argument('--shards', type=int, default=1, help='number of hypervisor processes splitting the level instances')
+    parser.add_argument('--shard-store', type=str, default='/tmp/simulation-leases.db', help='path of the lease store of the shards')
+    parser.add_argument('--shard-lease', type=int, default=3, help='lease duration of the shards in seconds')
+    parser.add_argument('--gc', type=int, default=0, help='number of level instances deactivated before collecting garbage')
+    parser.add_argument('--gc-retention', type=int, default=0, help='retention of the garbage collector in seconds')
+    parser.add_argument('--gc-rate', type=int, default=60000, help='removals per minute and host of the garbage collector')
+    parser.add_argument('--stream-ingest', action='store_true', help='extract levels and import their images in a single pass')
+    parser.add_argument('--prune', type=int, default=0, help='number of levels redumped after their images were pruned')
+    parser.add_argument('--seed', type=int, default=42, help='seed of the simulated catalog')
+    parser.add_argument('-v', '--verbose', action='store_true', help='log what the hypervisor does')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.CRITICAL)
+    Simulation(args).run()
@@ -0,0 +1,77 @@
+import json
+import sqlite3
+import threading
+import time
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS levels (
+    id TEXT PRIMARY KEY,
+    host TEXT NOT NULL,
+    source TEXT,
+    dumped_at TEXT,
+    version TEXT,
+    level_type TEXT,
+    passphrases TEXT,
+    running INTEGER,
+    updated_at REAL
+)
+'''
+
+COLUMNS = ('id', 'host', 'source', 'dumped_at', 'version', 'level_type', 'passphrases', 'running', 'updated_at')
+
+
+class StateStore(object):
+    """ I persist which level runs on which host in a SQLite database.
+
+    Every change of DockerPool.levels is written through, so a restarted
+    daemon knows the levels before the first inventory completes.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.lock:
+            self.db.execute(SCHEMA)
+            self.db.commit()
+
+    def _row(self, level, host, level_type):
+        dumped_at = level.dumped_at.isoformat() if level.dumped_at else None
+        return (level.id, host, level.source, dumped_at, level.version, level_type,
+                json.dumps(level.passphrases or []), int(bool(level.running)), time.time())
+
+    def save(self, level, host, level_type=None):
+        """ I record a level and the host running it. """
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO levels VALUES ({0})'.format(', '.join('?' * len(COLUMNS))),
+                            self._row(level, host, level_type))
+            self.db.commit()
+
+    def delete(self, level_id):
+        with self.lock:
+            self.db.execute('DELETE FROM levels WHERE id = ?', (level_id,))
+            self.db.commit()
+
+    def replace_host(self, host, entries):
+        """ I replace the levels of a host by (level, level_type) entries, in one transaction. """
+        with self.lock:
+            self.db.execute('DELETE FROM levels WHERE host = ?', (host,))
+            self.db.executemany('INSERT OR REPLACE INTO levels VALUES ({0})'.format(', '.join('?' * len(COLUMNS))),
+                                [self._row(level, host, level_type) for level, level_type in entries])
+            self.db.commit()
+
+    def levels(self):
+        """ I return every recorded level as a dict. """
+        with self.lock:
+            rows = self.db.execute('SELECT {0} FROM levels'.format(', '.join(COLUMNS))).fetchall()
+        levels = []
+        for row in rows:
+            level = dict(zip(COLUMNS, row))
+            level['passphrases'] = json.loads(level['passphrases'] or '[]')
+            level['running'] = bool(level['running'])
+            levels.append(level)
+        return levels
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,357 @@
+import base64
+import logging
+import os
+import pipes
+import Queue
+import select
+import subprocess
+import threading
+import time
+import uuid
+
+import metrics
+
+
+logger = logging.getLogger('hypervisor')
+
+
+SSH_OPTIONS = ['-o', 'ControlMaster=auto', '-o', 'ControlPersist=10m', '-o', 'ControlPath=~/%r@%h:%p',
+               '-o', 'UserKnownHostsFile=/dev/null', '-o', 'StrictHostKeyChecking=no']
+
+# seconds granted to a remote `timeout` before the local side gives up
+TIMEOUT_GRACE = 10
+
+
+class CommandError(subprocess.CalledProcessError):
+    """ I am raised when a command exits with a non-zero code. """
+    def __init__(self, returncode, cmd, output=None, stderr=None):
+        subprocess.CalledProcessError.__init__(self, returncode, cmd, output)
+        self.stderr = stderr
+
+    def __str__(self):
+        return "Command '{0}' returned non-zero exit status {1}: {2}".format(self.cmd, self.returncode, (self.stderr or '').strip())
+
+
+class CommandTimeout(CommandError):
+    """ I am raised when a command did not finish in time. """
+    def __str__(self):
+        return "Command '{0}' timed out".format(self.cmd)
+
+
+class Command(object):
+    """ I am a command to run on a host, with optional stdin and timeout. """
+    def __init__(self, cmd, stdin=None, timeout=None):
+        self.cmd = cmd
+        self.stdin = stdin
+        self.timeout = timeout
+
+
+class Result(object):
+    """ I am the outcome of a command. """
+    def __init__(self, cmd, returncode, stdout='', stderr='', timed_out=False):
+        self.cmd = cmd
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.timed_out = timed_out
+
+    def check(self):
+        """ I raise if the command failed, else I return myself. """
+        if self.timed_out:
+            raise CommandTimeout(self.returncode, self.cmd, self.stdout, self.stderr)
+        if self.returncode != 0:
+            raise CommandError(self.returncode, self.cmd, self.stdout, self.stderr)
+        return self
+
+
+class Transport(object):
+    """ I execute shell commands on a host. """
+    def run_many(self, commands):
+        """ I run several commands in order and return their results. """
+        raise NotImplementedError()
+
+    def run(self, cmd, stdin=None, timeout=None):
+        return self.run_many([Command(cmd, stdin=stdin, timeout=timeout)])[0]
+
+    def call(self, cmd, stdin=None, timeout=None):
+        return self.run(cmd, stdin=stdin, timeout=timeout).returncode
+
+    def check_call(self, cmd, stdin=None, timeout=None):
+        self.run(cmd, stdin=stdin, timeout=timeout).check()
+        return 0
+
+    def check_output(self, cmd, stdin=None, timeout=None):
+        return self.run(cmd, stdin=stdin, timeout=timeout).check().stdout
+
+    def run_script(self, script, timeout=None):
+        """ I run a bash script and return its output. """
+        return self.check_output('bash -s', stdin=script, timeout=timeout)
+
+    def put(self, path, data, timeout=None):
+        """ I write data to a file on the host. """
+        self.check_call('cat > {0}'.format(pipes.quote(path)), stdin=data, timeout=timeout)
+
+    def _stream_argv(self, cmd):
+        raise NotImplementedError()
+
+    def _popen(self, cmd, **kwargs):
+        """ I run a command in its own process, outside of the sessions. """
+        return subprocess.Popen(self._stream_argv(cmd), **kwargs)
+
+    def upload(self, local_path, path, offset=0, timeout=None):
+        """ I append a local file, from an offset, to a file on the host. """
+        logger.debug('Uploading {0} to {1} on {2}'.format(local_path, path, self))
+        with open(local_path, 'rb') as f:
+            f.seek(offset)
+            process = self._popen('cat >> {0}'.format(pipes.quote(path)), stdin=f, stderr=subprocess.PIPE)
+            timer = None
+            if timeout:
+                timer = threading.Timer(timeout, process.kill)
+                timer.start()
+            try:
+                _, stderr = process.communicate()
+            finally:
+                if timer:
+                    timer.cancel()
+        if process.returncode != 0:
+            raise CommandError(process.returncode, 'upload {0}'.format(path), stderr=stderr)
+        metrics.COMMAND_BYTES.inc(os.path.getsize(local_path) - offset, host=str(self), direction='sent')
+
+    def stream(self, cmd):
+        """ I run a long-lived command in its own process and yield its output lines. """
+        logger.debug('Streaming on {0}: {1}'.format(self, cmd))
+        process = self._popen(cmd, stdout=subprocess.PIPE)
+        try:
+            for line in iter(process.stdout.readline, ''):
+                yield line.rstrip('\n')
+        finally:
+            if process.poll() is None:
+                process.kill()
+            process.wait()
+
+    def close(self):
+        pass
+
+
+class LocalTransport(Transport):
+    """ I execute commands with local subprocesses, in a given directory. """
+    def __init__(self, cwd=None):
+        self.cwd = cwd
+
+    def __str__(self):
+        return 'local:{0}'.format(self.cwd or '')
+
+    def _stream_argv(self, cmd):
+        return ['bash', '-c', cmd]
+
+    def _popen(self, cmd, **kwargs):
+        return subprocess.Popen(self._stream_argv(cmd), cwd=self.cwd, **kwargs)
+
+    def run_many(self, commands):
+        results = []
+        for command in commands:
+            if not isinstance(command, Command):
+                command = Command(command)
+            logger.debug('Executing locally: {0}'.format(command.cmd))
+            process = subprocess.Popen(['bash', '-c', command.cmd], cwd=self.cwd, stdin=subprocess.PIPE,
+                                       stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            timer = None
+            expired = []
+            if command.timeout:
+                def kill(process=process):
+                    expired.append(True)
+                    process.kill()
+                timer = threading.Timer(command.timeout, kill)
+                timer.start()
+            try:
+                stdout, stderr = process.communicate(command.stdin)
+            finally:
+                if timer:
+                    timer.cancel()
+            results.append(Result(command.cmd, process.returncode, stdout, stderr, timed_out=bool(expired)))
+            metrics.count_commands(str(self), [command], results[-1:])
+        return results
+
+
+def frame(token, command):
+    """ I return the bash code running a command in a session, see _Session. """
+    lines = ['__pw_out=$(mktemp) __pw_err=$(mktemp) __pw_in=/dev/null']
+    if command.stdin is not None:
+        lines.append('__pw_in=$(mktemp)')
+        lines.append("base64 -d > \"$__pw_in\" <<'@@PW_EOF'")
+        lines.append(base64.encodestring(command.stdin).rstrip('\n'))
+        lines.append('@@PW_EOF')
+    cmd = 'bash -c {0}'.format(pipes.quote(command.cmd))
+    if command.timeout:
+        cmd = 'timeout -k 5 {0} {1}'.format(int(command.timeout), cmd)
+    lines.append('{0} <"$__pw_in" >"$__pw_out" 2>"$__pw_err"; __pw_rc=$?'.format(cmd))
+    lines.append('echo "@@{0} $__pw_rc $(wc -c <"$__pw_out") $(wc -c <"$__pw_err")"'.format(token))
+    lines.append('cat "$__pw_out" "$__pw_err"')
+    lines.append('rm -f "$__pw_out" "$__pw_err"; test "$__pw_in" = /dev/null || rm -f "$__pw_in"')
+    return '\n'.join(lines) + '\n'
+
+
+class _Session(object):
+    """ I am a long-lived `bash -s` running on a host over ssh.
+
+    Every command is wrapped in a frame that stores its stdout and stderr
+    in remote temporary files, then prints a header followed by both
+    outputs; several frames can be written before reading the results.
+    """
+    def __init__(self, argv):
+        self.token = uuid.uuid4().hex
+        self.buffer = ''
+        self.process = subprocess.Popen(argv, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        drainer = threading.Thread(target=self._drain_stderr)
+        drainer.daemon = True
+        drainer.start()
+
+    def _drain_stderr(self):
+        for line in iter(self.process.stderr.readline, ''):
+            logger.debug('ssh: {0}'.format(line.rstrip()))
+
+    def alive(self):
+        return self.process.poll() is None
+
+    def close(self):
+        if self.alive():
+            self.process.kill()
+        self.process.wait()
+
+    def _fill(self, deadline):
+        if deadline is not None:
+            remaining = deadline - time.time()
+            if remaining <= 0 or not select.select([self.process.stdout], [], [], remaining)[0]:
+                raise CommandTimeout(None, 'session read')
+        chunk = os.read(self.process.stdout.fileno(), 65536)
+        if not chunk:
+            raise EOFError('ssh session closed')
+        self.buffer += chunk
+
+    def _readline(self, deadline):
+        while '\n' not in self.buffer:
+            self._fill(deadline)
+        line, self.buffer = self.buffer.split('\n', 1)
+        return line
+
+    def _read(self, size, deadline):
+        while len(self.buffer) < size:
+            self._fill(deadline)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def execute(self, commands):
+        """ I pipeline commands over the session and read their results. """
+        frames = ''.join(frame(self.token, command) for command in commands)
+        writer = threading.Thread(target=self._write, args=(frames,))
+        writer.daemon = True
+        writer.start()
+
+        results = []
+        for command in commands:
+            deadline = None
+            if command.timeout:
+                deadline = time.time() + command.timeout + TIMEOUT_GRACE
+            header = self._readline(deadline)
+            while not header.startswith('@@{0} '.format(self.token)):
+                # noise from the remote login scripts
+                header = self._readline(deadline)
+            returncode, out_size, err_size = [int(chunk) for chunk in header.split()[1:]]
+            stdout = self._read(out_size, deadline)
+            stderr = self._read(err_size, deadline)
+            timed_out = bool(command.timeout) and returncode in (124, 137)
+            results.append(Result(command.cmd, returncode, stdout, stderr, timed_out=timed_out))
+        writer.join()
+        return results
+
+    def _write(self, frames):
+        try:
+            self.process.stdin.write(frames)
+            self.process.stdin.flush()
+        except (IOError, OSError):
+            logger.debug('failed to write to ssh session', exc_info=True)
+
+
+class SSHTransport(Transport):
+    """ I execute commands over persistent ssh sessions to a host. """
+    def __init__(self, host, sessions=1, options=None):
+        self.host = host
+        self.options = options or SSH_OPTIONS
+        self.argv = ['ssh'] + self.options + [host, 'bash', '-s']
+        self.max_sessions = sessions
+        self.opened = 0
+        self.idle = Queue.Queue()
+        self.lock = threading.Lock()
+
+    def __str__(self):
+        return self.host
+
+    def _stream_argv(self, cmd):
+        return ['ssh'] + self.options + [self.host, cmd]
+
+    def _acquire(self):
+        with self.lock:
+            if self.idle.empty() and self.opened < self.max_sessions:
+                self.opened += 1
+                logger.debug('opening ssh session to {0}'.format(self.host))
+                return _Session(self.argv)
+        return self.idle.get()
+
+    def _release(self, session, healthy):
+        if healthy and session.alive():
+            self.idle.put(session)
+            return
+        session.close()
+        with self.lock:
+            self.opened -= 1
+            # let a waiting caller open a fresh session
+            self.idle.put(None)
+
+    def run_many(self, commands):
+        commands = [command if isinstance(command, Command) else Command(command) for command in commands]
+        for command in commands:
+            logger.debug('Executing on {0}: {1}'.format(self.host, command.cmd))
+        session = self._acquire()
+        while session is None:
+            session = self._acquire()
+        healthy = False
+        try:
+            results = session.execute(commands)
+            healthy = True
+            metrics.count_commands(self.host, commands, results)
+            return results
+        except CommandTimeout:
+            raise CommandTimeout(None, '; '.join(command.cmd for command in commands))
+        except EOFError:
+            raise CommandError(255, '; '.join(command.cmd for command in commands), stderr='ssh session to {0} closed'.format(self.host))
+        finally:
+            self._release(session, healthy)
+
+    def close(self):
+        while not self.idle.empty():
+            session = self.idle.get()
+            if session:
+                session.close()
+
+
+# transports of other DOCKER_POOL prefixes, see register_transport
+FACTORIES = {}
+
+
+def register_transport(prefix, factory):
+    """ I make the DOCKER_POOL entries '<prefix>:<name>' use factory(host, sessions). """
+    FACTORIES[prefix] = factory
+
+
+def make_transport(host, sessions=1):
+    """ I return the transport matching a DOCKER_POOL entry.
+
+    'local:<dir>' runs commands locally in <dir>, anything else is a ssh
+    destination unless its prefix was registered.
+    """
+    prefix = host.split(':', 1)[0]
+    if ':' in host and prefix in FACTORIES:
+        return FACTORIES[prefix](host, sessions)
+    if host.startswith('local:'):
+        return LocalTransport(cwd=host[len('local:'):] or None)
+    return SSHTransport(host, sessions=sessions)
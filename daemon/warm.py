@@ -0,0 +1,53 @@
+import logging
+import threading
+
+
+logger = logging.getLogger('hypervisor')
+
+
+class WarmPool(object):
+    """ I keep spare instances of frequently redumped levels.
+
+    A spare is a level extracted and built on another server than the one
+    running it, but not started: switching to it only starts its containers.
+    After a blue/green redump, the server of the previous instance still has
+    the images of the level and becomes its next spare.
+    """
+    def __init__(self, pool, max_redump):
+        self.pool = pool
+        # levels redumped at least that often (in seconds) get a spare
+        self.max_redump = max_redump
+        # level_id -> (server, tarball)
+        self.spares = {}
+        self.lock = threading.Lock()
+
+    def wants(self, api_level):
+        """ I return True if a level is redumped often enough to deserve a spare. """
+        return bool(self.max_redump) and api_level['defaults']['redump'] <= self.max_redump
+
+    def keep(self, level_id, server, tarball):
+        """ I remember a server as having a spare of a level. """
+        with self.lock:
+            self.spares[level_id] = (server, tarball)
+
+    def take(self, level_id, tarball):
+        """ I return the server having a spare of a level built from a tarball, if any. """
+        with self.lock:
+            server, spare_tarball = self.spares.pop(level_id, (None, None))
+        if server and spare_tarball == tarball and server in self.pool.pool:
+            logger.info('switching level {0} to its spare on {1}'.format(level_id, server.host))
+            return server
+
+    def warm(self, level_id, tarball):
+        """ I prepare a spare of a level on another server than its current one. """
+        with self.lock:
+            if self.spares.get(level_id, (None, None))[1] == tarball:
+                return
+        current = self.pool.levels.get(level_id)
+        exclude = [current[1]] if current else []
+        if len(self.pool.pool) <= len(exclude):
+            return
+        logger.info('preparing a spare of level {0}'.format(level_id))
+        server = self.pool.prepare_level(level_id, tarball, exclude=exclude)
+        if server:
+            self.keep(level_id, server, tarball)